@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+import pandas as pd
+
+import controller
+
+"""Offline benchmarks for the triage pipeline on synthetic Incidents and QosEtwEvent data, nothing here talks to Kusto.
+Run from this directory:
+	python benchmark-triage.py
+
+	OR to record a baseline and later fail when a stage gets slower or hungrier than it,
+	python benchmark-triage.py --save-baseline triage-baseline.json
+	python benchmark-triage.py --baseline triage-baseline.json
+
+	OR to see how the stages scale,
+	python benchmark-triage.py --rows 200000 --duplicate-ratio 0.99 --incidents 200 --latency-ms 250
+"""
+
+frameNamespaces = ['Microsoft.WindowsAzure.Networking.Nrp', 'Microsoft.Azure.Networking.Slb', 'Microsoft.Cloudnet.PubSub', 'System.Threading.Tasks']
+frameDirectories = ['frontend', 'backend', 'manager', 'core', 'common', 'workers', 'validation', 'providers']
+noiseLines = [
+    '--- End of stack trace from previous location where exception was thrown ---',
+    '   at System.Runtime.ExceptionServices.ExceptionDispatchInfo.Throw()',
+    '   at System.Runtime.CompilerServices.TaskAwaiter.HandleNonSuccessAndDebuggerNotification(Task task)',
+]
+
+def syntheticFrame(rng: random.Random) -> str:
+    # Same shape as the frames stackFramePattern pulls out of QosEtwEvent ErrorDetails
+    source = rng.choice(list(controller.teamMap))
+    path = '\\'.join([source] + rng.sample(frameDirectories, rng.randint(1, 3)))
+    method = f"{rng.choice(frameNamespaces)}.{rng.choice(['Put', 'Get', 'Delete', 'Validate', 'Apply'])}{rng.randint(1, 40)}Async"
+    return f"   at {method}() in d:\\bt\\{rng.randint(1000, 99999)}\\repo\\src\\sources\\{path}\\{rng.choice(['Handler', 'Worker', 'Client'])}.cs:line {rng.randint(1, 2000)}"
+
+def syntheticErrorDetails(rng: random.Random) -> str:
+    lines = [f"System.InvalidOperationException: Operation failed with {rng.choice(['Conflict', 'InternalServerError', 'Timeout'])}"]
+    for _ in range(rng.randint(4, 30)):
+        lines.append(syntheticFrame(rng) if rng.random() < 0.7 else rng.choice(noiseLines))
+    return '\n'.join(lines)
+
+def syntheticQosEvents(rowCount: int, duplicateRatio: float, subscriptionId: str, seed: int) -> pd.DataFrame:
+    # duplicateRatio of the rows repeat an ErrorDetails another row already has, like one bug failing many operations
+    rng = random.Random(seed)
+    distinct = [syntheticErrorDetails(rng) for _ in range(max(1, round(rowCount * (1 - duplicateRatio))))]
+    errorDetails = distinct + [rng.choice(distinct) for _ in range(rowCount - len(distinct))]
+    rng.shuffle(errorDetails)
+    start = pd.Timestamp('2024-01-02T00:00:00')
+    return pd.DataFrame({
+        'TIMESTAMP': [start + pd.Timedelta(seconds=second) for second in sorted(rng.randint(0, 2 * 24 * 3600) for _ in range(rowCount))],
+        'ErrorDetails': errorDetails,
+        'CorrelationRequestId': [f'{rng.getrandbits(64):016x}' for _ in range(rowCount)],
+        'SubscriptionId': subscriptionId,
+        'ResourceGroup': [f'rg-{rng.randint(1, 5)}' for _ in range(rowCount)],
+        'StackTrace': '',
+        'ErrorCode': [rng.choice(['InternalServerError', 'Conflict', 'OperationTimedOut']) for _ in range(rowCount)],
+        'OperationId': [f'op-{rng.randint(1, 1000)}' for _ in range(rowCount)],
+        'OperationName': [rng.choice(['PutLoadBalancer', 'PutNetworkInterface', 'DeleteVirtualNetwork']) for _ in range(rowCount)],
+    })
+
+def syntheticIncidents(incidentIds: List[int], subscriptionCount: int, seed: int) -> pd.DataFrame:
+    # One row per incident in the shape grabICMBatch returns
+    rng = random.Random(seed)
+    rows = []
+    for incidentId in incidentIds:
+        subscriptionId = f'00000000-0000-0000-0000-{incidentId % subscriptionCount:012d}'
+        startTime = pd.Timestamp('2024-01-02T00:00:00') + pd.Timedelta(minutes=rng.randint(0, 24 * 60))
+        summary = (f"Customer reports failures. Problem start time: {startTime.month}/{startTime.day}/{startTime.year} "
+                   f"{startTime.strftime('%I:%M:%S %p').lstrip('0')} UTC<br>Resource: /subscriptions/{subscriptionId}/resourceGroups/rg-1/"
+                   f"providers/Microsoft.Network/loadBalancers/lb-{incidentId}<br>" + 'Details of the customer impact. ' * rng.randint(5, 50))
+        hops = rng.sample(sorted(set(controller.teamMap.values())), rng.randint(1, 3))
+        rows.append({
+            'Summary': summary, 'SubscriptionId': subscriptionId, 'SupportTicketId': f'st-{incidentId}', 'IncidentStartTime': startTime, 'IncidentId': incidentId,
+            'teamHistory': [{'OwningTeamName': team, 'ModifiedDate': controller.Helper.kustoDatetime(startTime + pd.Timedelta(hours=hop))} for hop, team in enumerate(hops)],
+        })
+    return pd.DataFrame(rows)
+
+class SyntheticKusto:
+    # Responder for FakeKustoClient answering the queries runBody sends, each subscription gets its own QosEtwEvent rows
+    def __init__(self, rowsPerIncident: int, duplicateRatio: float, subscriptionCount: int, seed: int):
+        self.rowsPerIncident = rowsPerIncident
+        self.duplicateRatio = duplicateRatio
+        self.subscriptionCount = subscriptionCount
+        self.seed = seed
+        self.qosEvents = {}
+
+    def respond(self, database: str, query: str) -> pd.DataFrame:
+        tail = query.split('};')[-1]
+        if 'grabICMBatch' in tail:
+            return syntheticIncidents([int(incidentId) for incidentId in re.findall(r'\d+', tail.split('dynamic', 1)[1])], self.subscriptionCount, self.seed)
+        if 'logs_of_interest' in tail:
+            subscriptionId = re.search(r'"([0-9a-f-]{36})"', tail).group(1)
+            if subscriptionId not in self.qosEvents:
+                self.qosEvents[subscriptionId] = syntheticQosEvents(self.rowsPerIncident, self.duplicateRatio, subscriptionId, self.seed + len(self.qosEvents))
+            return self.qosEvents[subscriptionId]
+        raise ValueError(f'SyntheticKusto has no answer for: {tail.strip()[:200]}')
+
+def stages(args: argparse.Namespace) -> List[Tuple[str, int, Callable[[], Any], Callable[[Any], Any]]]:
+    # (name, rows handled per run, setup, stage), setup isn't timed
+    exceptions = controller.Exceptions()
+    qosEvents = syntheticQosEvents(args.rows, args.duplicate_ratio, '00000000-0000-0000-0000-000000000000', args.seed)
+    parsed = exceptions.parseErrorDetails(qosEvents.copy())
+    mapped = exceptions.mapToTeams(parsed.copy())
+    predicted = exceptions.get_predicted_owning_team(mapped.copy())
+    incidents = syntheticIncidents(list(range(1, args.incidents + 1)), args.subscriptions, args.seed)
+
+    def coldPredictOwningTeams(errorLogs: pd.DataFrame) -> pd.DataFrame:
+        controller.stackCache.invalidate()
+        return exceptions.predictOwningTeams(errorLogs)
+
+    def runBodies(incidentIds: List[int]) -> List[pd.DataFrame]:
+        controller.Helper.invalidateCaches()
+        controller.stackCache.invalidate()
+        return exceptions.runBodies(incidentIds, args.workers, refresh=True)
+
+    return [
+        ('parseErrorDetails', len(qosEvents), qosEvents.copy, exceptions.parseErrorDetails),
+        ('mapToTeams', len(parsed), parsed.copy, exceptions.mapToTeams),
+        ('get_predicted_owning_team', len(mapped), mapped.copy, exceptions.get_predicted_owning_team),
+        ('predictOwningTeams (cold cache)', len(qosEvents), qosEvents.copy, coldPredictOwningTeams),
+        ('combineNrpLogs', len(predicted), predicted.copy, exceptions.combineNrpLogs),
+        ('parseSummary', len(incidents), incidents.copy, exceptions.parseSummary),
+        ('runBodies (fake Kusto)', args.incidents, lambda: list(range(1, args.incidents + 1)), runBodies),
+    ]
+
+def measure(setup: Callable[[], Any], stage: Callable[[Any], Any], repeat: int) -> Tuple[float, float]:
+    # Peak memory gets its own run, which also warms up anything loaded lazily, tracing allocations slows the stage
+    # down too much to time it in the same run
+    stageInput = setup()
+    tracemalloc.start()
+    try:
+        stage(stageInput)
+        peakBytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    durations = []
+    for _ in range(repeat):
+        stageInput = setup()
+        start = time.perf_counter()
+        stage(stageInput)
+        durations.append(time.perf_counter() - start)
+    # The fastest run is the one least disturbed by everything else on the machine, so it's the steadiest to compare
+    return min(durations), peakBytes
+
+def runSuite(args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    responder = SyntheticKusto(args.rows_per_incident, args.duplicate_ratio, args.subscriptions, args.seed)
+    controller.kustoClients.register('icm', lambda: controller.FakeKustoClient(responder.respond, args.latency_ms / 1000))
+    controller.kustoClients.register('nrp', lambda: controller.FakeKustoClient(responder.respond, args.latency_ms / 1000))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        controller.incidentStore = controller.IncidentStore(os.path.join(directory, 'benchmark.sqlite3'), controller.logTLDRSchemaVersion)
+        for name, rowCount, setup, stage in stages(args):
+            seconds, peakBytes = measure(setup, stage, args.repeat)
+            results[name] = {'rows': rowCount, 'seconds': seconds, 'rows_per_second': rowCount / seconds if seconds else float('inf'), 'peak_mb': peakBytes / 2 ** 20}
+            print(f"  {name:32} {rowCount:8} rows  {seconds * 1000:10.1f} ms  {results[name]['rows_per_second']:12.0f} rows/s  {results[name]['peak_mb']:8.1f} MB peak")
+    return results
+
+def compareToBaseline(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if result['rows_per_second'] < baseline[name]['rows_per_second'] / tolerance:
+            regressions.append(f"{name}: {result['rows_per_second']:.0f} rows/s, baseline {baseline[name]['rows_per_second']:.0f} rows/s")
+        if result['peak_mb'] > baseline[name]['peak_mb'] * tolerance:
+            regressions.append(f"{name}: {result['peak_mb']:.1f} MB peak, baseline {baseline[name]['peak_mb']:.1f} MB")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the triage stages on synthetic Kusto data.')
+    parser.add_argument('--rows', type=int, default=20000, help='QosEtwEvent rows for the per-stage benchmarks')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.9, help='share of rows whose ErrorDetails repeats another row')
+    parser.add_argument('--incidents', type=int, default=40, help='incidents for parseSummary and runBodies')
+    parser.add_argument('--rows-per-incident', type=int, default=2000, help='QosEtwEvent rows each incident\'s logs_of_interest returns')
+    parser.add_argument('--subscriptions', type=int, default=10, help='distinct subscriptions the incidents are spread over')
+    parser.add_argument('--latency-ms', type=float, default=50, help='latency of every fake Kusto query')
+    parser.add_argument('--workers', type=int, default=controller.maxIncidentWorkers, help='incident workers for runBodies')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--baseline', help='JSON written by --save-baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='fail when a stage is this many times slower or bigger than the baseline')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    config = {name: value for name, value in vars(args).items() if name not in ('baseline', 'tolerance', 'save_baseline', 'repeat')}
+    print(f"Benchmarking with {config}")
+    results = runSuite(args)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baselineFile:
+            json.dump({'config': config, 'results': results}, baselineFile, indent=2)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        if baseline['config'] != config:
+            print(f"\nBaseline {args.baseline} was recorded with {baseline['config']}, rerun with the same options to compare")
+            sys.exit(2)
+        regressions = compareToBaseline(results, baseline['results'], args.tolerance)
+        if regressions:
+            print('\nRegressed past baseline:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+        print(f"\nWithin {args.tolerance}x of baseline {args.baseline}")
@@ -0,0 +1,1051 @@
+from contextlib import closing
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, List
+import unittest
+import warnings
+
+import pandas as pd
+
+import controller
+
+"""Offline tests for controller.py, nothing here talks to Kusto. Run from this directory:
+	python -m unittest controller-tests.py
+
+	OR to run an individual unit test,
+	python -m unittest controller-tests.py -k <name-of-test>
+"""
+
+# The per-key scan mapToTeams used before TeamMatcher, kept as the reference the matcher has to agree with
+def referenceMapLineToTeam(cleanedLines: List[str]) -> List[Dict[str, Any]]:
+    teamCounts = {}
+    for lineIndex, line in enumerate(cleanedLines):
+        for key, team in controller.teamMap.items():
+            matches = list(re.finditer(key.lower(), line.lower()))
+            num_matches = len(matches)
+            if matches:
+                last_match = matches[-1]
+                before_key = line[:last_match.start()]
+                words_before_key = len(before_key.split())
+
+                if key in teamCounts:
+                    teamCounts[key]['match_count'] += num_matches
+                    if lineIndex <= teamCounts[key]['exception_method_idx'][0]:
+                        teamCounts[key]['exception_method_idx'] = [lineIndex, words_before_key]
+                else:
+                    teamCounts[key] = {
+                        'team_key': key,
+                        'team_value': team,
+                        'match_count': num_matches,
+                        'exception_method_idx' : [lineIndex, words_before_key]
+                    }
+    return list(teamCounts.values())
+
+# The sort get_predicted_owning_team ran over each row's MappedTeams before they became dense columns
+def referencePredictedOwningTeam(mappedTeams: List[Dict[str, Any]]) -> str:
+    sortedTeams = sorted(mappedTeams, key=lambda team: (-team['match_count'], team['exception_method_idx'][0], -team['exception_method_idx'][1]))
+    return sortedTeams[0]['team_value'] if sortedTeams else ""
+
+def referenceDenseRow(mappedTeams: List[Dict[str, Any]]) -> List[int]:
+    keyCount = len(controller.teamMatcher.keys)
+    row = [0] * (3 * keyCount)
+    for team in mappedTeams:
+        keyIdx = controller.teamMatcher.keys.index(team['team_key'])
+        row[keyIdx] = team['match_count']
+        row[keyCount + keyIdx], row[2 * keyCount + keyIdx] = team['exception_method_idx']
+    return row
+
+# The per-row cleanLines parseErrorDetails used before it was vectorized
+def referenceCleanLines(lines: List[str]) -> List[str]:
+    cleanedLines = []
+    for line in lines:
+        match = re.search(r"bt\\[0-9]+\\repo\\src\\sources\\([a-zA-Z\\]+)", line)
+        if match:
+            path = match.group(1)
+            cleanedPath = re.sub(r'[0-9]+', '', path).replace('\\', ' ')
+            cleanedLines.append(cleanedPath)
+    return cleanedLines
+
+class ParseErrorDetailsTests(unittest.TestCase):
+    errorDetails = [
+        "\n".join([
+            r"   at Foo() in d:\bt\1234\repo\src\sources\nrp\frontend\Handler.cs:line 10",
+            r"   at Bar() in d:\bt\1234\repo\src\sources\slb\manager\Slb.cs:line 20 d:\bt\1\repo\src\sources\rnm\Second.cs",
+            r"   noise line",
+            r"   at Baz() in d:\bt\99\repo\src\sources\nrpinternal\nrp2\Inner.cs:line 3",
+        ]),
+        "no frames at all",
+        "",
+        r"d:\bt\7\repo\src\sources\pubsub\x\Y.cs",
+    ]
+
+    def test_matches_reference_and_drops_rows_without_frames(self):
+        errorLogs = pd.DataFrame({'ErrorDetails': self.errorDetails, 'Row': range(len(self.errorDetails))}, index=[10, 11, 12, 13])
+        expected = [referenceCleanLines(details.split('\n')) for details in self.errorDetails]
+
+        actual = controller.Exceptions().parseErrorDetails(errorLogs.copy())
+        self.assertEqual(actual.index.tolist(), [10, 13])
+        self.assertEqual(actual['ExceptionCallStack'].tolist(), [stack for stack in expected if stack])
+
+class TeamMatcherTests(unittest.TestCase):
+    words = list(controller.teamMap.keys()) + ["NrpInternal", "SLB", "frontend", "manager", "nrpnrp", "networkservicenrp", "Microsoft", "Network", "x"]
+
+    def randomStack(self, rng: random.Random) -> List[str]:
+        lines = []
+        for _ in range(rng.randint(0, 8)):
+            separator = rng.choice([" ", "", "  "])
+            lines.append(separator.join(rng.choice(self.words) for _ in range(rng.randint(1, 7))))
+        return lines
+
+    def test_matches_reference_on_known_stacks(self):
+        stacks = [
+            [],
+            ["nrp frontend Handler", "slb manager Slb", "nrpinternal nrp Inner"],
+            ["NrpInternal NRPInternal nrp", "networkservice virtualwan", "pubsubpubsub applicationgateway"],
+            ["nrpnrpnrp", "xnrpinternalx nrp"],
+            ["rnm core Rnm", "pubsub x Y"],
+        ]
+        expected = [referenceDenseRow(referenceMapLineToTeam(stack)) for stack in stacks]
+        self.assertEqual(controller.teamMatcher.matchStacks(stacks).tolist(), expected)
+
+    def test_matches_reference_on_random_stacks(self):
+        rng = random.Random(1234)
+        stacks = [self.randomStack(rng) for _ in range(2000)]
+        expected = [referenceDenseRow(referenceMapLineToTeam(stack)) for stack in stacks]
+        self.assertEqual(controller.teamMatcher.matchStacks(stacks).tolist(), expected)
+
+    def test_map_to_teams_keeps_rows_and_predictions(self):
+        rng = random.Random(42)
+        stacks = [self.randomStack(rng) for _ in range(300)]
+        errorLogs = pd.DataFrame({'ExceptionCallStack': stacks})
+
+        expectedTeams = errorLogs['ExceptionCallStack'].apply(referenceMapLineToTeam)
+        expectedTeams = expectedTeams[expectedTeams.map(len) > 0]
+
+        exceptions = controller.Exceptions()
+        actual = exceptions.get_predicted_owning_team(exceptions.mapToTeams(errorLogs.copy()))
+        self.assertEqual(actual.index.tolist(), expectedTeams.index.tolist())
+        self.assertEqual(actual[controller.teamMatcher.denseColumns].to_numpy().tolist(), [referenceDenseRow(teams) for teams in expectedTeams])
+        self.assertEqual(actual['PredictedOwningTeam'].tolist(), [referencePredictedOwningTeam(teams) for teams in expectedTeams])
+
+class KustoRecordingTests(unittest.TestCase):
+    def test_replay_returns_what_was_recorded(self):
+        recordedDf = pd.DataFrame({
+            'TIMESTAMP': pd.to_datetime(['2024-01-02T15:00:00.1234567', '2024-01-02T15:01:00.0000000']), 'ErrorDetails': ['a\nb', None],
+            'Count': [3, 4], 'Ratio': [0.5, None], 'teamHistory': [[{'OwningTeamName': 'CLOUDNET\\NRP'}], []],
+        })
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = controller.RecordingKustoClient(controller.FakeKustoClient(lambda database, query: recordedDf), directory)
+            expected = controller.kustoHelpers.dataframe_from_result_table(recorder.execute('mdsnrp', 'QosEtwEvent | take 2').primary_results[0])
+
+            replayer = controller.ReplayKustoClient(directory, latencySeconds=0.01)
+            actual = controller.kustoHelpers.dataframe_from_result_table(replayer.execute('mdsnrp', 'QosEtwEvent | take 2').primary_results[0])
+            streamed = next(replayer.execute_streaming_query('mdsnrp', 'QosEtwEvent | take 2').iter_primary_results())
+            self.assertEqual(len(list(streamed.raw_rows)), 2)
+            with self.assertRaises(LookupError):
+                replayer.execute('mdsnrp', 'QosEtwEvent | take 3')
+
+        pd.testing.assert_frame_equal(actual, expected)
+        self.assertEqual(replayer.queryCount, 2)
+        self.assertAlmostEqual(replayer.injectedLatencySeconds, 0.02)
+
+class MetricsTests(unittest.TestCase):
+    def test_renders_prometheus_text(self):
+        metrics = controller.Metrics()
+        metrics.declare('query_seconds', 'histogram', 'Query latency.', ('template',), (0.1, 1))
+        metrics.declare('in_flight', 'gauge', 'Work in flight.')
+        for value in [0.05, 0.5, 5]:
+            metrics.observe('query_seconds', value, template='grab"ICM')
+        metrics.increment('in_flight')
+
+        self.assertEqual(metrics.render().splitlines(), [
+            '# HELP query_seconds Query latency.',
+            '# TYPE query_seconds histogram',
+            'query_seconds_bucket{template="grab\\"ICM",le="0.1"} 1',
+            'query_seconds_bucket{template="grab\\"ICM",le="1"} 2',
+            'query_seconds_bucket{template="grab\\"ICM",le="+Inf"} 3',
+            'query_seconds_sum{template="grab\\"ICM"} 5.55',
+            'query_seconds_count{template="grab\\"ICM"} 3',
+            '# HELP in_flight Work in flight.',
+            '# TYPE in_flight gauge',
+            'in_flight 1',
+        ])
+
+class SingleFlightTests(unittest.TestCase):
+    def runConcurrently(self, callers: List[Callable[[], Any]]) -> List[Any]:
+        # Every caller starts while the first one is still inside its flight
+        results = [None] * len(callers)
+        def call(position):
+            try:
+                results[position] = callers[position]()
+            except Exception as e:
+                results[position] = e
+        threads = [threading.Thread(target=call, args=(position,)) for position in range(len(callers))]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = []
+
+    def slowSquare(self, value: int) -> int:
+        self.calls.append(value)
+        self.release.wait()
+        if value < 0:
+            raise ValueError(value)
+        return value * value
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = controller.SingleFlight('test')
+        results = self.runConcurrently([lambda: flight.do('key', self.slowSquare, 3)] * 5)
+        self.assertEqual(results, [9] * 5)
+        self.assertEqual(self.calls, [3])
+        # Nothing is kept once the flight lands
+        self.assertEqual(flight.do('key', lambda: 'again'), 'again')
+
+    def test_every_waiter_gets_the_exception(self):
+        flight = controller.SingleFlight('test')
+        results = self.runConcurrently([lambda: flight.do('key', self.slowSquare, -1)] * 3)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(self.calls, [-1])
+
+    def test_batches_only_claim_keys_not_in_flight(self):
+        flight = controller.SingleFlight('test')
+        batches = []
+        def squares(keys):
+            batches.append(sorted(keys))
+            self.release.wait()
+            return {key: key * key for key in keys}
+        first = lambda: flight.doMany([1, 2, 3], squares)
+        def second():
+            time.sleep(0.05)
+            return flight.doMany([2, 3, 4], squares)
+        results = self.runConcurrently([first, second])
+        self.assertEqual(results, [{1: 1, 2: 4, 3: 9}, {2: 4, 3: 9, 4: 16}])
+        self.assertEqual(sorted(batches), [[1, 2, 3], [4]])
+
+class ResultCacheTests(unittest.TestCase):
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = controller.ResultCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 3, 'misses': 1, 'hit_ratio': 0.75})
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = controller.ResultCache(10, ttlSeconds=0.05)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_invalidate_drops_one_key_or_everything(self):
+        cache = controller.ResultCache(10)
+        for key in 'abc':
+            cache.put(key, key)
+        cache.invalidate('b')
+        self.assertEqual([cache.get(key) for key in 'abc'], ['a', None, 'c'])
+        cache.invalidate()
+        self.assertEqual(cache.stats()['size'], 0)
+
+class IncidentStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'store.sqlite3')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def logTLDR(self, incidentId: int) -> pd.DataFrame:
+        return pd.DataFrame({
+            'IncidentId': [incidentId], 'PredictedOwningTeam': ['CLOUDNET\\SLB'], 'ExceptionCallStack': [['nrp x Y', 'slb manager Slb']],
+            'TIMESTAMP': ['2024-01-02T15:00:00'],
+        })
+
+    def test_put_survives_a_warm_load(self):
+        store = controller.IncidentStore(self.path, 1)
+        self.assertEqual(store.warmLoad(), 0)
+        store.put('101', self.logTLDR(101))
+        store.put(102, self.logTLDR(102))
+        self.assertIsNone(store.get(103))
+
+        reloaded = controller.IncidentStore(self.path, 1)
+        self.assertEqual(reloaded.warmLoad(), 2)
+        for incidentId in [101, 102]:
+            self.assertEqual(reloaded.get(str(incidentId)).to_dict(orient='records'), self.logTLDR(incidentId).to_dict(orient='records'))
+        self.assertEqual(sorted(logTLDR['IncidentId'].iloc[0] for logTLDR in reloaded.allFrames()), [101, 102])
+
+    def test_rows_from_another_schema_version_are_dropped(self):
+        controller.IncidentStore(self.path, 1).put(101, self.logTLDR(101))
+        newer = controller.IncidentStore(self.path, 2)
+        self.assertEqual(newer.warmLoad(), 0)
+        self.assertIsNone(newer.get(101))
+        # They're deleted from the file too, going back to the old version doesn't bring them back
+        self.assertEqual(controller.IncidentStore(self.path, 1).warmLoad(), 0)
+
+    def test_migrations_upgrade_an_older_file_in_place(self):
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            for statement in controller.incidentStoreMigrations[1]:
+                conn.execute(statement)
+            conn.execute('PRAGMA user_version = 1')
+            conn.execute('INSERT INTO incident_results VALUES (?, ?, ?, ?)', (101, 1, '2024-01-02T00:00:00', self.logTLDR(101).to_json(orient='records')))
+
+        store = controller.IncidentStore(self.path, 1)
+        self.assertEqual(store.warmLoad(), 1)
+        self.assertIsNone(store.getWatermark('findIcms'))
+        store.saveWatermark('findIcms', ('2024-01-02T00:00:00', 101))
+        self.assertEqual(store.getWatermark('findIcms'), ('2024-01-02T00:00:00', 101))
+        with closing(sqlite3.connect(self.path)) as conn:
+            self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0], max(controller.incidentStoreMigrations))
+
+class ShowTableTests(unittest.TestCase):
+    def setUp(self):
+        self.client = controller.app.test_client()
+        self.resultDf = pd.DataFrame({'IncidentId': range(100, 125), 'Team': [f'team-{row % 3}' for row in range(25)], 'Rank': [(row * 7) % 25 for row in range(25)]})
+        self.resultId = controller.resultTableStore.put(self.resultDf)
+
+    def renderedRows(self, response) -> pd.DataFrame:
+        # Header cells of the DataFrame.to_html table and its body rows, the row index is each row's <th>
+        self.assertEqual(response.status_code, 200)
+        html = response.get_data(as_text=True)
+        header, body = html.split('<tbody>')
+        columns = re.findall(r'<th>([^<]*)</th>', header.split('<thead>')[1])[1:]
+        rows = [[int(cell) if cell.isdigit() else cell for cell in re.findall(r'<td>([^<]*)</td>', row)] for row in body.split('</tr>')[:-1]]
+        return pd.DataFrame(rows, columns=columns)
+
+    def test_pages_sort_and_select_columns(self):
+        pageDf = self.renderedRows(self.client.get(f'/show_table/{self.resultId}?page=2&page_size=10'))
+        self.assertEqual(pageDf['IncidentId'].tolist(), list(range(110, 120)))
+
+        expected = self.resultDf.sort_values('Rank', ascending=False).iloc[20:25]
+        pageDf = self.renderedRows(self.client.get(f'/show_table/{self.resultId}?page=5&page_size=5&sort=Rank&order=desc&columns=IncidentId,Rank'))
+        self.assertEqual(pageDf.columns.tolist(), ['IncidentId', 'Rank'])
+        self.assertEqual(pageDf['Rank'].tolist(), expected['Rank'].tolist())
+
+    def test_page_links_keep_only_paging_options(self):
+        response = self.client.get(f'/show_table/{self.resultId}?page=2&page_size=10&sort=Rank&result_id=other&refresh=1')
+        html = response.get_data(as_text=True)
+        self.assertEqual(response.status_code, 200)
+        links = re.findall(r'href="([^"]+)"', html)
+        self.assertEqual(len(links), 2)
+        for link in links:
+            self.assertTrue(link.startswith(f'/show_table/{self.resultId}?'))
+            self.assertIn('page_size=10', link)
+            self.assertIn('sort=Rank', link)
+            self.assertNotIn('result_id', link)
+            self.assertNotIn('refresh', link)
+
+    def test_unknown_tables_and_columns_are_rejected(self):
+        self.assertEqual(self.client.get('/show_table/missing').status_code, 404)
+        self.assertEqual(self.client.get(f'/show_table/{self.resultId}?columns=IncidentId,Nope').status_code, 400)
+        self.assertEqual(self.client.get(f'/show_table/{self.resultId}?sort=Nope').status_code, 400)
+
+class FakeHttpResponse:
+    def __init__(self, status_code: int, headers: Dict[str, str] = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = ''
+
+class ExecuteKustoTests(unittest.TestCase):
+    def setUp(self):
+        self.failures = []
+        self.queries = 0
+        self.lock = threading.Lock()
+        self.slowFirstQuery = False
+        self.settings = (controller.kustoBackoffBaseSeconds, controller.kustoRetryBudget, controller.hedgeKustoQueries, controller.kustoLatencies)
+        self.registered = dict(controller.kustoClients.creators)
+        controller.kustoBackoffBaseSeconds = 0.001
+        controller.kustoRetryBudget = controller.RetryBudget(controller.kustoRetryBudgetRatio, controller.kustoRetryBudgetMaxTokens)
+        controller.kustoLatencies = controller.LatencyTracker(controller.kustoLatencyWindow)
+        client = controller.FakeKustoClient(self.respond)
+        controller.kustoClients.register('icm', lambda: client)
+
+    def tearDown(self):
+        for name, (creator, warmUpDatabase) in self.registered.items():
+            controller.kustoClients.register(name, creator, warmUpDatabase)
+        controller.kustoBackoffBaseSeconds, controller.kustoRetryBudget, controller.hedgeKustoQueries, controller.kustoLatencies = self.settings
+
+    def respond(self, database: str, query: str) -> pd.DataFrame:
+        with self.lock:
+            self.queries += 1
+            queryNumber = self.queries
+            failure = self.failures.pop(0) if self.failures else None
+        if failure is not None:
+            raise failure
+        if self.slowFirstQuery and queryNumber == 1:
+            time.sleep(2)
+        return pd.DataFrame({'IncidentId': [queryNumber]})
+
+    def query(self) -> pd.DataFrame:
+        return controller.Helper.queryKusto('icm', 'IcMDataWarehouse', 'test', 'Incidents | take 1')
+
+    # Built the way azure-kusto-data's _handle_http_error raises them
+    def throttled(self, retryAfter: str = None) -> Exception:
+        headers = {'Retry-After': retryAfter} if retryAfter is not None else {}
+        return controller.kustoExceptions.KustoThrottlingError('The request was throttled by the server.', FakeHttpResponse(429, headers))
+
+    def serviceError(self, status: int, text: str) -> Exception:
+        return controller.kustoExceptions.KustoServiceError(text, FakeHttpResponse(status))
+
+    def test_classifies_errors(self):
+        errors = controller.kustoExceptions
+        self.assertEqual(controller.Helper.kustoErrorKind(self.throttled()), 'throttled')
+        self.assertEqual(controller.Helper.kustoErrorKind(self.serviceError(503, 'Service Unavailable')), 'transient')
+        self.assertEqual(controller.Helper.kustoErrorKind(errors.KustoNetworkError('https://nrp.kusto.windows.net')), 'transient')
+        self.assertEqual(controller.Helper.kustoErrorKind(self.serviceError(400, 'Semantic error')), 'permanent')
+        self.assertEqual(controller.Helper.kustoErrorKind(self.serviceError(404, "The requested endpoint 'x' does not exist.")), 'permanent')
+        self.assertEqual(controller.Helper.kustoErrorKind(ValueError('bad')), 'permanent')
+
+    def test_backoff_waits_for_retry_after(self):
+        self.assertGreaterEqual(controller.Helper.kustoBackoffSeconds(self.throttled('7'), 1), 7)
+        self.assertLess(controller.Helper.kustoBackoffSeconds(self.throttled(), 1), 1)
+        self.assertLess(controller.Helper.kustoBackoffSeconds(self.throttled('soon'), 1), 1)
+
+    def test_retries_transient_errors(self):
+        self.failures = [self.serviceError(503, 'Service Unavailable'), self.throttled()]
+        self.assertEqual(self.query()['IncidentId'].tolist(), [3])
+
+    def test_permanent_errors_are_not_retried(self):
+        self.failures = [self.serviceError(400, 'Semantic error')]
+        with self.assertRaises(controller.kustoExceptions.KustoServiceError):
+            self.query()
+        self.assertEqual(self.queries, 1)
+
+    def test_retries_stop_when_the_budget_runs_out(self):
+        controller.kustoRetryBudget = controller.RetryBudget(0, 1)
+        self.failures = [self.throttled() for _ in range(3)]
+        with self.assertRaises(controller.kustoExceptions.KustoThrottlingError):
+            self.query()
+        self.assertEqual(self.queries, 2)
+
+    def test_slow_queries_are_hedged(self):
+        controller.hedgeKustoQueries = True
+        for _ in range(controller.kustoHedgeMinSamples):
+            controller.kustoLatencies.observe('test', 0.01)
+        self.slowFirstQuery = True
+        start = time.perf_counter()
+        self.assertEqual(self.query()['IncidentId'].tolist(), [2])
+        self.assertLess(time.perf_counter() - start, 1)
+
+class PredictOwningTeamsTests(unittest.TestCase):
+    def test_memoized_prediction_matches_uncached_pipeline(self):
+        rng = random.Random(3)
+        stackLines = [
+            r"   at Foo() in d:\bt\1234\repo\src\sources\nrp\frontend\Handler.cs:line 10",
+            r"   at Bar() in d:\bt\1234\repo\src\sources\slb\manager\Slb.cs:line 20",
+            r"   at Baz() in d:\bt\99\repo\src\sources\nrpinternal\nrp\Inner.cs:line 3",
+            r"   at Qux() in d:\bt\7\repo\src\sources\pubsub\x\Y.cs:line 3",
+            r"   at Nope() in d:\bt\7\repo\src\sources\unknownteam\x\Y.cs:line 3",
+            "   noise line",
+        ]
+        distinctDetails = ["\n".join(rng.sample(stackLines, rng.randint(0, 4))) for _ in range(40)]
+        errorLogs = pd.DataFrame({'ErrorDetails': [rng.choice(distinctDetails) for _ in range(500)], 'Row': range(500)}, index=range(1000, 1500))
+
+        exceptions = controller.Exceptions()
+        expected = exceptions.get_predicted_owning_team(exceptions.mapToTeams(exceptions.parseErrorDetails(errorLogs.copy())))
+        controller.stackCache.invalidate()
+        for attempt in range(2):
+            hitsBefore = controller.stackCache.hits
+            actual = exceptions.predictOwningTeams(errorLogs.copy())
+            pd.testing.assert_frame_equal(actual, expected)
+        # The second pass is answered from the cache entirely, one lookup per distinct sequence of frame paths
+        distinctStacks = set(tuple(callStack) for callStack in exceptions.parseErrorDetails(errorLogs.copy())['ExceptionCallStack'])
+        self.assertEqual(controller.stackCache.hits - hitsBefore, len(distinctStacks))
+
+    def test_stacks_from_other_builds_share_a_cache_entry(self):
+        exceptions = controller.Exceptions()
+        controller.stackCache.invalidate()
+        firstBuild = "\n".join([r"   at Foo() in d:\bt\1234\repo\src\sources\slb\manager\Slb.cs:line 20", r"   at Bar() in d:\bt\1234\repo\src\sources\nrp\frontend\Handler.cs:line 10"])
+        laterBuild = "\n".join(["Timeout talking to the frontend", r"   at Foo() in d:\bt\5678\repo\src\sources\slb\manager\Slb.cs:line 27", r"   at Bar() in d:\bt\5678\repo\src\sources\nrp\frontend\Handler.cs:line 12"])
+        first = exceptions.predictOwningTeams(pd.DataFrame({'ErrorDetails': [firstBuild]}))
+        hitsBefore = controller.stackCache.hits
+        later = exceptions.predictOwningTeams(pd.DataFrame({'ErrorDetails': [laterBuild]}))
+        self.assertEqual(controller.stackCache.hits - hitsBefore, 1)
+        self.assertEqual(controller.stackCache.stats()['size'], 1)
+        self.assertEqual(later['PredictedOwningTeam'].tolist(), first['PredictedOwningTeam'].tolist())
+        self.assertEqual(later['ExceptionCallStack'].tolist(), first['ExceptionCallStack'].tolist())
+
+class OwningTeamModelTests(unittest.TestCase):
+    def test_trained_model_round_trips_and_predicts_in_batch(self):
+        examples = [(["nrp frontend Handler"], 'CLOUDNET\\NRP'), (["slb manager Slb", "nrp frontend Handler"], 'CLOUDNET\\SLB'), (["rnm core Rnm"], 'CLOUDNET\\RNM')] * 20
+        model = controller.OwningTeamModel().fit([stack for stack, _ in examples], [team for _, team in examples])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'model.joblib')
+            model.save(path)
+            loaded = controller.OwningTeamModel.load(path)
+
+        callStacks = pd.Series([["rnm core Rnm"], ["nrp frontend Handler"], ["rnm core Rnm"], ["slb manager Slb", "nrp frontend Handler"]])
+        self.assertEqual(loaded.predict(callStacks).tolist(), ['CLOUDNET\\RNM', 'CLOUDNET\\NRP', 'CLOUDNET\\RNM', 'CLOUDNET\\SLB'])
+        self.assertEqual(loaded.predict(pd.Series([], dtype=object)).tolist(), [])
+
+    def test_model_mode_keeps_rows_by_the_model_alone(self):
+        examples = [(["nrp frontend Handler"], 'CLOUDNET\\SLB'), (["unknownteam x Y"], 'CLOUDNET\\RNM'), (["slb manager Slb"], 'CLOUDNET\\SLB')] * 20
+        model = controller.OwningTeamModel().fit([stack for stack, _ in examples], [team for _, team in examples])
+        errorLogs = pd.DataFrame({
+            'TIMESTAMP': pd.to_datetime(['2024-01-02T15:00:00'] * 4),
+            'ErrorDetails': [
+                r"   at Foo() in d:\bt\1\repo\src\sources\unknownteam\x\Y.cs:line 3",
+                r"   at Foo() in d:\bt\1\repo\src\sources\nrp\frontend\Handler.cs:line 3",
+                r"   at Foo() in d:\bt\1\repo\src\sources\slb\manager\Slb.cs:line 3",
+                "no frames",
+            ],
+        })
+        exceptions = controller.Exceptions()
+        previous = (controller.useOwningTeamModel, controller.owningTeamModel)
+        controller.useOwningTeamModel, controller.owningTeamModel = True, model
+        controller.stackCache.invalidate()
+        try:
+            # Assigning onto a filtered view stops working under copy-on-write, so the warning fails the test
+            with warnings.catch_warnings():
+                warnings.simplefilter('error', pd.errors.SettingWithCopyWarning)
+                nrpDf = exceptions.processNrpLogs(errorLogs)
+        finally:
+            controller.useOwningTeamModel, controller.owningTeamModel = previous
+        # The stack no teamMap key matches is kept, the NRP frame goes to the team the model learned, and no keyword matching ran
+        self.assertEqual(nrpDf['PredictedOwningTeam'].tolist(), ['CLOUDNET\\RNM', 'CLOUDNET\\SLB', 'CLOUDNET\\SLB'])
+        self.assertEqual(controller.stackCache.stats()['size'], 0)
+        self.assertFalse(set(controller.teamMatcher.denseColumns) & set(nrpDf.columns))
+        mentions = controller.Helper.predictedTeamMentions(nrpDf)
+        self.assertEqual(mentions.tolist(), nrpDf['PredictedTeamScore'].tolist())
+
+        slbDf = nrpDf[nrpDf['PredictedOwningTeam'] == 'CLOUDNET\\SLB']
+        combinedDf = exceptions.combineNrpLogs(slbDf)
+        self.assertEqual(combinedDf.index.tolist(), [slbDf['PredictedTeamScore'].idxmax()])
+
+class ReduceNrpLogsTests(unittest.TestCase):
+    def randomNrpLogs(self, rng: random.Random, rowCount: int, teamCount: int) -> pd.DataFrame:
+        teams = list(dict.fromkeys(controller.teamMap.values()))[:teamCount]
+        keys = controller.teamMatcher.keys
+        rows = []
+        for _ in range(rowCount):
+            predictedTeam = rng.choice(teams)
+            counts = [rng.randint(1, 3) if controller.teamMap[key] == predictedTeam or (controller.teamMap[key] in teams and rng.random() < 0.3) else 0 for key in keys]
+            row = dict(zip(controller.teamMatcher.denseColumns, counts + [0] * (2 * len(keys))))
+            row.update({'PredictedOwningTeam': predictedTeam, 'Row': len(rows)})
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def test_reducing_in_batches_keeps_the_combined_rows(self):
+        rng = random.Random(7)
+        exceptions = controller.Exceptions()
+        for teamCount in [1, 1, 2, 4]:
+            nrpDf = self.randomNrpLogs(rng, 200, teamCount)
+            keptDf = pd.DataFrame()
+            for start in range(0, len(nrpDf), 17):
+                batchDf = nrpDf.iloc[start:start + 17]
+                keptDf = exceptions.reduceNrpLogs(pd.concat([keptDf, batchDf]) if not keptDf.empty else batchDf)
+            self.assertLessEqual(len(keptDf), 2 * teamCount)
+            self.assertEqual(exceptions.combineNrpLogs(keptDf)['Row'].tolist(), exceptions.combineNrpLogs(nrpDf)['Row'].tolist())
+
+    def test_signature_counts_weight_mentions_once(self):
+        nrpDf = self.randomNrpLogs(random.Random(5), 50, 3)
+        unweighted = controller.Helper.predictedTeamMentions(nrpDf)
+        # Large enough that weighting the int32 counts as well would have wrapped
+        nrpDf['SignatureCount'] = [3_000_000_000 + row for row in range(len(nrpDf))]
+        weighted = controller.Helper.predictedTeamMentions(nrpDf)
+        self.assertEqual(weighted.tolist(), [mentions * count for mentions, count in zip(unweighted.tolist(), nrpDf['SignatureCount'].tolist())])
+
+    def test_compacted_logs_keep_the_combined_rows_and_only_their_categories(self):
+        rng = random.Random(3)
+        exceptions = controller.Exceptions()
+        for teamCount in [1, 2, 4]:
+            nrpDf = self.randomNrpLogs(rng, 300, teamCount)
+            nrpDf['OperationName'] = pd.Series([f'op-{row}' for row in range(len(nrpDf))], dtype='category')
+            compactDf = exceptions.compactNrpLogs(nrpDf)
+            self.assertLessEqual(len(compactDf), 2 * teamCount)
+            self.assertEqual(len(compactDf['OperationName'].cat.categories), len(compactDf))
+            self.assertEqual(exceptions.combineNrpLogs(compactDf)['Row'].tolist(), exceptions.combineNrpLogs(nrpDf)['Row'].tolist())
+
+    def test_batch_combine_matches_per_incident_combine(self):
+        rng = random.Random(11)
+        exceptions = controller.Exceptions()
+        nrpColumns = {column: 'x' for column in ['ErrorDetails', 'StackTrace', 'CorrelationRequestId', 'ErrorCode', 'OperationId', 'OperationName']}
+        icmResults, nrpResults = {}, {}
+        for incidentId in range(500, 530):
+            nrpDf = self.randomNrpLogs(rng, rng.randint(1, 40), rng.choice([1, 1, 2, 4]))
+            nrpResults[incidentId] = nrpDf.assign(SubscriptionId=f'sub-{incidentId % 4}', **nrpColumns)
+            # Every fifth incident's ICM info is for another subscription, so nothing merges
+            icmResults[incidentId] = pd.DataFrame({
+                'SubscriptionId': [f'sub-{incidentId % 4}' if incidentId % 5 else 'sub-other'], 'SupportTicketId': ['st'],
+                'IncidentStartTime': ['2024-01-02T15:00:00'], 'IncidentId': [incidentId], 'IcmLink': [f'link-{incidentId}'],
+            })
+        nrpResults[529] = pd.DataFrame({'status': ['no_data'], 'message': ['no logs']})
+
+        batchLogTLDRs = exceptions.combineNrpIcmBatch(icmResults, nrpResults)
+        self.assertEqual(sorted(batchLogTLDRs), sorted(nrpResults))
+        for incidentId in nrpResults:
+            expected = nrpResults[incidentId] if incidentId == 529 else exceptions.combineNrpIcm(nrpResults[incidentId], icmResults[incidentId])
+            actual = batchLogTLDRs[incidentId]
+            self.assertEqual(actual.columns.tolist(), expected.columns.tolist())
+            self.assertEqual(actual.astype(object).to_dict(orient='records'), expected.astype(object).to_dict(orient='records'))
+
+class FakeKustoClientTests(unittest.TestCase):
+    stack = "\n".join([
+        r"   at Foo() in d:\bt\1234\repo\src\sources\slb\manager\Slb.cs:line 20",
+        r"   at Bar() in d:\bt\1234\repo\src\sources\nrp\frontend\Handler.cs:line 10",
+    ])
+
+    nrpStack = "\n".join([
+        r"   at Foo() in d:\bt\1234\repo\src\sources\nrp\frontend\Handler.cs:line 20",
+        r"   at Bar() in d:\bt\1234\repo\src\sources\nrp\backend\Worker.cs:line 10",
+    ])
+
+    def respond(self, database: str, query: str) -> pd.DataFrame:
+        tail = query.split('};')[-1]
+        if 'grabICMBatch' in tail:
+            return pd.DataFrame({
+                'Summary': ['Problem start time: 1/2/2024 3:04:05 PM UTC<br>'], 'SubscriptionId': ['sub-1'], 'SupportTicketId': ['st'],
+                'IncidentStartTime': [pd.Timestamp('2024-01-02')], 'IncidentId': [101],
+                'teamHistory': [[{'OwningTeamName': 'CLOUDNET\\NRP', 'ModifiedDate': '2024-01-02T00:00:00Z'}]],
+            })
+        if 'logs_of_interest_signatures' in tail:
+            # The first signature has more NRP frames per stack, the second failed far more often
+            return pd.DataFrame({
+                'TIMESTAMP': pd.to_datetime(['2024-01-02T15:00:00', '2024-01-02T15:01:00']), 'ErrorDetails': [self.nrpStack, r"d:\bt\1\repo\src\sources\nrp\x\Y.cs"],
+                'CorrelationRequestId': ['c1', 'c2'], 'SubscriptionId': ['sub-1', 'sub-1'], 'ResourceGroup': ['rg', 'rg'],
+                'StackTrace': ['st', 'st'], 'ErrorCode': ['E', 'E'], 'OperationId': ['op', 'op'], 'OperationName': ['Put', 'Put'],
+                'SignatureCount': [1, 40], 'StackSignature': [111, 222],
+            })
+        if 'logs_of_interest' in tail:
+            return pd.DataFrame({
+                'TIMESTAMP': pd.to_datetime(['2024-01-02T15:00:00', '2024-01-02T15:01:00']), 'ErrorDetails': [self.stack, 'no frames'],
+                'CorrelationRequestId': ['c1', 'c2'], 'SubscriptionId': ['sub-1', 'sub-1'], 'ResourceGroup': ['rg', 'rg'],
+                'StackTrace': ['st', 'st'], 'ErrorCode': ['E', 'E'], 'OperationId': ['op', 'op'], 'OperationName': ['Put', 'Put'],
+            })
+        raise AssertionError(f'Unexpected query against {database}: {tail}')
+
+    def setUp(self):
+        self.factory = controller.kustoClients
+        self.registered = dict(self.factory.creators)
+        self.created = []
+        def createFake():
+            self.created.append(controller.FakeKustoClient(self.respond))
+            return self.created[-1]
+        self.factory.register('icm', createFake)
+        self.factory.register('nrp', createFake)
+        controller.Helper.invalidateCaches()
+
+    def tearDown(self):
+        for name, (creator, warmUpDatabase) in self.registered.items():
+            self.factory.register(name, creator, warmUpDatabase)
+        controller.Helper.invalidateCaches()
+
+    def test_clients_are_created_lazily_and_reused(self):
+        self.assertEqual(self.created, [])
+        self.assertIs(self.factory.get('icm'), self.factory.get('icm'))
+        self.assertEqual(len(self.created), 1)
+
+    def test_warm_up_waits_for_the_cluster_concurrency_limit(self):
+        class AadHelper:
+            def acquire_authorization_header(self):
+                return 'Bearer token'
+        client = controller.FakeKustoClient(self.respond)
+        client._aad_helper = AadHelper()
+        warmUps = []
+        client.execute = lambda database, query: warmUps.append((database, query))
+        factory = controller.KustoClientFactory()
+        factory.register('icm', lambda: client, 'IcMDataWarehouse')
+
+        semaphores = dict(controller.kustoSemaphores)
+        controller.kustoSemaphores['icm'] = threading.BoundedSemaphore(1)
+        try:
+            controller.kustoSemaphores['icm'].acquire()
+            refresh = threading.Thread(target=factory.refreshTokens)
+            refresh.start()
+            refresh.join(0.1)
+            self.assertEqual(warmUps, [])
+            controller.kustoSemaphores['icm'].release()
+            refresh.join(5)
+        finally:
+            controller.kustoSemaphores.update(semaphores)
+        self.assertEqual(warmUps, [('IcMDataWarehouse', 'print WarmUp = 1')])
+
+    def test_run_body_against_fake_client(self):
+        exceptions = controller.Exceptions()
+        icmResult = exceptions.executeIcmBatchQuery([101])
+        result = exceptions.runBody(101, exceptions.icmResultFor(icmResult, 101))
+        self.assertEqual(result['IncidentId'].tolist(), [101])
+        self.assertEqual(result['PredictedOwningTeam'].tolist(), ['CLOUDNET\\SLB'])
+
+    def test_signature_rows_are_weighted_by_count(self):
+        exceptions = controller.Exceptions()
+        controller.aggregateStackSignatures = True
+        try:
+            result = exceptions.runBody(101, exceptions.icmResultFor(exceptions.executeIcmBatchQuery([101]), 101))
+        finally:
+            controller.aggregateStackSignatures = False
+        self.assertEqual(result['ExceptionCallStack'].tolist(), [['nrp x Y']])
+        self.assertEqual(result['SignatureCount'].tolist(), [40])
+        self.assertNotIn('StackSignature', result.columns)
+
+    def test_results_follow_the_template_schema(self):
+        exceptions = controller.Exceptions()
+        nrpResult = exceptions.executeNrpQuery('sub-1', '2024-01-02T15:00:00', 101)
+        self.assertEqual(nrpResult['ErrorDetails'].dtype, 'category')
+        self.assertEqual(nrpResult['SubscriptionId'].dtype, 'category')
+        self.assertEqual(nrpResult['PredictedOwningTeam'].dtype, 'category')
+        self.assertEqual(nrpResult['StackTrace'].dtype, 'string[pyarrow]')
+
+        # Same logTLDR as with the dtypes Kusto hands back
+        converted = exceptions.runBody(101, exceptions.icmResultFor(exceptions.executeIcmBatchQuery([101]), 101))
+        resultSchemas = controller.resultSchemas
+        controller.resultSchemas = {}
+        controller.Helper.invalidateCaches()
+        try:
+            unconverted = exceptions.runBody(101, exceptions.icmResultFor(exceptions.executeIcmBatchQuery([101]), 101))
+        finally:
+            controller.resultSchemas = resultSchemas
+        self.assertEqual(converted.astype(object).to_dict(orient='records'), unconverted.astype(object).to_dict(orient='records'))
+
+class FakeIncidentKusto:
+    # Responder for FakeKustoClient answering what /exceptions asks about incidentIds, each on its own subscription
+    # sub-<IncidentId>. logs_of_interest raises for failingIncidents, and every answer takes a random few milliseconds
+    # so incidents finish out of order
+    stack = FakeKustoClientTests.stack
+
+    def __init__(self, incidentIds: List[int], seed: int = 0):
+        self.incidentIds = list(incidentIds)
+        self.failingIncidents = set()
+        self.failDiscovery = False
+        self.resourceGroup = 'rg'
+        self.emptyIncidents = set()
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # (ModifiedDate, IncidentId) rows findIcmsSince pages through, in keyset order an hour apart
+        now = pd.Timestamp.now(tz='UTC').floor('s')
+        self.modifiedRows = [(now - pd.Timedelta(hours=len(self.incidentIds) - position), incidentId) for position, incidentId in enumerate(self.incidentIds)]
+        self.sinceQueries = []
+
+    def respond(self, database: str, query: str) -> pd.DataFrame:
+        tail = query.split('};')[-1]
+        with self.lock:
+            delay = self.rng.uniform(0, 0.02)
+        time.sleep(delay)
+        if 'grabICMBatch' in tail:
+            incidentIds = [int(incidentId) for incidentId in re.findall(r'\d+', tail.split('dynamic', 1)[1])]
+            return pd.DataFrame({
+                'Summary': 'Problem start time: 1/2/2024 3:04:05 PM UTC<br>', 'SubscriptionId': [f'sub-{incidentId}' for incidentId in incidentIds],
+                'SupportTicketId': 'st', 'IncidentStartTime': pd.Timestamp('2024-01-02'), 'IncidentId': incidentIds,
+                'teamHistory': [[{'OwningTeamName': 'CLOUDNET\\NRP', 'ModifiedDate': '2024-01-02T00:00:00Z'}] for _ in incidentIds],
+            })
+        if 'logs_of_interest' in tail:
+            subscriptionId = re.search(r'"(sub-\d+)"', tail).group(1)
+            if int(subscriptionId[len('sub-'):]) in self.failingIncidents:
+                raise ValueError(f'logs_of_interest failed for {subscriptionId}')
+            if int(subscriptionId[len('sub-'):]) in self.emptyIncidents:
+                return pd.DataFrame({column: pd.Series(dtype=object) for column in ['TIMESTAMP', 'ErrorDetails', 'CorrelationRequestId', 'SubscriptionId', 'ResourceGroup', 'StackTrace', 'ErrorCode', 'OperationId', 'OperationName']})
+            return pd.DataFrame({
+                'TIMESTAMP': pd.to_datetime(['2024-01-02T15:00:00']), 'ErrorDetails': [self.stack], 'CorrelationRequestId': ['c1'],
+                'SubscriptionId': [subscriptionId], 'ResourceGroup': [self.resourceGroup], 'StackTrace': ['st'], 'ErrorCode': ['E'], 'OperationId': ['op'], 'OperationName': ['Put'],
+            })
+        if self.failDiscovery and ('findIcmsSince' in tail or 'Incidents' in tail) and 'grabICMBatch' not in tail:
+            raise ValueError('Incidents discovery failed')
+        if 'findIcmsSince' in tail:
+            watermark, watermarkIncidentId, pageSize = re.search(r'datetime\(([^)]+)\), (\d+), (\d+)\)', tail).groups()
+            watermark = pd.Timestamp(watermark)
+            with self.lock:
+                self.sinceQueries.append((watermark, int(watermarkIncidentId)))
+            rows = [row for row in self.modifiedRows if row > (watermark, int(watermarkIncidentId))][:int(pageSize)]
+            return pd.DataFrame({
+                'SubscriptionId': [f'sub-{incidentId}' for _, incidentId in rows], 'OwningTeamName': 'CLOUDNET\\NRP',
+                'IncidentId': [incidentId for _, incidentId in rows], 'IncidentStartTime': '2024-01-02', 'ModifiedDate': [modifiedDate for modifiedDate, _ in rows],
+            })
+        if 'Incidents' in tail:
+            return pd.DataFrame({
+                'SubscriptionId': [f'sub-{incidentId}' for incidentId in self.incidentIds], 'OwningTeamName': 'CLOUDNET\\NRP',
+                'IncidentId': self.incidentIds, 'IncidentStartTime': '2024-01-02',
+            })
+        raise AssertionError(f'Unexpected query against {database}: {tail}')
+
+class FakeIncidentKustoTestCase(unittest.TestCase):
+    # Points both Kusto clients at a FakeIncidentKusto and the incident store at a throwaway file
+    incidentIds = [101, 102, 103, 104, 105, 106]
+
+    def setUp(self):
+        self.kusto = FakeIncidentKusto(self.incidentIds)
+        self.registered = dict(controller.kustoClients.creators)
+        client = controller.FakeKustoClient(self.kusto.respond)
+        controller.kustoClients.register('icm', lambda: client)
+        controller.kustoClients.register('nrp', lambda: client)
+        self.directory = tempfile.TemporaryDirectory()
+        self.incidentStore = controller.incidentStore
+        controller.incidentStore = controller.IncidentStore(os.path.join(self.directory.name, 'store.sqlite3'), controller.logTLDRSchemaVersion)
+        controller.Helper.invalidateCaches()
+
+    def tearDown(self):
+        for name, (creator, warmUpDatabase) in self.registered.items():
+            controller.kustoClients.register(name, creator, warmUpDatabase)
+        controller.incidentStore = self.incidentStore
+        self.directory.cleanup()
+        controller.Helper.invalidateCaches()
+
+class RunBodiesTests(FakeIncidentKustoTestCase):
+    def test_results_keep_incident_order_and_failures_stay_per_incident(self):
+        self.kusto.failingIncidents = {103}
+        exceptions = controller.Exceptions()
+        for workers in [1, 4]:
+            logTLDRs = exceptions.runBodies(self.incidentIds, workers, refresh=True)
+            for incidentId, logTLDR in zip(self.incidentIds, logTLDRs):
+                if incidentId == 103:
+                    self.assertEqual(logTLDR['status'].tolist(), ['error'])
+                    self.assertIn('sub-103', logTLDR['message'].iloc[0])
+                else:
+                    self.assertEqual(logTLDR['IncidentId'].tolist(), [incidentId])
+
+            streamed = dict(exceptions.iterRunBodies(self.incidentIds, workers, refresh=True))
+            self.assertEqual(sorted(streamed), self.incidentIds)
+            self.assertIn('status', streamed[103].columns)
+
+        allIcmDf = exceptions.collectIncidents(4, refresh=True)
+        self.assertEqual(allIcmDf['IncidentId'].tolist(), [101, 102, 104, 105, 106])
+
+    def test_shared_no_data_results_name_each_incident(self):
+        self.kusto.emptyIncidents = {101}
+        exceptions = controller.Exceptions()
+        hitsBefore = controller.nrpCache.stats()['hits']
+        for incidentId in [101, 202, 101]:
+            nrpResult = exceptions.executeNrpQuery('sub-101', '2024-01-02T15:04:05', incidentId)
+            self.assertEqual(nrpResult['status'].tolist(), ['no_data'])
+            self.assertTrue(nrpResult['message'].iloc[0].endswith(f'for incident: {incidentId}'), nrpResult['message'].iloc[0])
+        self.assertEqual(controller.nrpCache.stats()['hits'] - hitsBefore, 2)
+
+    def test_missing_categorical_values_are_json_null(self):
+        self.kusto.resourceGroup = None
+        with controller.app.test_request_context('/exceptions'):
+            response = controller.Exceptions().get()
+        # Bare NaN isn't JSON, a strict parser refuses it
+        body = json.loads(response.get_data(as_text=True), parse_constant=lambda constant: self.fail(f'{constant} in the response'))
+        self.assertEqual([row['ResourceGroup'] for row in body['allIcm_df']], [None] * len(self.incidentIds))
+
+    def test_requested_workers_are_capped(self):
+        for queryString, workers in [('', controller.maxIncidentWorkers), ('?workers=1', 1), ('?workers=0', 1), ('?workers=10000', controller.maxIncidentWorkers)]:
+            with controller.app.test_request_context(f'/exceptions{queryString}'):
+                self.assertEqual(controller.Helper.requestedWorkers(), workers)
+
+class IncrementalDiscoveryTests(FakeIncidentKustoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pageSize = controller.findIcmsPageSize
+        controller.findIcmsPageSize = 2
+        # 103 and 104 were modified at the same time and 102 matched a second team later on
+        rows = self.kusto.modifiedRows
+        self.kusto.modifiedRows = sorted(rows[:3] + [(rows[2][0], 104), (rows[3][0], 102)] + rows[4:])
+        self.exceptions = controller.Exceptions()
+
+    def tearDown(self):
+        controller.findIcmsPageSize = self.pageSize
+        super().tearDown()
+
+    def keysetPosition(self, row: Any) -> Any:
+        return (controller.Helper.kustoDatetime(row[0]), row[1])
+
+    def test_pages_resume_after_the_last_row_of_the_previous_page(self):
+        incidentIds, watermarks = self.exceptions.executeFindIcmsIncrementalQuery()
+        rows = self.kusto.modifiedRows
+        self.assertEqual(incidentIds, self.incidentIds)
+        # Each incident's watermark is the row before its first one, the last is the final row
+        self.assertEqual(watermarks[1:], [self.keysetPosition(rows[position]) for position in [0, 1, 2, 4, 5, 6]])
+        self.assertEqual([(modifiedDate, incidentId) for modifiedDate, incidentId in self.kusto.sinceQueries[1:]], [rows[1], rows[3], rows[5]])
+
+    def test_watermark_stops_before_the_first_failed_incident(self):
+        self.kusto.failingIncidents = {103}
+        allIcmDf = self.exceptions.collectIncidents(4, incremental=True)
+        self.assertEqual(allIcmDf['IncidentId'].tolist(), [101, 102, 104, 105, 106])
+        self.assertEqual(controller.incidentStore.getWatermark(controller.findIcmsWatermarkName), self.keysetPosition(self.kusto.modifiedRows[1]))
+
+        self.kusto.failingIncidents = set()
+        allIcmDf = self.exceptions.collectIncidents(4, incremental=True)
+        self.assertEqual(sorted(allIcmDf['IncidentId'].tolist()), self.incidentIds)
+        self.assertEqual(controller.incidentStore.getWatermark(controller.findIcmsWatermarkName), self.keysetPosition(self.kusto.modifiedRows[-1]))
+        # Nothing new since, the next run only reads the store
+        self.assertEqual(len(self.exceptions.collectIncidents(4, incremental=True)), len(self.incidentIds))
+
+    def test_result_only_covers_incidents_stored_in_the_lookback_window(self):
+        logTLDR = pd.DataFrame({'IncidentId': [99], 'PredictedOwningTeam': ['CLOUDNET\\NRP']})
+        controller.incidentStore.put(99, logTLDR)
+        with closing(sqlite3.connect(controller.incidentStore.path)) as conn, conn:
+            conn.execute('UPDATE incident_results SET stored_at = ? WHERE incident_id = 99', ('2000-01-01T00:00:00',))
+        controller.incidentStore.warmLoad()
+        allIcmDf = self.exceptions.collectIncidents(4, incremental=True)
+        self.assertEqual(sorted(allIcmDf['IncidentId'].tolist()), self.incidentIds)
+
+class RefreshSchedulerTests(unittest.TestCase):
+    # collectIncidents is swapped for one that records its arguments and holds every job until release is set
+    def setUp(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.collectIncidents = controller.Exceptions.collectIncidents
+        def collectIncidents(exceptions, workers, refresh=False, incremental=False):
+            self.calls.append((refresh, incremental))
+            self.release.wait(5)
+            return pd.DataFrame({'IncidentId': [101, 102], 'Refresh': refresh})
+        controller.Exceptions.collectIncidents = collectIncidents
+        self.scheduler = controller.RefreshScheduler(0)
+        self.refreshScheduler = controller.refreshScheduler
+        controller.refreshScheduler = self.scheduler
+
+    def tearDown(self):
+        self.release.set()
+        controller.Exceptions.collectIncidents = self.collectIncidents
+        controller.refreshScheduler = self.refreshScheduler
+
+    def waitFor(self, jobId: str, state: str) -> Dict[str, Any]:
+        deadline = time.monotonic() + 5
+        while self.scheduler.job(jobId)['state'] != state and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.scheduler.job(jobId)
+
+    def test_refresh_during_a_scheduled_job_is_queued_once(self):
+        scheduled = self.scheduler.trigger('schedule')
+        self.assertEqual(self.scheduler.trigger('schedule')['jobId'], scheduled['jobId'])
+        queued = self.scheduler.trigger('on_demand', refresh=True)
+        self.assertEqual(queued['state'], 'queued')
+        self.assertNotEqual(queued['jobId'], scheduled['jobId'])
+        self.assertEqual(self.scheduler.trigger('on_demand', refresh=True)['jobId'], queued['jobId'])
+
+        self.release.set()
+        self.assertEqual(self.waitFor(scheduled['jobId'], 'succeeded')['incidentRows'], 2)
+        self.assertEqual(self.waitFor(queued['jobId'], 'succeeded')['state'], 'succeeded')
+        self.assertEqual(self.calls, [(False, controller.incrementalDiscovery), (True, False)])
+        self.assertEqual(self.scheduler.latestSnapshot()['jobId'], queued['jobId'])
+
+    def test_refresh_during_a_refresh_returns_the_running_job(self):
+        running = self.scheduler.trigger('on_demand', refresh=True)
+        self.assertEqual(self.scheduler.trigger('on_demand', refresh=True)['jobId'], running['jobId'])
+        self.assertEqual(self.scheduler.trigger('schedule')['jobId'], running['jobId'])
+        self.release.set()
+        self.waitFor(running['jobId'], 'succeeded')
+        self.assertEqual(len(self.calls), 1)
+
+    def test_fetch_serves_the_newest_snapshot(self):
+        with controller.app.test_request_context('/exceptions/fetch'):
+            body, status = controller.ExceptionsFetch().get()
+        self.assertEqual(status, 202)
+        self.assertEqual(body['status'], 'pending')
+
+        self.release.set()
+        self.waitFor(body['job']['jobId'], 'succeeded')
+        with controller.app.test_request_context('/exceptions/fetch'):
+            response = controller.ExceptionsFetch().get()
+        result = response.get_json()
+        self.assertEqual(result['SnapshotJobId'], body['job']['jobId'])
+        self.assertEqual([row['IncidentId'] for row in result['allIcm_df']], [101, 102])
+        self.assertIn('/show_table/', result['TableLink'])
+        self.assertEqual(len(self.calls), 1)
+
+class RefreshDiscoveryFailureTests(FakeIncidentKustoTestCase):
+    def waitFor(self, scheduler: Any, jobId: str) -> Dict[str, Any]:
+        deadline = time.monotonic() + 10
+        while scheduler.job(jobId)['state'] in ('queued', 'running') and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return scheduler.job(jobId)
+
+    def test_failed_discovery_keeps_the_snapshot_and_caches(self):
+        scheduler = controller.RefreshScheduler(0)
+        first = self.waitFor(scheduler, scheduler.trigger('on_demand', refresh=True)['jobId'])
+        self.assertEqual((first['state'], first['incidentRows']), ('succeeded', len(self.incidentIds)))
+        cacheStats = controller.Helper.cacheStats()
+
+        self.kusto.failDiscovery = True
+        second = self.waitFor(scheduler, scheduler.trigger('on_demand', refresh=True)['jobId'])
+        self.assertEqual(second['state'], 'failed')
+        self.assertIn('Incidents discovery failed', second['message'])
+        self.assertEqual(scheduler.latestSnapshot()['jobId'], first['jobId'])
+        self.assertEqual(len(scheduler.latestSnapshot()['frame']), len(self.incidentIds))
+        self.assertEqual(controller.Helper.cacheStats()['icm']['size'], cacheStats['icm']['size'])
+        self.assertEqual(controller.Helper.cacheStats()['nrp']['size'], cacheStats['nrp']['size'])
+
+class NrpWindowTests(unittest.TestCase):
+    incidentTime = '2024-01-02T12:00:00'
+    stacks = [
+        r"   at Foo() in d:\bt\1234\repo\src\sources\slb\manager\Slb.cs:line 20",
+        r"   at Bar() in d:\bt\1234\repo\src\sources\nrp\frontend\Handler.cs:line 10",
+        r"   at Baz() in d:\bt\99\repo\src\sources\rnm\core\Rnm.cs:line 3",
+    ]
+
+    def qosEvents(self) -> pd.DataFrame:
+        rng = random.Random(5)
+        incidentStart = pd.Timestamp(self.incidentTime)
+        # Rows right on the ring edges and on both ends of the two days, plus random ones in between
+        offsets = [pd.Timedelta(hours=hours) for hours in [-24, -8, -3, -1, 0, 1, 3, 8, 24]]
+        offsets += [pd.Timedelta(seconds=rng.randint(-24 * 3600, 24 * 3600)) for _ in range(300)]
+        timestamps = sorted(incidentStart + offset for offset in offsets)
+        return pd.DataFrame({
+            'TIMESTAMP': timestamps, 'ErrorDetails': [rng.choice(self.stacks) for _ in timestamps],
+            'CorrelationRequestId': [f'c{row}' for row in range(len(timestamps))], 'SubscriptionId': 'sub-1', 'ResourceGroup': 'rg',
+            'StackTrace': 'st', 'ErrorCode': 'E', 'OperationId': 'op', 'OperationName': 'Put',
+        })
+
+    def respond(self, database: str, query: str) -> pd.DataFrame:
+        tail = query.split('};')[-1]
+        timestamps = self.events['TIMESTAMP']
+        if 'logs_of_interest_window' in tail:
+            start, end = [pd.Timestamp(literal).tz_localize(None) for literal in re.findall(r'datetime\(([^)]*)\)', tail)]
+            self.windows.append((start, end))
+            if end - start > self.largestWindow:
+                raise controller.kustoExceptions.KustoServiceError('E_QUERY_RESULT_SET_TOO_LARGE: result set too large')
+            return self.events[(timestamps >= start) & (timestamps < end)]
+        if 'logs_of_interest' in tail:
+            incidentStart = pd.Timestamp(self.incidentTime)
+            return self.events[timestamps.between(incidentStart - pd.Timedelta(days=1), incidentStart + pd.Timedelta(days=1))]
+        raise AssertionError(f'Unexpected query against {database}: {tail}')
+
+    def setUp(self):
+        self.events = self.qosEvents()
+        self.windows = []
+        self.largestWindow = pd.Timedelta(days=2)
+        self.registered = dict(controller.kustoClients.creators)
+        self.settings = (controller.splitNrpWindow, controller.nrpTargetRows)
+        client = controller.FakeKustoClient(self.respond)
+        controller.kustoClients.register('nrp', lambda: client)
+        controller.Helper.invalidateCaches()
+
+    def tearDown(self):
+        for name, (creator, warmUpDatabase) in self.registered.items():
+            controller.kustoClients.register(name, creator, warmUpDatabase)
+        controller.splitNrpWindow, controller.nrpTargetRows = self.settings
+        controller.Helper.invalidateCaches()
+
+    def queryNrpLogs(self, splitWindow: bool) -> pd.DataFrame:
+        controller.splitNrpWindow = splitWindow
+        return controller.Exceptions().queryNrpLogs('sub-1', self.incidentTime)
+
+    def test_windows_cover_the_whole_two_days(self):
+        controller.nrpTargetRows = len(self.events) + 1
+        expected = self.queryNrpLogs(False)
+        actual = self.queryNrpLogs(True)
+        self.assertEqual(len(self.windows), 2 * len(controller.nrpWindowEdgesHours))
+        self.assertEqual(actual.astype(object).to_dict(orient='records'), expected.astype(object).to_dict(orient='records'))
+
+    def test_stops_once_the_nearest_rings_have_enough_rows(self):
+        controller.nrpTargetRows = 20
+        actual = self.queryNrpLogs(True)
+        incidentStart = pd.Timestamp(self.incidentTime)
+        nearest = self.events[(self.events['TIMESTAMP'] >= incidentStart - pd.Timedelta(hours=3)) & (self.events['TIMESTAMP'] < incidentStart + pd.Timedelta(hours=3))]
+        self.assertEqual(actual['CorrelationRequestId'].tolist(), nearest['CorrelationRequestId'].tolist())
+
+    def test_windows_too_large_for_kusto_are_halved(self):
+        controller.nrpTargetRows = len(self.events) + 1
+        self.largestWindow = pd.Timedelta(hours=2)
+        expected = self.queryNrpLogs(False)
+        actual = self.queryNrpLogs(True)
+        self.assertEqual(actual.astype(object).to_dict(orient='records'), expected.astype(object).to_dict(orient='records'))
+        self.assertGreater(len(self.windows), 2 * len(controller.nrpWindowEdgesHours))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,23 +1,65 @@
+from __future__ import annotations
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import closing, nullcontext
+import functools
+import hashlib
+import importlib
+import importlib.util
+from itertools import islice
+import os
+import random
 import signal
+import sqlite3
 import sys
-from azure.kusto.data import KustoClient, KustoConnectionStringBuilder, ClientRequestProperties
-from azure.kusto.data.exceptions import KustoServiceError
-from azure.kusto.data.helpers import dataframe_from_result_table
-from azure.kusto.data.response import KustoStreamingResponseDataSet
+import threading
+import time
+import uuid
 from datetime import datetime
 from datetime import timedelta
-from flask import Flask, request, jsonify, render_template_string, url_for, redirect
+from flask import Flask, Response, request, jsonify, render_template_string, stream_with_context, url_for, redirect
 from flask_restful import reqparse, abort, Api, Resource
 from pprint import pprint
 import re
-from typing import Any, Dict, List
-import pandas as pd
-from pandas.core.frame import DataFrame
-from tabulate import tabulate
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Tuple
 import json
-from urllib.parse import quote
 from io import StringIO
 
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    from azure.kusto.data import ClientRequestProperties
+    from azure.kusto.data.response import KustoStreamingResponseDataSet
+
+class LazyModule:
+    # Stands in for a module and imports it on first attribute access. pandas/numpy and azure-kusto-data are most of the
+    # controller's import time and nothing needs them until the first query, see startup-profile.py for the numbers
+    def __init__(self, moduleName: str):
+        self.lazyModuleName = moduleName
+        self.lazyModule = None
+        self.lazyLock = threading.Lock()
+
+    def load(self) -> Any:
+        if self.lazyModule is None:
+            with self.lazyLock:
+                if self.lazyModule is None:
+                    self.lazyModule = importlib.import_module(self.lazyModuleName)
+        return self.lazyModule
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        return f"<LazyModule '{self.lazyModuleName}' ({'loaded' if self.lazyModule is not None else 'not loaded'})>"
+
+if not TYPE_CHECKING:
+    np = LazyModule('numpy')
+    pd = LazyModule('pandas')
+kustoData = LazyModule('azure.kusto.data')
+kustoModels = LazyModule('azure.kusto.data._models')
+kustoExceptions = LazyModule('azure.kusto.data.exceptions')
+kustoHelpers = LazyModule('azure.kusto.data.helpers')
+heavyModules = [np, pd, kustoData, kustoModels, kustoExceptions, kustoHelpers]
 
 app = Flask(__name__)
 api = Api(app)
@@ -39,6 +81,39 @@ let logs_of_interest = (subscription_id: string, resource_group: string, inciden
 };
 """
 
+# logs_of_interest restricted to [window_start, window_end), queryNrpLogWindows covers the same two days with several of these
+queryQosWindow = r"""
+let logs_of_interest_window = (subscription_id: string, resource_group: string, window_start: datetime, window_end: datetime) { 
+    cluster('nrp.kusto.windows.net').database('mdsnrp').QosEtwEvent
+        | where TIMESTAMP >= window_start and TIMESTAMP < window_end
+        | where SubscriptionId == subscription_id
+        //| where ResourceGroup =~ resource_group
+        | where Success == "0"
+        | where UserError == false
+        | sort by TIMESTAMP asc
+        | project TIMESTAMP, ErrorDetails, CorrelationRequestId, SubscriptionId, ResourceGroup, StackTrace, ErrorCode, OperationId, OperationName
+};
+"""
+
+# Same failures as logs_of_interest but grouped on the server by a signature of the stack's source paths (build number and
+# line numbers stripped), returning the earliest row of each signature and how many rows share it
+queryQosSignatures = r"""
+let logs_of_interest_signatures = (subscription_id: string, resource_group: string, incident_time: datetime) { 
+    let incidentStart = datetime_add('day',-1, incident_time);
+    let incidentEnd = datetime_add('day', 1, incident_time);
+    cluster('nrp.kusto.windows.net').database('mdsnrp').QosEtwEvent
+        | where TIMESTAMP between(incidentStart..incidentEnd)
+        | where SubscriptionId == subscription_id
+        //| where ResourceGroup =~ resource_group
+        | where Success == "0"
+        | where UserError == false
+        | extend StackSignature = hash(strcat_array(extract_all(@"bt\\[0-9]+\\repo\\src\\sources\\([a-zA-Z\\]+)", ErrorDetails), "\n"))
+        | summarize SignatureCount = count(), arg_min(TIMESTAMP, ErrorDetails, CorrelationRequestId, SubscriptionId, ResourceGroup, StackTrace, ErrorCode, OperationId, OperationName) by StackSignature
+        | sort by TIMESTAMP asc
+        | project TIMESTAMP, ErrorDetails, CorrelationRequestId, SubscriptionId, ResourceGroup, StackTrace, ErrorCode, OperationId, OperationName, SignatureCount, StackSignature
+};
+"""
+
 # Use when you want only want to see team history, no intermediary hops
 queryTeamHistory = r"""
 let teamHistory = (incident_id: string) {
@@ -79,6 +154,28 @@ let grabICM = (incidentId: int) {
 };
 """
 
+# Use when you want grabICM + teamHistoryAll for many incidents in one round trip, joined on the server
+queryGrabIcmBatch = r"""
+let grabICMBatch = (incidentIds: dynamic) {
+    let incidents = cluster('icmcluster.kusto.windows.net').database('IcMDataWarehouse').Incidents
+        | where IncidentId in (incidentIds);
+    let summaries = incidents
+        | where Status != "ACTIVE"
+        | where not(isempty(Summary))
+        | summarize arg_min(ModifiedDate, Summary, SubscriptionId, SupportTicketId, SourceCreateDate) by IncidentId
+        | extend IncidentStartTime = SourceCreateDate
+        | project Summary, SubscriptionId, SupportTicketId, IncidentStartTime, IncidentId;
+    let teams = incidents
+        | order by IncidentId asc, ModifiedDate asc
+        | extend PreviousTeamName = prev(OwningTeamName), PreviousIncidentId = prev(IncidentId)
+        | where OwningTeamName != PreviousTeamName or isnull(PreviousTeamName) or IncidentId != PreviousIncidentId
+        | summarize teamHistory = make_list(pack('OwningTeamName', OwningTeamName, 'ModifiedDate', ModifiedDate)) by IncidentId;
+    summaries
+        | join kind=inner teams on IncidentId
+        | project-away IncidentId1
+};
+"""
+
 queryFindIcms = r"""cluster('https://icmcluster.kusto.windows.net').database('IcMDataWarehouse').Incidents
     | where SourceCreateDate > ago(30d)
     | where OwningTeamName in (@"CLOUDNET\RNM", @"CLOUDNET\NRP", "NetworkAnalytics", @"CLOUDNET\NetAnalytics", 
@@ -94,6 +191,27 @@ queryFindIcms = r"""cluster('https://icmcluster.kusto.windows.net').database('Ic
     | take 20;
 """
 
+# Use when you only want incidents modified after the stored watermark, paged in (ModifiedDate, IncidentId) order
+queryFindIcmsSince = r"""
+let findIcmsSince = (watermark: datetime, watermarkIncidentId: long, pageSize: long) {
+    cluster('https://icmcluster.kusto.windows.net').database('IcMDataWarehouse').Incidents
+        | where ModifiedDate >= watermark
+        | where OwningTeamName in (@"CLOUDNET\RNM", @"CLOUDNET\NRP", "NetworkAnalytics", @"CLOUDNET\NetAnalytics", 
+        @"CLOUDNET\SLB", @"CLOUDNET\ApplicationGateway", @"CLOUDNET\Gateway Manager", @"CLOUDNET\ExpressRouteSupport",
+        @"CLOUDNET\Azure Bastion", @"CLOUDNET\VirtualWAN", @"CLOUDNET\DDOS", @"CLOUDNET\NRP")
+        | where Status == "RESOLVED"
+        | where IncidentType == "CustomerReported"
+        | where not(isempty(SubscriptionId))
+        | where not(isempty(SourceCreateDate))
+        | parse kind=regex Summary with * @"^.*(?:<b>)?Problem start time:(?:<\/b>)?\s+" IncidentStartTime "<br><br>$"
+        | extend IncidentStartTime=iff(IncidentStartTime == "", tostring(SourceCreateDate), IncidentStartTime)
+        | summarize ModifiedDate = min(ModifiedDate) by SubscriptionId, OwningTeamName, IncidentId, IncidentStartTime
+        | where ModifiedDate > watermark or (ModifiedDate == watermark and IncidentId > watermarkIncidentId)
+        | order by ModifiedDate asc, IncidentId asc
+        | take pageSize
+};
+"""
+
 teamMap = { 
     # teams appear in kusto icm incidents table as CLOUDNET\\<team-name> and in icm portal as Cloudnet/<team-name>
     "rnm": "CLOUDNET\\RNM",
@@ -108,14 +226,845 @@ teamMap = {
     # "frontend" : "CLOUDNET\\temp"  test
 }
 
+# First path under the build's sources folder on a call stack line, e.g. bt\1234\repo\src\sources\nrp\frontend\Handler.cs
+stackFramePattern = re.compile(r"bt\\[0-9]+\\repo\\src\\sources\\([a-zA-Z\\]+)")
+
+class TeamMatcher:
+    # Finds every teamMap key in a call stack line with one compiled regex pass instead of one re.finditer per key
+    def __init__(self, teamMap: Dict[str, str]):
+        self.keys = list(teamMap.keys())
+        self.teams = list(teamMap.values())
+        loweredKeys = [key.lower() for key in self.keys]
+        # Longest keys first so the alternation reports the longest key starting at each position, the lookahead lets hits overlap
+        alternation = '|'.join(re.escape(key) for key in sorted(set(loweredKeys), key=len, reverse=True))
+        self.pattern = re.compile(f'(?=({alternation}))')
+        # Every key that starts where the longest key matched is a prefix of it, in teamMap order
+        self.keysStartingWith = {
+            longest: [keyIdx for keyIdx, key in enumerate(loweredKeys) if longest.startswith(key)]
+            for longest in set(loweredKeys)
+        }
+        self.keyLengths = [len(key) for key in loweredKeys]
+        # Teams as integer codes, several keys can point at the same team
+        self.teamNames = list(dict.fromkeys(self.teams))
+        self.teamCodes = {team: teamCode for teamCode, team in enumerate(self.teamNames)}
+        self.keyTeamCodes = [self.teamCodes[team] for team in self.teams]
+        # mapToTeams adds one int32 column per key for each of these, together they replace a list of dicts per row
+        self.countColumns = [f'TeamMatchCount_{key}' for key in self.keys]
+        self.firstLineColumns = [f'TeamFirstLine_{key}' for key in self.keys]
+        self.firstWordsColumns = [f'TeamFirstWords_{key}' for key in self.keys]
+        self.denseColumns = self.countColumns + self.firstLineColumns + self.firstWordsColumns
+
+    def matchLine(self, line: str) -> Dict[int, List[int]]:
+        # keyIdx -> [match_count, start of the last match], matches of the same key never overlap, same as re.finditer
+        hits = {}
+        for match in self.pattern.finditer(line.lower()):
+            start = match.start()
+            for keyIdx in self.keysStartingWith[match.group(1)]:
+                hit = hits.get(keyIdx)
+                if hit is None:
+                    hits[keyIdx] = [1, start]
+                elif start >= hit[1] + self.keyLengths[keyIdx]:
+                    hit[0] += 1
+                    hit[1] = start
+        return hits
+
+    def matchStacks(self, callStacks: List[List[str]]) -> np.ndarray:
+        # rows x (3 * keys) int32, laid out like denseColumns: match counts over the whole stack, the line of each key's
+        # first hit, and the words before its last match on that line
+        keyCount = len(self.keys)
+        rows = []
+        for cleanedLines in callStacks:
+            row = [0] * (3 * keyCount)
+            for lineIndex, line in enumerate(cleanedLines):
+                for keyIdx, (num_matches, lastStart) in self.matchLine(line).items():
+                    if not row[keyIdx]:
+                        row[keyCount + keyIdx] = lineIndex
+                        row[2 * keyCount + keyIdx] = len(line[:lastStart].split())
+                    row[keyIdx] += num_matches
+            rows.append(row)
+        return np.array(rows, dtype=np.int32).reshape(len(rows), 3 * keyCount)
+
+    def predictKeys(self, dense: np.ndarray) -> np.ndarray:
+        # Per row the key with the most matches, then the earliest first line, then the most words before it, then the
+        # lowest key index, the order get_predicted_owning_team's sort used to pick. -1 for rows without a match
+        keyCount = len(self.keys)
+        counts, firstLines, firstWords = dense[:, :keyCount], dense[:, keyCount:2 * keyCount], dense[:, 2 * keyCount:]
+        candidates = counts == counts.max(axis=1, keepdims=True)
+        candidates &= firstLines == np.where(candidates, firstLines, np.iinfo(np.int32).max).min(axis=1, keepdims=True)
+        candidates &= firstWords == np.where(candidates, firstWords, -1).max(axis=1, keepdims=True)
+        return np.where(counts.any(axis=1), candidates.argmax(axis=1), -1)
+
+    def teamsForKeys(self, keyIdxs: np.ndarray) -> np.ndarray:
+        # The trailing '' is what key -1 picks up
+        teams = np.array(self.teams + [''], dtype=object)
+        return teams[keyIdxs]
+
+    def predictedTeamMentions(self, dense: np.ndarray, predictedTeams: pd.Series) -> np.ndarray:
+        # How many matched keys point at the row's predicted team, several keys can share a team
+        predictedCodes = predictedTeams.astype(object).map(self.teamCodes).fillna(-1).to_numpy(dtype=np.int64)
+        matched = dense[:, :len(self.keys)] > 0
+        return (matched & (np.array(self.keyTeamCodes) == predictedCodes[:, None])).sum(axis=1)
+
+teamMatcher = TeamMatcher(teamMap)
+
 icmCluster = "https://icmcluster.kusto.windows.net"
 nrpCluster = "https://nrp.kusto.windows.net"
 
-icmKustoConnStrBuilder = KustoConnectionStringBuilder.with_az_cli_authentication(icmCluster)
-nrpKustoConnStrBuilder = KustoConnectionStringBuilder.with_az_cli_authentication(nrpCluster)
-# TODO: Shove all these dependencies in a constructor somewhere
-icmClient = KustoClient(icmKustoConnStrBuilder)
-nrpClient = KustoClient(nrpKustoConnStrBuilder)
+# Tokens are re-acquired in the background this often, the az cli token provider only shells out when the cached one is close to expiring
+tokenRefreshIntervalSeconds = 5 * 60
+
+class KustoClientFactory:
+    # Creates each cluster's client on first use instead of at import time and shares it across the worker threads,
+    # KustoClient pools its HTTP connections in one requests.Session so sharing also means reusing connections
+    def __init__(self):
+        self.creators = {}
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    # creator builds the client, anything with KustoClient's execute/execute_streaming_query/close works (see FakeKustoClient)
+    # warmUpDatabase gets a trivial query from the background refresh so the connection is open before the first real one
+    def register(self, name: str, creator: Callable[[], Any], warmUpDatabase: str = None) -> None:
+        with self.lock:
+            self.creators[name] = (creator, warmUpDatabase)
+            previousClient = self.clients.pop(name, None)
+        if previousClient is not None:
+            previousClient.close()
+
+    def get(self, name: str) -> Any:
+        client = self.clients.get(name)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(name)
+                if client is None:
+                    client = self.creators[name][0]()
+                    self.clients[name] = client
+        return client
+
+    def refreshTokens(self) -> None:
+        for name, (_, warmUpDatabase) in list(self.creators.items()):
+            try:
+                client = self.get(name)
+                aadHelper = getattr(client, '_aad_helper', None)
+                if aadHelper is not None:
+                    aadHelper.acquire_authorization_header()
+                    if warmUpDatabase is not None and not getattr(client, 'warmedUp', False):
+                        # Counts against the cluster's concurrency limit like any query executeKusto runs
+                        with kustoSemaphores.get(name) or nullcontext():
+                            client.execute(warmUpDatabase, 'print WarmUp = 1')
+                        client.warmedUp = True
+            except Exception as e:
+                print(f'Background token refresh for {name} failed:', e)
+
+    def startTokenRefresh(self, intervalSeconds: float = tokenRefreshIntervalSeconds) -> None:
+        def refreshLoop():
+            while not self.stopped.is_set():
+                self.refreshTokens()
+                self.stopped.wait(intervalSeconds)
+        threading.Thread(target=refreshLoop, name='kusto-token-refresh', daemon=True).start()
+
+    def close(self) -> None:
+        self.stopped.set()
+        with self.lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            client.close()
+
+class FakeKustoClient:
+    # Local stand-in for KustoClient, responder(database, query) returns the primary result as a DataFrame
+    # latencySeconds is slept before every response to stand in for the round trip to the cluster
+    def __init__(self, responder: Callable[[str, str], pd.DataFrame], latencySeconds: float = 0):
+        self.responder = responder
+        self.latencySeconds = latencySeconds
+
+    @staticmethod
+    def columnType(column: pd.Series) -> str:
+        if pd.api.types.is_datetime64_any_dtype(column):
+            return 'datetime'
+        if pd.api.types.is_bool_dtype(column):
+            return 'bool'
+        if pd.api.types.is_integer_dtype(column):
+            return 'long'
+        if pd.api.types.is_float_dtype(column):
+            return 'real'
+        if any(isinstance(value, (list, dict)) for value in column.head(100)):
+            return 'dynamic'
+        return 'string'
+
+    @staticmethod
+    def rawValue(value: Any) -> Any:
+        if isinstance(value, (list, dict)):
+            return value
+        if pd.isna(value):
+            return None
+        if isinstance(value, datetime):
+            return Helper.kustoDatetime(value)
+        return value.item() if isinstance(value, np.generic) else value
+
+    @staticmethod
+    def tableFromDataFrame(resultDf: pd.DataFrame, streaming: bool = False) -> Any:
+        columns = [{'ColumnName': column, 'ColumnType': FakeKustoClient.columnType(resultDf[column])} for column in resultDf.columns]
+        rows = [[FakeKustoClient.rawValue(value) for value in row] for row in resultDf.itertuples(index=False, name=None)]
+        jsonTable = {'TableName': 'PrimaryResult', 'TableKind': 'PrimaryResult', 'Columns': columns, 'Rows': iter(rows) if streaming else rows}
+        return kustoModels.KustoStreamingResultTable(jsonTable) if streaming else kustoModels.KustoResultTable(jsonTable)
+
+    def execute(self, database: str, query: str, properties: ClientRequestProperties = None) -> Any:
+        time.sleep(self.latencySeconds)
+        return FakeKustoResponse([self.tableFromDataFrame(self.responder(database, query))])
+
+    def execute_streaming_query(self, database: str, query: str, timeout: timedelta = None, properties: ClientRequestProperties = None) -> Any:
+        time.sleep(self.latencySeconds)
+        return FakeKustoResponse([self.tableFromDataFrame(self.responder(database, query), streaming=True)])
+
+    def close(self) -> None:
+        pass
+
+class FakeKustoResponse:
+    def __init__(self, primaryResults: List[Any]):
+        self.primary_results = primaryResults
+
+    def iter_primary_results(self) -> Iterator[Any]:
+        return iter(self.primary_results)
+
+class KustoRecording:
+    # One parquet file per query under directory, named by a hash of database + query text. Columns keep their Kusto type
+    # in the file metadata, dynamic columns (and any column arrow can't type) are stored as JSON text
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    @staticmethod
+    def queryKey(database: str, query: str) -> str:
+        return hashlib.sha256(f'{database}\n{query}'.encode('utf-8')).hexdigest()[:32]
+
+    def path(self, database: str, query: str) -> str:
+        return os.path.join(self.directory, f'{self.queryKey(database, query)}.parquet')
+
+    def save(self, database: str, query: str, table: Any, elapsedSeconds: float) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        columns = [{'ColumnName': column['ColumnName'], 'ColumnType': column['ColumnType']} for column in table.raw_columns]
+        rows = list(table.raw_rows)
+        arrays, jsonColumns = [], []
+        for position, column in enumerate(columns):
+            values = [row[position] for row in rows]
+            try:
+                if column['ColumnType'] == 'dynamic':
+                    raise TypeError('dynamic')
+                arrays.append(pa.array(values))
+            except (TypeError, pa.ArrowException):
+                arrays.append(pa.array([json.dumps(value) for value in values], pa.string()))
+                jsonColumns.append(column['ColumnName'])
+        metadata = {'database': database, 'query': query, 'tableName': table.table_name, 'columns': columns, 'jsonColumns': jsonColumns, 'elapsedSeconds': elapsedSeconds}
+        recorded = pa.Table.from_arrays(arrays, names=[f'c{position}' for position in range(len(columns))], metadata={'kustoRecording': json.dumps(metadata)})
+        os.makedirs(self.directory, exist_ok=True)
+        # Written to the side and renamed so a replay never reads a half written file
+        temporaryPath = f'{self.path(database, query)}.{uuid.uuid4().hex}.tmp'
+        pq.write_table(recorded, temporaryPath, compression='zstd')
+        os.replace(temporaryPath, self.path(database, query))
+
+    def load(self, database: str, query: str) -> Tuple[Dict[str, Any], float]:
+        import pyarrow.parquet as pq
+        path = self.path(database, query)
+        if not os.path.exists(path):
+            raise LookupError(f'No recorded result for query {self.queryKey(database, query)} against {database} in {self.directory}')
+        recorded = pq.read_table(path)
+        metadata = json.loads(recorded.schema.metadata[b'kustoRecording'])
+        columnValues = []
+        for position, column in enumerate(metadata['columns']):
+            values = recorded.column(f'c{position}').to_pylist()
+            columnValues.append([json.loads(value) for value in values] if column['ColumnName'] in metadata['jsonColumns'] else values)
+        jsonTable = {'TableName': metadata['tableName'], 'TableKind': 'PrimaryResult', 'Columns': metadata['columns'], 'Rows': [list(row) for row in zip(*columnValues)]}
+        return jsonTable, metadata['elapsedSeconds']
+
+class RecordingKustoClient:
+    # Passes queries through to client and saves each primary result to the recording, streaming queries are recorded
+    # from a regular execute and handed back as a stream
+    def __init__(self, client: Any, directory: str):
+        self.client = client
+        self.recording = KustoRecording(directory)
+        # Lets KustoClientFactory keep refreshing the wrapped client's token
+        self._aad_helper = getattr(client, '_aad_helper', None)
+
+    def execute(self, database: str, query: str, properties: ClientRequestProperties = None) -> Any:
+        start = time.perf_counter()
+        response = self.client.execute(database, query, properties)
+        self.recording.save(database, query, response.primary_results[0], time.perf_counter() - start)
+        return response
+
+    def execute_streaming_query(self, database: str, query: str, timeout: timedelta = None, properties: ClientRequestProperties = None) -> Any:
+        table = self.execute(database, query, properties).primary_results[0]
+        jsonTable = {'TableName': table.table_name, 'TableKind': 'PrimaryResult', 'Columns': table.raw_columns, 'Rows': iter(table.raw_rows)}
+        return FakeKustoResponse([kustoModels.KustoStreamingResultTable(jsonTable)])
+
+    def close(self) -> None:
+        self.client.close()
+
+class ReplayKustoClient:
+    # Serves results saved by RecordingKustoClient, queries that weren't recorded raise LookupError. Sleeps latencySeconds
+    # per query, or the recorded round trip with useRecordedLatency, and counts both so network time can be told apart
+    def __init__(self, directory: str, latencySeconds: float = 0, useRecordedLatency: bool = False):
+        self.recording = KustoRecording(directory)
+        self.latencySeconds = latencySeconds
+        self.useRecordedLatency = useRecordedLatency
+        self.lock = threading.Lock()
+        self.queryCount = 0
+        self.injectedLatencySeconds = 0.0
+
+    def replay(self, database: str, query: str) -> Dict[str, Any]:
+        jsonTable, elapsedSeconds = self.recording.load(database, query)
+        latencySeconds = elapsedSeconds if self.useRecordedLatency else self.latencySeconds
+        with self.lock:
+            self.queryCount += 1
+            self.injectedLatencySeconds += latencySeconds
+        time.sleep(latencySeconds)
+        return jsonTable
+
+    def execute(self, database: str, query: str, properties: ClientRequestProperties = None) -> Any:
+        return FakeKustoResponse([kustoModels.KustoResultTable(self.replay(database, query))])
+
+    def execute_streaming_query(self, database: str, query: str, timeout: timedelta = None, properties: ClientRequestProperties = None) -> Any:
+        jsonTable = self.replay(database, query)
+        jsonTable['Rows'] = iter(jsonTable['Rows'])
+        return FakeKustoResponse([kustoModels.KustoStreamingResultTable(jsonTable)])
+
+    def close(self) -> None:
+        pass
+
+# Save every Kusto result under kustoRecordDirectory, or answer from kustoReplayDirectory without touching the clusters,
+# replay-profile.py drives both. Read when a client is first created
+kustoRecordDirectory = None
+kustoReplayDirectory = None
+kustoReplayLatencySeconds = 0
+
+def createKustoClient(cluster: str) -> Any:
+    if kustoReplayDirectory:
+        return ReplayKustoClient(kustoReplayDirectory, kustoReplayLatencySeconds)
+    client = kustoData.KustoClient(kustoData.KustoConnectionStringBuilder.with_az_cli_authentication(cluster))
+    return RecordingKustoClient(client, kustoRecordDirectory) if kustoRecordDirectory else client
+
+kustoClients = KustoClientFactory()
+kustoClients.register('icm', lambda: createKustoClient(icmCluster), 'IcMDataWarehouse')
+kustoClients.register('nrp', lambda: createKustoClient(nrpCluster), 'mdsnrp')
+
+# Throttling (429, KustoThrottlingError) and transient failures (5xx, network) are retried up to kustoMaxAttempts times,
+# sleeping a random time up to an exponentially growing cap, or longer when the cluster sends Retry-After
+kustoMaxAttempts = 4
+kustoBackoffBaseSeconds = 0.5
+kustoBackoffMaxSeconds = 10
+# Every query earns kustoRetryBudgetRatio of a retry token and every retry spends one, so when a cluster is struggling
+# retries can't grow past that share of the traffic and pile onto it. Starts at and never exceeds kustoRetryBudgetMaxTokens
+kustoRetryBudgetRatio = 0.2
+kustoRetryBudgetMaxTokens = 20
+# Send a second, identical query when the first has been running longer than the template's recent p95 and use whichever
+# answers first. Needs kustoHedgeMinSamples latencies of the template before it kicks in
+hedgeKustoQueries = False
+kustoHedgeQuantile = 0.95
+kustoHedgeMinSamples = 20
+kustoLatencyWindow = 200
+# Queries in flight per Kusto client at once, retries and hedges included, read at import. Clients not listed aren't limited
+kustoConcurrencyLimits = {'icm': 8, 'nrp': 16}
+
+class RetryBudget:
+    # Token bucket shared by every query, see kustoRetryBudgetRatio
+    def __init__(self, ratio: float, maxTokens: float):
+        self.ratio = ratio
+        self.maxTokens = maxTokens
+        self.tokens = maxTokens
+        self.lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self.lock:
+            self.tokens = min(self.maxTokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class LatencyTracker:
+    # The last windowSize successful query latencies per template, for the hedging delay
+    def __init__(self, windowSize: int):
+        self.windowSize = windowSize
+        self.latencies = {}
+        self.lock = threading.Lock()
+
+    def observe(self, template: str, seconds: float) -> None:
+        with self.lock:
+            self.latencies.setdefault(template, deque(maxlen=self.windowSize)).append(seconds)
+
+    def quantile(self, template: str, quantile: float, minSamples: int) -> float:
+        with self.lock:
+            latencies = sorted(self.latencies.get(template, ()))
+        if len(latencies) < minSamples:
+            return None
+        return latencies[min(len(latencies) - 1, int(quantile * len(latencies)))]
+
+kustoRetryBudget = RetryBudget(kustoRetryBudgetRatio, kustoRetryBudgetMaxTokens)
+kustoLatencies = LatencyTracker(kustoLatencyWindow)
+kustoSemaphores = {name: threading.BoundedSemaphore(limit) for name, limit in kustoConcurrencyLimits.items()}
+# Runs the first attempt of hedged queries and their hedges, threads are only started when hedging is on
+kustoHedgeExecutor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='kusto-hedge')
+
+# Max incident ids sent in one grabICMBatch query, keeps the query text well under Kusto's request size limits
+icmBatchSize = 100
+
+# Stream logs_of_interest results and reduce them in row batches instead of loading the whole window into one frame
+streamNrpResults = False
+nrpStreamingBatchSize = 5000
+
+# Query logs_of_interest_signatures instead, one row per distinct stack with its SignatureCount, so duplicate stacks are
+# neither transferred nor parsed. Mentions are weighted by SignatureCount so picks still reflect how often a stack failed
+aggregateStackSignatures = False
+
+# Query logs_of_interest in sub-windows that widen out from the incident time, nrpWindowConcurrency at a time, and stop once
+# the windows closest to the incident hold nrpTargetRows failures that map to a team. Each entry of nrpWindowEdgesHours
+# is a ring, the window from the previous edge to this one on both sides of the incident, the last edge is the full reach
+splitNrpWindow = False
+nrpWindowEdgesHours = (1, 3, 8, 24)
+nrpWindowConcurrency = 4
+nrpTargetRows = 2000
+# A window Kusto refuses as too big or too slow is halved and retried, down to windows of this length
+nrpMinWindowMinutes = 15
+nrpWindowSplitErrors = ('E_QUERY_RESULT_SET_TOO_LARGE', 'E_RUNAWAY_QUERY', 'exceeded the allowed limits')
+
+# Column dtypes each query template's result is converted to as soon as it arrives. Columns whose values repeat across rows
+# become categoricals, long free text becomes Arrow-backed strings ('text'), anything not listed keeps the dtype Kusto gave it
+useArrowStrings = True
+icmResultSchema = {'SubscriptionId': 'category', 'OwningTeamName': 'category'}
+icmIncidentSchema = {'Summary': 'text', 'SubscriptionId': 'category', 'SupportTicketId': 'text'}
+# The same few stacks fail over and over inside a window, so ErrorDetails is a categorical too, except from
+# logs_of_interest_signatures where every row already is a distinct stack
+nrpResultSchema = {
+    'ErrorDetails': 'category', 'CorrelationRequestId': 'text', 'SubscriptionId': 'category', 'ResourceGroup': 'category',
+    'StackTrace': 'text', 'ErrorCode': 'category', 'OperationId': 'text', 'OperationName': 'category'
+}
+nrpSignatureSchema = {**nrpResultSchema, 'ErrorDetails': 'text'}
+resultSchemas = {
+    'queryFindIcms': icmResultSchema,
+    'findIcmsSince': icmResultSchema,
+    'grabICM': icmIncidentSchema,
+    'grabICMBatch': icmIncidentSchema,
+    'teamHistoryAll': {},
+    'logs_of_interest': nrpResultSchema,
+    'logs_of_interest_window': nrpResultSchema,
+    'logs_of_interest_signatures': nrpSignatureSchema
+}
+
+# NRP columns left out of the logTLDR once it has been combined with the ICM info
+logTLDRDroppedColumns = ['ErrorDetails', 'StackTrace', 'CorrelationRequestId', 'ErrorCode', 'OperationId', 'OperationName', 'SupportTicketId']
+# Only used to pick rows, whichever of them the keyword scoring, the owning team model or the signature query added are dropped too
+nrpScoringColumns = teamMatcher.denseColumns + ['PredictedTeamScore', 'StackSignature']
+
+# Incremental discovery starts this far back the first time, then only asks for incidents past the stored watermark
+findIcmsWatermarkName = 'findIcmsSince'
+findIcmsInitialLookbackDays = 30
+findIcmsPageSize = 200
+findIcmsMaxPages = 50
+# Scheduled refresh jobs use incremental discovery, /exceptions opts in with ?incremental=1
+incrementalDiscovery = True
+
+# Number of incidents processed concurrently by /exceptions, lower it per request with ?workers=<n> (1 runs sequentially)
+maxIncidentWorkers = 8
+
+# Resolved incidents barely change, so their ICM/NRP results are kept in memory until /exceptions/refresh or the TTL runs out.
+# NRP entries only hold the rows combineNrpLogs can pick (compactNrpLogs), a handful per subscription
+cacheMaxEntries = 2048
+cacheTtlSeconds = 12 * 60 * 60
+
+class ResultCache:
+    # Size-bounded LRU with a per-entry TTL, safe to share between the incident worker threads
+    def __init__(self, maxEntries: int, ttlSeconds: float = None):
+        self.maxEntries = maxEntries
+        self.ttlSeconds = ttlSeconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Any) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expiresAt = entry
+                if expiresAt is None or expiresAt > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Any, value: Any) -> None:
+        expiresAt = time.monotonic() + self.ttlSeconds if self.ttlSeconds is not None else None
+        with self.lock:
+            self.entries[key] = (value, expiresAt)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    # Drops one key, or everything when no key is given
+    def invalidate(self, key: Any = None) -> None:
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
+
+# Keyed by IncidentId
+icmCache = ResultCache(cacheMaxEntries, cacheTtlSeconds)
+# Keyed by (SubscriptionId, IncidentStartTime), the inputs of the logs_of_interest window
+nrpCache = ResultCache(cacheMaxEntries, cacheTtlSeconds)
+# Keyed by a 64-bit hash of a stack's frame paths (ExceptionCallStack), holds (dense teamMatcher row, PredictedOwningTeam), or an
+# empty tuple for stacks that map to no team. The mapping only depends on teamMap so entries don't expire and survive refreshes
+stackCacheMaxEntries = 50000
+stackCache = ResultCache(stackCacheMaxEntries)
+
+class SingleFlight:
+    # Concurrent calls with the same key share one computation: the first caller runs it, the rest wait on its Future and
+    # get the same result or exception. Nothing is kept once it finishes, a later call with the key runs again
+    def __init__(self, name: str):
+        self.name = name
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: Any, function: Callable, *args: Any) -> Any:
+        return self.doMany([key], lambda keys: {key: function(*args)})[key]
+
+    def doMany(self, keys: List[Any], function: Callable[[List[Any]], Dict[Any, Any]]) -> Dict[Any, Any]:
+        # function gets the keys nobody else is working on and returns a result for each, the rest are waited on
+        with self.lock:
+            waiting = {key: self.flights[key] for key in keys if key in self.flights}
+            claimed = {key: Future() for key in dict.fromkeys(keys) if key not in waiting}
+            self.flights.update(claimed)
+        if waiting:
+            metrics.increment('logtldr_singleflight_shared_total', len(waiting), flight=self.name)
+
+        results = {}
+        if claimed:
+            try:
+                results = function(list(claimed))
+                for key, future in claimed.items():
+                    future.set_result(results[key])
+            except BaseException as e:
+                for future in claimed.values():
+                    if not future.done():
+                        future.set_exception(e)
+                raise
+            finally:
+                with self.lock:
+                    for key in claimed:
+                        del self.flights[key]
+        return {key: results[key] if key in claimed else waiting[key].result() for key in keys}
+
+# Identical work requested by concurrent /exceptions callers runs once: whole collectIncidents runs and incident
+# discovery per endpoint, ICM and NRP queries per incident and per (SubscriptionId, IncidentStartTime)
+collectFlights = SingleFlight('collectIncidents')
+findIcmsFlights = SingleFlight('findIncidentIds')
+icmFlights = SingleFlight('icm')
+nrpFlights = SingleFlight('nrp')
+
+class Metrics:
+    # Histograms, counters and gauges rendered in the Prometheus text format for /metrics, kept in process so it needs
+    # no client library. Every metric is declared once with its label names, values are keyed by the label values
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.definitions = OrderedDict()
+        self.values = {}
+
+    def declare(self, name: str, kind: str, help: str, labelNames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = None) -> None:
+        self.definitions[name] = {'kind': kind, 'help': help, 'labelNames': labelNames, 'buckets': buckets}
+        self.values[name] = {}
+
+    def labelValues(self, name: str, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels[labelName]) for labelName in self.definitions[name]['labelNames'])
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        buckets = self.definitions[name]['buckets']
+        key = self.labelValues(name, labels)
+        with self.lock:
+            series = self.values[name].get(key)
+            if series is None:
+                series = self.values[name][key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for position, bound in enumerate(buckets):
+                if value <= bound:
+                    series['buckets'][position] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def increment(self, name: str, amount: float = 1, **labels: Any) -> None:
+        key = self.labelValues(name, labels)
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        key = self.labelValues(name, labels)
+        with self.lock:
+            self.values[name][key] = value
+
+    @staticmethod
+    def formatLabels(labelNames: Tuple[str, ...], labelValues: Tuple[str, ...]) -> str:
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labelValues)
+        pairs = [f'{labelName}="{value}"' for labelName, value in zip(labelNames, escaped)]
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, definition in self.definitions.items():
+                lines.append(f"# HELP {name} {definition['help']}")
+                lines.append(f"# TYPE {name} {definition['kind']}")
+                labelNames = definition['labelNames']
+                for labelValues, value in self.values[name].items():
+                    labels = self.formatLabels(labelNames, labelValues)
+                    if definition['kind'] != 'histogram':
+                        lines.append(f'{name}{labels} {value}')
+                        continue
+                    # Prometheus buckets are cumulative, each le counts every observation at or below it
+                    cumulative = 0
+                    for bound, count in zip(definition['buckets'], value['buckets']):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{self.formatLabels(labelNames + ("le",), labelValues + (str(bound),))} {cumulative}')
+                    lines.append(f'{name}_bucket{self.formatLabels(labelNames + ("le",), labelValues + ("+Inf",))} {value["count"]}')
+                    lines.append(f'{name}_sum{labels} {value["sum"]}')
+                    lines.append(f'{name}_count{labels} {value["count"]}')
+        return '\n'.join(lines) + '\n'
+
+latencyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+rowBuckets = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+byteBuckets = (1024, 16384, 131072, 1048576, 8388608, 67108864, 536870912)
+
+metrics = Metrics()
+metrics.declare('logtldr_kusto_query_seconds', 'histogram', 'Kusto query latency by query template.', ('template',), latencyBuckets)
+metrics.declare('logtldr_kusto_query_rows', 'histogram', 'Rows returned per Kusto query by query template.', ('template',), rowBuckets)
+metrics.declare('logtldr_kusto_query_bytes', 'histogram', 'In-memory size of each Kusto query result by query template.', ('template',), byteBuckets)
+metrics.declare('logtldr_kusto_query_errors_total', 'counter', 'Kusto queries that raised, by query template.', ('template',))
+metrics.declare('logtldr_stage_seconds', 'histogram', 'Time spent in each processing stage.', ('stage',), latencyBuckets)
+metrics.declare('logtldr_incidents_in_flight', 'gauge', 'Incidents runBody is working on right now.')
+metrics.set('logtldr_incidents_in_flight', 0)
+metrics.declare('logtldr_incidents_total', 'counter', 'Incidents processed by runBody, by outcome.', ('outcome',))
+metrics.declare('logtldr_cache_hits_total', 'counter', 'Cache lookups that found an entry.', ('cache',))
+metrics.declare('logtldr_cache_misses_total', 'counter', 'Cache lookups that found nothing.', ('cache',))
+metrics.declare('logtldr_cache_hit_ratio', 'gauge', 'Share of cache lookups that found an entry.', ('cache',))
+metrics.declare('logtldr_cache_entries', 'gauge', 'Entries currently held in the cache.', ('cache',))
+metrics.declare('logtldr_kusto_retries_total', 'counter', 'Kusto queries retried after a throttling or transient error, by query template.', ('template', 'reason'))
+metrics.declare('logtldr_kusto_hedges_total', 'counter', 'Second requests sent for Kusto queries slower than their p95, by query template.', ('template',))
+metrics.declare('logtldr_singleflight_shared_total', 'counter', 'Calls answered by joining identical work already in flight.', ('flight',))
+
+def timedStage(stage: str) -> Callable:
+    # Records how long the decorated method takes in logtldr_stage_seconds, exceptions included
+    def decorate(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                metrics.observe('logtldr_stage_seconds', time.perf_counter() - start, stage=stage)
+        return timed
+    return decorate
+
+# Per-incident logTLDR frames are persisted here so a restart doesn't mean a cold re-query of ICM and NRP
+incidentStorePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'incidentStore.sqlite3')
+# Bump when the columns runBody produces change, rows stored under another version are dropped at warm load
+logTLDRSchemaVersion = 1
+# Each entry upgrades the sqlite layout from the previous version, PRAGMA user_version tracks which ones have run
+incidentStoreMigrations = {
+    1: [
+        """CREATE TABLE incident_results (
+            incident_id INTEGER PRIMARY KEY,
+            schema_version INTEGER NOT NULL,
+            stored_at TEXT NOT NULL,
+            payload TEXT NOT NULL
+        )"""
+    ],
+    2: [
+        """CREATE TABLE watermarks (
+            name TEXT PRIMARY KEY,
+            modified_date TEXT NOT NULL,
+            incident_id INTEGER NOT NULL
+        )"""
+    ]
+}
+
+class IncidentStore:
+    # Write-through sqlite store of runBody results, with every stored frame also held in memory after warmLoad
+    def __init__(self, path: str, schemaVersion: int):
+        self.path = path
+        self.schemaVersion = schemaVersion
+        self.frames = {}
+        self.storedAt = {}
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def migrate(self, conn: sqlite3.Connection) -> None:
+        currentVersion = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version in sorted(incidentStoreMigrations):
+            if version > currentVersion:
+                for statement in incidentStoreMigrations[version]:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {version}')
+
+    def warmLoad(self) -> int:
+        with self.lock, closing(self.connect()) as conn, conn:
+            self.migrate(conn)
+            conn.execute('DELETE FROM incident_results WHERE schema_version != ?', (self.schemaVersion,))
+            rows = conn.execute('SELECT incident_id, stored_at, payload FROM incident_results').fetchall()
+        frames = {incidentId: pd.read_json(StringIO(payload), orient='records', convert_dates=False, dtype=False) for incidentId, _, payload in rows}
+        with self.lock:
+            self.frames.update(frames)
+            self.storedAt.update({incidentId: storedAt for incidentId, storedAt, _ in rows})
+        return len(frames)
+
+    def get(self, incidentId: str) -> pd.DataFrame:
+        with self.lock:
+            logTLDR = self.frames.get(int(incidentId))
+        return logTLDR.copy() if logTLDR is not None else None
+
+    def put(self, incidentId: str, logTLDR: pd.DataFrame) -> None:
+        payload = logTLDR.to_json(orient='records', date_format='iso')
+        storedAt = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+        with self.lock, closing(self.connect()) as conn, conn:
+            self.migrate(conn)
+            conn.execute('INSERT OR REPLACE INTO incident_results VALUES (?, ?, ?, ?)', (int(incidentId), self.schemaVersion, storedAt, payload))
+            self.frames[int(incidentId)] = logTLDR
+            self.storedAt[int(incidentId)] = storedAt
+
+    # storedSince ("%Y-%m-%dT%H:%M:%S", UTC) leaves out frames last stored before it
+    def allFrames(self, storedSince: str = None) -> List[pd.DataFrame]:
+        with self.lock:
+            return [logTLDR.copy() for incidentId, logTLDR in self.frames.items() if storedSince is None or self.storedAt[incidentId] >= storedSince]
+
+    # High-water mark of an incremental query, (ModifiedDate, IncidentId) of the last row it has handed out
+    def getWatermark(self, name: str) -> Tuple[str, int]:
+        with self.lock, closing(self.connect()) as conn, conn:
+            self.migrate(conn)
+            row = conn.execute('SELECT modified_date, incident_id FROM watermarks WHERE name = ?', (name,)).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def saveWatermark(self, name: str, watermark: Tuple[str, int]) -> None:
+        with self.lock, closing(self.connect()) as conn, conn:
+            self.migrate(conn)
+            conn.execute('INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)', (name, watermark[0], int(watermark[1])))
+
+incidentStore = IncidentStore(incidentStorePath, logTLDRSchemaVersion)
+
+# Finished /exceptions results are kept server-side and linked by id from TableLink, the newest resultTableMaxEntries survive
+resultTableMaxEntries = 32
+showTablePageSize = 50
+showTableMaxPageSize = 1000
+showTablePageArgs = ['page_size', 'columns', 'sort', 'order']
+
+class ResultTableStore:
+    def __init__(self, maxEntries: int):
+        self.maxEntries = maxEntries
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, resultDf: pd.DataFrame) -> str:
+        resultId = uuid.uuid4().hex[:12]
+        with self.lock:
+            # Row order per (column, ascending) is computed on first use and reused for every later page
+            self.tables[resultId] = {'frame': resultDf.reset_index(drop=True), 'sortOrders': {}}
+            while len(self.tables) > self.maxEntries:
+                self.tables.popitem(last=False)
+        return resultId
+
+    def get(self, resultId: str) -> pd.DataFrame:
+        with self.lock:
+            entry = self.tables.get(resultId)
+        return entry['frame'] if entry is not None else None
+
+    def page(self, resultId: str, start: int, pageSize: int, sortBy: str = None, ascending: bool = True) -> pd.DataFrame:
+        with self.lock:
+            entry = self.tables[resultId]
+        resultDf = entry['frame']
+        if not sortBy:
+            return resultDf.iloc[start:start + pageSize]
+
+        sortOrder = entry['sortOrders'].get((sortBy, ascending))
+        if sortOrder is None:
+            try:
+                sortedColumn = resultDf[sortBy].sort_values(ascending=ascending, kind='stable')
+            except TypeError:
+                # Columns holding lists or dicts (ExceptionCallStack, teamHistory) sort by their text
+                sortedColumn = resultDf[sortBy].astype(str).sort_values(ascending=ascending, kind='stable')
+            sortOrder = sortedColumn.index.to_numpy()
+            entry['sortOrders'][(sortBy, ascending)] = sortOrder
+        return resultDf.iloc[sortOrder[start:start + pageSize]]
+
+resultTableStore = ResultTableStore(resultTableMaxEntries)
+
+# Predict PredictedOwningTeam with the classifier trained by owning-team-model.py instead of the keyword scoring,
+# falls back to the keyword scoring when the artifact at owningTeamModelPath doesn't exist
+useOwningTeamModel = False
+owningTeamModelPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'owningTeamModel.joblib')
+# Bump when the features change, artifacts saved under another version are refused at load
+owningTeamModelVersion = 1
+
+class OwningTeamModel:
+    # Hashed words and word pairs of the cleaned frame paths into a linear classifier. Hashing needs no vocabulary pass,
+    # so training is a single fit and the artifact is only the classifier's weights
+    featureCount = 2 ** 18
+
+    def __init__(self, classifier: Any = None):
+        self.classifier = classifier
+        from sklearn.feature_extraction.text import HashingVectorizer
+        self.vectorizer = HashingVectorizer(n_features=self.featureCount, ngram_range=(1, 2), token_pattern=r'\S+', alternate_sign=False)
+
+    @staticmethod
+    def stackText(callStack: List[str]) -> str:
+        return ' '.join(callStack)
+
+    def fit(self, callStacks: List[List[str]], teams: List[str]) -> OwningTeamModel:
+        from sklearn.linear_model import SGDClassifier
+        self.classifier = SGDClassifier(loss='log_loss', alpha=1e-5, max_iter=50, tol=1e-4, random_state=0)
+        self.classifier.fit(self.vectorizer.transform([self.stackText(callStack) for callStack in callStacks]), teams)
+        return self
+
+    def predict(self, callStacks: pd.Series) -> np.ndarray:
+        return self.predictWithScores(callStacks)[0]
+
+    def predictWithScores(self, callStacks: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+        # The team for every stack and the classifier's probability for it. Distinct stacks are hashed and scored once,
+        # all of them in one sparse matrix product
+        codes, uniqueTexts = pd.factorize(pd.Series([self.stackText(callStack) for callStack in callStacks], dtype=object))
+        if not len(uniqueTexts):
+            return np.array([], dtype=object), np.array([], dtype=np.float64)
+        probabilities = self.classifier.predict_proba(self.vectorizer.transform(uniqueTexts))
+        best = probabilities.argmax(axis=1)
+        return self.classifier.classes_[best][codes], probabilities[np.arange(len(best)), best][codes]
+
+    def save(self, path: str) -> None:
+        import joblib
+        joblib.dump({'version': owningTeamModelVersion, 'classifier': self.classifier}, path)
+
+    @staticmethod
+    def load(path: str) -> OwningTeamModel:
+        import joblib
+        artifact = joblib.load(path)
+        if artifact.get('version') != owningTeamModelVersion:
+            raise ValueError(f"{path} is owning team model version {artifact.get('version')}, expected {owningTeamModelVersion}")
+        return OwningTeamModel(artifact['classifier'])
+
+owningTeamModel = None
+owningTeamModelFailed = False
+owningTeamModelLock = threading.Lock()
 
 class Helper:
     @staticmethod
@@ -131,44 +1080,325 @@ class Helper:
         outputDatetimeStr = datetimeObj.strftime("%Y-%m-%dT%H:%M:%S")
         return outputDatetimeStr
 
+    # Kusto datetime literal with the full 100ns precision, so a watermark compares equal to the row it came from
+    @staticmethod
+    def kustoDatetime(inputDatetime: datetime) -> str:
+        timestamp = pd.Timestamp(inputDatetime)
+        return f"{timestamp:%Y-%m-%dT%H:%M:%S}.{timestamp.microsecond:06d}{timestamp.nanosecond // 100}Z"
+
+    # Errors are usually transient (throttling, auth, network) so they are never cached, no_data answers are
+    @staticmethod
+    def isErrorFrame(resultDf: pd.DataFrame) -> bool:
+        return 'error' in resultDf.columns or ('status' in resultDf.columns and (resultDf['status'] == 'error').any())
+
+    # How many of a row's matched teamMap keys point at its own PredictedOwningTeam
+    @staticmethod
+    def predictedTeamMentions(nrpDf: pd.DataFrame) -> pd.Series:
+        # Rows the owning team model predicted carry its probability instead of keyword counts
+        if 'PredictedTeamScore' in nrpDf.columns:
+            mentions = nrpDf['PredictedTeamScore'].copy()
+        else:
+            mentions = teamMatcher.predictedTeamMentions(nrpDf[teamMatcher.countColumns].to_numpy(), nrpDf['PredictedOwningTeam'])
+            mentions = pd.Series(mentions, index=nrpDf.index)
+        # Rows from logs_of_interest_signatures stand for SignatureCount identical failures, this is the only place they're weighted
+        if 'SignatureCount' in nrpDf.columns:
+            mentions = mentions * nrpDf['SignatureCount'].to_numpy(dtype=np.int64)
+        return mentions
+
+    @staticmethod
+    def owningTeamModel() -> OwningTeamModel:
+        # Loaded on first use, None when there's no usable artifact so callers keep the keyword scoring
+        global owningTeamModel, owningTeamModelFailed
+        with owningTeamModelLock:
+            if owningTeamModel is None and not owningTeamModelFailed:
+                try:
+                    owningTeamModel = OwningTeamModel.load(owningTeamModelPath)
+                except Exception as e:
+                    owningTeamModelFailed = True
+                    print(f'Unable to load owning team model {owningTeamModelPath}, using keyword scoring:', e)
+            return owningTeamModel
+
+    @staticmethod
+    def kustoErrorKind(error: Exception) -> str:
+        # 'throttled' and 'transient' are worth retrying, anything else ('permanent') would fail the same way again
+        if isinstance(error, kustoExceptions.KustoThrottlingError):
+            return 'throttled'
+        if isinstance(error, (kustoExceptions.KustoNetworkError, ConnectionError, TimeoutError)):
+            return 'transient'
+        httpResponse = Helper.kustoHttpResponse(error)
+        status = getattr(httpResponse, 'status_code', getattr(httpResponse, 'status', None))
+        if status is not None and 500 <= status < 600:
+            return 'transient'
+        return 'permanent'
+
+    @staticmethod
+    def kustoHttpResponse(error: Exception) -> Any:
+        # The client raises KustoThrottlingError("...", response) on a 429, that class keeps the response only in its args
+        if isinstance(error, kustoExceptions.KustoServiceError):
+            return error.http_response
+        if isinstance(error, kustoExceptions.KustoThrottlingError) and len(error.args) > 1:
+            return error.args[1]
+        return None
+
+    @staticmethod
+    def kustoBackoffSeconds(error: Exception, attempt: int) -> float:
+        # Full jitter, never sooner than the cluster's Retry-After
+        delay = random.uniform(0, min(kustoBackoffMaxSeconds, kustoBackoffBaseSeconds * 2 ** (attempt - 1)))
+        headers = getattr(Helper.kustoHttpResponse(error), 'headers', None) or {}
+        try:
+            return max(delay, float(headers.get('Retry-After', 0)))
+        except ValueError:
+            return delay
+
+    @staticmethod
+    def attemptKusto(clientName: str, template: str, execute: Callable[[Any], Any]) -> Any:
+        with kustoSemaphores.get(clientName) or nullcontext():
+            start = time.perf_counter()
+            response = execute(kustoClients.get(clientName))
+        kustoLatencies.observe(template, time.perf_counter() - start)
+        return response
+
+    @staticmethod
+    def hedgedAttemptKusto(clientName: str, template: str, execute: Callable[[Any], Any]) -> Any:
+        hedgeDelay = kustoLatencies.quantile(template, kustoHedgeQuantile, kustoHedgeMinSamples)
+        if hedgeDelay is None:
+            return Helper.attemptKusto(clientName, template, execute)
+        first = kustoHedgeExecutor.submit(Helper.attemptKusto, clientName, template, execute)
+        if wait([first], timeout=hedgeDelay).done:
+            return first.result()
+        metrics.increment('logtldr_kusto_hedges_total', template=template)
+        # The slower of the two is left to finish on its own, its answer is dropped
+        pending = {first, kustoHedgeExecutor.submit(Helper.attemptKusto, clientName, template, execute)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+        return first.result()
+
+    @staticmethod
+    def executeKusto(clientName: str, template: str, execute: Callable[[Any], Any], hedge: bool = True) -> Any:
+        # Every Kusto call goes through here: execute(client) under the client's concurrency limit, hedged when enabled,
+        # and retried with backoff on throttling and transient errors while attempts and the retry budget last
+        kustoRetryBudget.deposit()
+        attempt = 1
+        while True:
+            try:
+                if hedge and hedgeKustoQueries:
+                    return Helper.hedgedAttemptKusto(clientName, template, execute)
+                return Helper.attemptKusto(clientName, template, execute)
+            except Exception as e:
+                errorKind = Helper.kustoErrorKind(e)
+                if errorKind == 'permanent' or attempt >= kustoMaxAttempts or not kustoRetryBudget.withdraw():
+                    raise
+                metrics.increment('logtldr_kusto_retries_total', template=template, reason=errorKind)
+                time.sleep(Helper.kustoBackoffSeconds(e, attempt))
+                attempt += 1
+
+    @staticmethod
+    def queryKusto(clientName: str, database: str, template: str, query: str) -> pd.DataFrame:
+        # Every regular query runs through here so its latency, row count and size show up in /metrics under template
+        start = time.perf_counter()
+        try:
+            response = Helper.executeKusto(clientName, template, lambda client: client.execute(database, query))
+        except Exception:
+            metrics.increment('logtldr_kusto_query_errors_total', template=template)
+            raise
+        finally:
+            metrics.observe('logtldr_kusto_query_seconds', time.perf_counter() - start, template=template)
+        resultDf = Helper.applySchema(kustoHelpers.dataframe_from_result_table(response.primary_results[0]), template)
+        metrics.observe('logtldr_kusto_query_rows', len(resultDf), template=template)
+        metrics.observe('logtldr_kusto_query_bytes', Helper.frameBytes(resultDf), template=template)
+        return resultDf
+
+    @staticmethod
+    def applySchema(resultDf: pd.DataFrame, template: str) -> pd.DataFrame:
+        # Converts the columns resultSchemas lists for template, text stays object dtype when pyarrow isn't installed
+        arrowStrings = useArrowStrings and importlib.util.find_spec('pyarrow') is not None
+        dtypes = {}
+        for column, kind in resultSchemas.get(template, {}).items():
+            if column not in resultDf.columns:
+                continue
+            if kind == 'text':
+                if arrowStrings:
+                    dtypes[column] = 'string[pyarrow]'
+            else:
+                dtypes[column] = kind
+        return resultDf.astype(dtypes) if dtypes else resultDf
+
+    @staticmethod
+    def jsonRecords(resultDf: pd.DataFrame) -> List[Dict[str, Any]]:
+        # Missing values in categorical and float columns come out of to_dict as NaN, which isn't valid JSON, so they become null
+        return resultDf.astype(object).where(resultDf.notna(), None).to_dict(orient='records')
+
+    @staticmethod
+    def frameBytes(resultDf: pd.DataFrame) -> int:
+        return int(resultDf.memory_usage(index=False, deep=True).sum())
+
+    # ?workers=<n> can lower the incident concurrency of a request but never raise it past maxIncidentWorkers
+    @staticmethod
+    def requestedWorkers() -> int:
+        return min(max(request.args.get('workers', default=maxIncidentWorkers, type=int), 1), maxIncidentWorkers)
+
+    @staticmethod
+    def cacheStats() -> Dict[str, Dict[str, Any]]:
+        return {'icm': icmCache.stats(), 'nrp': nrpCache.stats(), 'stack': stackCache.stats()}
+
+    @staticmethod
+    def invalidateCaches() -> None:
+        icmCache.invalidate()
+        nrpCache.invalidate()
+
 class Exceptions(Resource):
     ####### ICM -- find incidents that match our criteria #######
     def executeFindIcmsQuery(self) -> pd.DataFrame:
         try:
-            response = icmClient.execute("IcMDataWarehouse", queryFindIcms)
-            resultDf = dataframe_from_result_table(response.primary_results[0])
+            resultDf = Helper.queryKusto('icm', "IcMDataWarehouse", 'queryFindIcms', queryFindIcms)
             print('after icm query find icms')
             if not resultDf.empty:
                 incidentIds = list(resultDf['IncidentId'].tolist())
                 return incidentIds
             else:
                 return pd.DataFrame({'status': ['no_data'], 'message': [f'No ErrorDetails found in Incidents table']})
-        except KustoServiceError as e:
+        except kustoExceptions.KustoServiceError as e:
             return pd.DataFrame({'status': ['error'], 'message': [str(e)]})
         except Exception as e:
             return pd.DataFrame({'status': ['error'], 'message': [str(e)]})
 
+    ####### ICM -- find incidents modified since the last run #######
+    def executeFindIcmsIncrementalQuery(self) -> Tuple[Any, List[Tuple[str, int]]]:
+        # Also returns the watermark just before the first row of each incident, and after the last row at the end, so the
+        # caller can stop short of an incident it failed to process
+        watermark = incidentStore.getWatermark(findIcmsWatermarkName)
+        if watermark is None:
+            watermark = (Helper.kustoDatetime(datetime.utcnow() - timedelta(days=findIcmsInitialLookbackDays)), 0)
+        incidentIds = []
+        seenIds = set()
+        watermarks = []
+        try:
+            # Keyset paging on (ModifiedDate, IncidentId) instead of take 20, each page starts right after the last row of the previous one
+            for _ in range(findIcmsMaxPages):
+                queryStr = f"{queryFindIcmsSince}findIcmsSince(datetime({watermark[0]}), {watermark[1]}, {findIcmsPageSize})"
+                pageDf = Helper.queryKusto('icm', "IcMDataWarehouse", 'findIcmsSince', queryStr)
+                if pageDf.empty:
+                    break
+                for incidentId, modifiedDate in zip(pageDf['IncidentId'].tolist(), pageDf['ModifiedDate'].tolist()):
+                    # An incident shows up once per owning team it matched with
+                    if incidentId not in seenIds:
+                        seenIds.add(incidentId)
+                        incidentIds.append(incidentId)
+                        watermarks.append(watermark)
+                    watermark = (Helper.kustoDatetime(modifiedDate), int(incidentId))
+                if len(pageDf) < findIcmsPageSize:
+                    break
+            print(f'after icm query find icms since watermark, {len(incidentIds)} new')
+            return incidentIds, watermarks + [watermark]
+        except kustoExceptions.KustoServiceError as e:
+            return pd.DataFrame({'status': ['error'], 'message': [str(e)]}), None
+        except Exception as e:
+            return pd.DataFrame({'status': ['error'], 'message': [str(e)]}), None
+
+    def findIncidentIds(self, incremental: bool = False) -> Tuple[Any, List[Tuple[str, int]]]:
+        # A status/message error frame instead of the list when the discovery query failed
+        icmIdList, watermarks = findIcmsFlights.do(incremental, self.queryIncidentIds, incremental)
+        return (icmIdList.copy() if isinstance(icmIdList, pd.DataFrame) else list(icmIdList)), watermarks
+
+    def queryIncidentIds(self, incremental: bool = False) -> Tuple[Any, List[Tuple[str, int]]]:
+        if incremental:
+            icmIdList, watermarks = self.executeFindIcmsIncrementalQuery()
+        else:
+            icmIdList, watermarks = self.executeFindIcmsQuery(), None
+        if isinstance(icmIdList, pd.DataFrame):
+            print('Finding incidents failed in', icmIdList['message'].iloc[0])
+            # Errors are passed on so callers can tell a failed discovery from one that found nothing
+            return (icmIdList, None) if Helper.isErrorFrame(icmIdList) else ([], None)
+        return icmIdList, watermarks
+
     ####### ICM -- grab info for specific incident #######
     def executeIcmQuery(self, incidentId: str) -> pd.DataFrame:
+        cached = icmCache.get(int(incidentId))
+        if cached is not None:
+            return cached.copy()
+
+        resultDf = icmFlights.do(int(incidentId), self.queryIcm, incidentId)
+        if not Helper.isErrorFrame(resultDf):
+            icmCache.put(int(incidentId), resultDf)
+        return resultDf.copy()
+
+    def queryIcm(self, incidentId: str) -> pd.DataFrame:
         queryStrIncident = f"{queryGrabIcm}grabICM({incidentId})"
         queryStrTeams = f"{queryTeamHistoryAll}teamHistoryAll({incidentId})"
         try:
-            responseIncident = icmClient.execute("IcMDataWarehouse", queryStrIncident)
-            resultIncident = dataframe_from_result_table(responseIncident.primary_results[0])
+            resultIncident = Helper.queryKusto('icm', "IcMDataWarehouse", 'grabICM', queryStrIncident)
             
-            responseTeams = icmClient.execute("IcMDataWarehouse", queryStrTeams)
-            resultTeams = dataframe_from_result_table(responseTeams.primary_results[0])
+            resultTeams = Helper.queryKusto('icm', "IcMDataWarehouse", 'teamHistoryAll', queryStrTeams)
             print('in executeIcmQuery')
             if not resultIncident.empty and not resultTeams.empty:
                 combined_result = pd.merge(resultIncident, resultTeams, on='IncidentId', how='left', suffixes=('', 'TeamHistory'))
                 return self.parseSummary(combined_result)
             else:
                 return pd.DataFrame({'status': ['no_data'], 'message': [f'executeIcmQuery: Unable to combine ICM with team history on incident: {incidentId}']})
-        except KustoServiceError as e:
+        except kustoExceptions.KustoServiceError as e:
             return pd.DataFrame({'error': [str(e)]})
         except Exception as e:
             return pd.DataFrame({'error': [str(e)]})
+
+    ####### ICM -- grab info for all incidents in one go #######
+    def executeIcmBatchQuery(self, incidentIds: List[str]) -> pd.DataFrame:
+        # Only incidents missing from icmCache go to Kusto
+        cachedDfs = []
+        missingIds = []
+        for incidentId in incidentIds:
+            cached = icmCache.get(int(incidentId))
+            if cached is None:
+                missingIds.append(incidentId)
+            else:
+                cachedDfs.append(cached)
+
+        if missingIds:
+            for incidentKey, icmResult in icmFlights.doMany([int(incidentId) for incidentId in missingIds], self.queryIcmBatch).items():
+                if Helper.isErrorFrame(icmResult):
+                    message = icmResult['message'].iloc[0] if 'message' in icmResult.columns else icmResult['error'].iloc[0]
+                    return pd.DataFrame({'status': ['error'], 'message': [message]})
+                if 'status' not in icmResult.columns:
+                    icmCache.put(incidentKey, icmResult)
+                    cachedDfs.append(icmResult)
+
+        if not cachedDfs:
+            return pd.DataFrame({'status': ['no_data'], 'message': ['executeIcmBatchQuery: Unable to combine ICM with team history for any incident']})
+        return pd.concat(cachedDfs, ignore_index=True)
+
+    def queryIcmBatch(self, incidentKeys: List[int]) -> Dict[int, pd.DataFrame]:
+        # Parsed ICM rows per incident, no_data for incidents Kusto has nothing on, and the same error frame for all if a query fails
+        batchDfs = []
+        try:
+            for start in range(0, len(incidentKeys), icmBatchSize):
+                idList = ', '.join(str(incidentKey) for incidentKey in incidentKeys[start:start + icmBatchSize])
+                queryStr = f"{queryGrabIcmBatch}grabICMBatch(dynamic([{idList}]))"
+                batchDfs.append(Helper.queryKusto('icm', "IcMDataWarehouse", 'grabICMBatch', queryStr))
+            print('in executeIcmBatchQuery')
+            icmResults = {}
+            fetchedDfs = [batchDf for batchDf in batchDfs if not batchDf.empty]
+            if fetchedDfs:
+                fetchedDf = self.parseSummary(pd.concat(fetchedDfs, ignore_index=True))
+                for incidentId, icmResult in fetchedDf.groupby('IncidentId', sort=False):
+                    icmResults[int(incidentId)] = icmResult.reset_index(drop=True)
+        except kustoExceptions.KustoServiceError as e:
+            return dict.fromkeys(incidentKeys, pd.DataFrame({'status': ['error'], 'message': [str(e)]}))
+        except Exception as e:
+            return dict.fromkeys(incidentKeys, pd.DataFrame({'status': ['error'], 'message': [str(e)]}))
+        noData = pd.DataFrame({'status': ['no_data'], 'message': ['executeIcmBatchQuery: Unable to combine ICM with team history on incident']})
+        return {incidentKey: icmResults.get(incidentKey, noData) for incidentKey in incidentKeys}
+
+    def icmResultFor(self, icmBatchDf: pd.DataFrame, incidentId: str) -> pd.DataFrame:
+        if 'status' in icmBatchDf.columns:
+            return icmBatchDf
+        icmResult = icmBatchDf[icmBatchDf['IncidentId'] == int(incidentId)].reset_index(drop=True)
+        if icmResult.empty:
+            return pd.DataFrame({'status': ['no_data'], 'message': [f'executeIcmBatchQuery: Unable to combine ICM with team history on incident: {incidentId}']})
+        return icmResult
     
+    @timedStage('parseSummary')
     def parseSummary(self, resultDf: pd.DataFrame) -> pd.DataFrame:
         resourceUriPattern = rf'/subscriptions/{resultDf["SubscriptionId"].iat[0]}/resource[Gg]roups/([0-9a-zA-Z-_]+)/providers/Microsoft\.Network/([0-9a-zA-Z-_]+)/([0-9a-zA-Z-_]+)'
         datetimePattern = r'(\d{1,2}/\d{1,2}/\d{4}\s\d{1,2}:\d{2}:\d{2}\s[AP]M\sUTC)'
@@ -176,7 +1406,7 @@ class Exceptions(Resource):
         def extract_match(pattern, text, group_index, default='not_found'):
             match = re.search(pattern, text)
             return match.group(group_index) if match else default
-        resultDf['IncidentStartTime'] = resultDf['Summary'].apply(lambda x: Helper.formattedDatetime(extract_match(datetimePattern, x, 1, resultDf['IncidentStartTime'].iloc[0])))
+        resultDf['IncidentStartTime'] = resultDf.apply(lambda row: Helper.formattedDatetime(extract_match(datetimePattern, row['Summary'], 1, row['IncidentStartTime'])), axis=1)
         resultDf['IcmLink'] = resultDf.apply(lambda row: f"https://portal.microsofticm.com/imp/v5/incidents/details/{row['IncidentId']}/summary", axis=1)
         # resultDf['ResourceGroup'] = resultDf['Summary'].apply(lambda x: extract_match(resourceUriPattern, x, 1, 'not_Found'))
         # resultDf['Provider'] = resultDf['Summary'].apply(lambda x: extract_match(resourceUriPattern, x, 2))
@@ -187,84 +1417,250 @@ class Exceptions(Resource):
     
     ####### NRP #######
     def executeNrpQuery(self, subscriptionId: str, incidentTime: str, incidentId:int, resourceGroup: str = 'temp') -> pd.DataFrame:
-        queryStr = f"{queryQos}logs_of_interest(\"{subscriptionId}\", \"{resourceGroup}\", datetime(\"{incidentTime}\"))"
+        cacheKey = (subscriptionId, incidentTime)
+        cached = nrpCache.get(cacheKey)
+        if cached is not None:
+            return self.nrpResultForIncident(cached, incidentId)
+
+        resultDf = nrpFlights.do(cacheKey, self.queryNrpLogs, subscriptionId, incidentTime, resourceGroup)
+        if 'status' not in resultDf.columns:
+            resultDf = self.compactNrpLogs(resultDf)
+        if not Helper.isErrorFrame(resultDf):
+            nrpCache.put(cacheKey, resultDf)
+        return self.nrpResultForIncident(resultDf, incidentId)
+
+    def nrpResultForIncident(self, resultDf: pd.DataFrame, incidentId: int) -> pd.DataFrame:
+        # Cached and shared results are keyed by subscription and time, every incident asking for one gets its own id in the no_data message
+        resultDf = resultDf.copy()
+        if 'status' in resultDf.columns and (resultDf['status'] == 'no_data').all():
+            resultDf['message'] = resultDf['message'] + f' for incident: {incidentId}'
+        return resultDf
+
+    def compactNrpLogs(self, nrpDf: pd.DataFrame) -> pd.DataFrame:
+        # Only the rows combineNrpLogs can pick are kept, and the categories of the dropped rows with them, so a cached
+        # subscription costs a few rows instead of every failure in its window
+        nrpDf = self.reduceNrpLogs(nrpDf).copy()
+        for column in nrpDf.select_dtypes('category').columns:
+            nrpDf[column] = nrpDf[column].cat.remove_unused_categories()
+        return nrpDf
+
+    def queryNrpLogs(self, subscriptionId: str, incidentTime: str, resourceGroup: str = 'temp') -> pd.DataFrame:
+        template = 'logs_of_interest_signatures' if aggregateStackSignatures else 'logs_of_interest'
+        if aggregateStackSignatures:
+            queryStr = f"{queryQosSignatures}logs_of_interest_signatures(\"{subscriptionId}\", \"{resourceGroup}\", datetime(\"{incidentTime}\"))"
+        else:
+            queryStr = f"{queryQos}logs_of_interest(\"{subscriptionId}\", \"{resourceGroup}\", datetime(\"{incidentTime}\"))"
         try:
-            response = nrpClient.execute("mdsnrp", queryStr)
-            resultDf = dataframe_from_result_table(response.primary_results[0])
-            if not resultDf.empty:
-                resultDf = self.parseErrorDetails(resultDf)
-                resultDf = self.mapToTeams(resultDf)
-                resultDf = self.get_predicted_owning_team(resultDf)
-                resultDf['TIMESTAMP'] = resultDf['TIMESTAMP'].apply(Helper.formattedDatetime)
-                
+            if splitNrpWindow and not aggregateStackSignatures:
+                rowCount, resultDf = self.queryNrpLogWindows(subscriptionId, incidentTime, resourceGroup)
+            elif streamNrpResults:
+                rowCount, resultDf = self.streamNrpLogs(queryStr, template)
+            else:
+                resultDf = Helper.queryKusto('nrp', "mdsnrp", template, queryStr)
+                rowCount = len(resultDf)
+                if rowCount:
+                    resultDf = self.processNrpLogs(resultDf)
+
+            if rowCount:
                 # Need if check if its empty now after removing rows in previous functions
                 if resultDf.empty:
-                    return pd.DataFrame({'status': ['no_data'], 'message': [f'executeNrpQuery/others: Unable to match ErrorDetails to a team for incident: {incidentId}']})
+                    return pd.DataFrame({'status': ['no_data'], 'message': ['executeNrpQuery/others: Unable to match ErrorDetails to a team']})
                 return resultDf
             else:
-                return pd.DataFrame({'status': ['no_data'], 'message': [f'executeNrpQuery: No ErrorDetails found in NRP table for incident: {incidentId}']})
-        except KustoServiceError as e:
+                return pd.DataFrame({'status': ['no_data'], 'message': ['executeNrpQuery: No ErrorDetails found in NRP table']})
+        except kustoExceptions.KustoServiceError as e:
             return pd.DataFrame({'status': ['error'], 'message': [str(e)]})
         except Exception as e:
             return pd.DataFrame({'status': ['error'], 'message': [str(e)]})
 
+    def nrpWindowRings(self, incidentTime: str) -> List[List[Tuple[pd.Timestamp, pd.Timestamp]]]:
+        # [start, end) windows grouped by ring, closest to the incident first, earlier side before later side
+        incidentStart = pd.Timestamp(incidentTime)
+        edges = [pd.Timedelta(0)] + [pd.Timedelta(hours=hours) for hours in nrpWindowEdgesHours]
+        rings = []
+        for inner, outer in zip(edges, edges[1:]):
+            # logs_of_interest's between() includes its end, one 100ns tick past it keeps the last window the same
+            end = incidentStart + outer + (pd.Timedelta(100, 'ns') if outer == edges[-1] else pd.Timedelta(0))
+            rings.append([(incidentStart - outer, incidentStart - inner), (incidentStart + inner, end)])
+        return rings
+
+    def queryNrpLogWindow(self, subscriptionId: str, resourceGroup: str, window: Tuple[pd.Timestamp, pd.Timestamp]) -> pd.DataFrame:
+        start, end = window
+        queryStr = f"{queryQosWindow}logs_of_interest_window(\"{subscriptionId}\", \"{resourceGroup}\", datetime({Helper.kustoDatetime(start)}), datetime({Helper.kustoDatetime(end)}))"
+        try:
+            return Helper.queryKusto('nrp', "mdsnrp", 'logs_of_interest_window', queryStr)
+        except kustoExceptions.KustoServiceError as e:
+            if end - start <= pd.Timedelta(minutes=nrpMinWindowMinutes) or not any(marker in str(e) for marker in nrpWindowSplitErrors):
+                raise
+            middle = start + (end - start) / 2
+            halves = [self.queryNrpLogWindow(subscriptionId, resourceGroup, half) for half in [(start, middle), (middle, end)]]
+            return pd.concat(halves, ignore_index=True)
+
+    def queryNrpLogWindows(self, subscriptionId: str, incidentTime: str, resourceGroup: str = 'temp') -> Tuple[int, pd.DataFrame]:
+        # Windows are queried closest first with up to nrpWindowConcurrency in flight and consumed ring by ring, so the rows
+        # used are always those of the nearest rings whatever order Kusto answers in, windows past the stopping ring are cancelled
+        rings = self.nrpWindowRings(incidentTime)
+        executor = ThreadPoolExecutor(max_workers=nrpWindowConcurrency)
+        try:
+            futures = [[executor.submit(self.queryNrpLogWindow, subscriptionId, resourceGroup, window) for window in ring] for ring in rings]
+            rowCount = 0
+            keptRows = 0
+            windowDfs = {}
+            for ring, ringFutures in zip(rings, futures):
+                for window, future in zip(ring, ringFutures):
+                    windowDf = future.result()
+                    rowCount += len(windowDf)
+                    if not windowDf.empty:
+                        windowDfs[window] = self.processNrpLogs(windowDf)
+                        keptRows += len(windowDfs[window])
+                if keptRows >= nrpTargetRows:
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        if not windowDfs:
+            return rowCount, pd.DataFrame()
+        # Windows don't overlap, in start order their rows are in the TIMESTAMP order logs_of_interest sorts by
+        resultDf = Helper.applySchema(pd.concat([windowDfs[window] for window in sorted(windowDfs)], ignore_index=True), 'logs_of_interest_window')
+        resultDf['PredictedOwningTeam'] = resultDf['PredictedOwningTeam'].astype('category')
+        return rowCount, resultDf
+
+    def streamNrpLogs(self, queryStr: str, template: str = 'logs_of_interest') -> Tuple[int, pd.DataFrame]:
+        # Rows are parsed and mapped batch by batch as Kusto streams them in, and after every batch only the rows
+        # combineNrpLogs could still pick are kept, so memory stays flat however many failures the window has
+        start = time.perf_counter()
+        try:
+            # Only the request that opens the stream is retried, rows already handed out can't be taken back. Not hedged either,
+            # the stream is read long after the first table arrives
+            response: KustoStreamingResponseDataSet = Helper.executeKusto('nrp', template, lambda client: client.execute_streaming_query("mdsnrp", queryStr), hedge=False)
+            table = next(response.iter_primary_results())
+        except Exception:
+            metrics.increment('logtldr_kusto_query_errors_total', template=template)
+            raise
+        finally:
+            # Time to the first table, the rest of the stream overlaps with processing
+            metrics.observe('logtldr_kusto_query_seconds', time.perf_counter() - start, template=template)
+        rowCount = 0
+        byteCount = 0
+        keptDf = pd.DataFrame()
+        while True:
+            rows = list(islice(table.raw_rows, nrpStreamingBatchSize))
+            if not rows:
+                break
+            batchTable = kustoModels.KustoResultTable({'TableName': table.table_name, 'Columns': table.raw_columns, 'Rows': rows})
+            batchDf = Helper.applySchema(kustoHelpers.dataframe_from_result_table(batchTable), template)
+            # Keep row positions unique across batches so first/most-mentions ties resolve exactly as in one big frame
+            batchDf.index = pd.RangeIndex(rowCount, rowCount + len(batchDf))
+            rowCount += len(batchDf)
+            byteCount += Helper.frameBytes(batchDf)
+            batchDf = self.processNrpLogs(batchDf)
+            keptDf = self.reduceNrpLogs(pd.concat([keptDf, batchDf]) if not keptDf.empty else batchDf)
+        metrics.observe('logtldr_kusto_query_rows', rowCount, template=template)
+        metrics.observe('logtldr_kusto_query_bytes', byteCount, template=template)
+        # Batches each bring their own categories, concat falls back to object wherever they differ
+        return rowCount, Helper.applySchema(keptDf, template)
+
+    @timedStage('processNrpLogs')
+    def processNrpLogs(self, resultDf: pd.DataFrame) -> pd.DataFrame:
+        model = Helper.owningTeamModel() if useOwningTeamModel else None
+        if model is not None:
+            resultDf = self.predictOwningTeamsWithModel(resultDf, model)
+        else:
+            resultDf = self.predictOwningTeams(resultDf)
+        resultDf['TIMESTAMP'] = resultDf['TIMESTAMP'].apply(Helper.formattedDatetime)
+        resultDf['PredictedOwningTeam'] = resultDf['PredictedOwningTeam'].astype('category')
+        return resultDf
+
+    @timedStage('predictOwningTeams')
+    def predictOwningTeams(self, errorLogs: pd.DataFrame) -> pd.DataFrame:
+        # Same rows and columns as parseErrorDetails -> mapToTeams -> get_predicted_owning_team. The team matching is cached on a
+        # hash of the parsed frame paths, so the same stack from another build, line or incident is a stackCache hit. The key
+        # needs the parse though: every distinct ErrorDetails in the frame is still parsed once before its lookup, only the
+        # matching and prediction are skipped
+        detailKeys = pd.util.hash_pandas_object(errorLogs['ErrorDetails'], index=False).to_numpy()
+        _, firstPositions, inverse = np.unique(detailKeys, return_index=True, return_inverse=True)
+        parsedDf = self.parseErrorDetails(pd.DataFrame({'ErrorDetails': errorLogs['ErrorDetails'].to_numpy()[firstPositions]}))
+        callStacks = dict(zip(parsedDf.index, parsedDf['ExceptionCallStack']))
+        stackKeys = dict(zip(parsedDf.index, pd.util.hash_pandas_object(parsedDf['ExceptionCallStack'].str.join('\n'), index=False).tolist()))
+
+        # Per distinct stack key: (dense teamMatcher row, PredictedOwningTeam), or an empty tuple for stacks that map to no team
+        predictions = {key: stackCache.get(key) for key in dict.fromkeys(stackKeys.values())}
+        missing = {key: position for position, key in reversed(stackKeys.items()) if predictions[key] is None}
+        if missing:
+            missingDf = pd.DataFrame({'ExceptionCallStack': [callStacks[position] for position in missing.values()]}, index=list(missing))
+            missingDf = self.get_predicted_owning_team(self.mapToTeams(missingDf))
+            predicted = dict(zip(missingDf.index, zip(missingDf[teamMatcher.denseColumns].to_numpy(), missingDf['PredictedOwningTeam'])))
+            for key in missing:
+                # Stacks with no team are cached too, so they're dropped without matching next time
+                predictions[key] = predicted.get(key, ())
+                stackCache.put(key, predictions[key])
+
+        # Distinct ErrorDetails with no frames or no team are left out
+        results = [predictions[stackKeys[position]] if position in stackKeys else () for position in range(len(firstPositions))]
+        keep = np.array([bool(result) for result in results], dtype=bool)[inverse]
+        keptPositions = inverse[keep]
+        uniqueDense = np.zeros((len(results), len(teamMatcher.denseColumns)), dtype=np.int32)
+        for position, result in enumerate(results):
+            if result:
+                uniqueDense[position] = result[0]
+        errorLogs = errorLogs[keep].copy()
+        errorLogs['ExceptionCallStack'] = [callStacks[position] for position in keptPositions]
+        errorLogs = pd.concat([errorLogs, pd.DataFrame(uniqueDense[keptPositions], index=errorLogs.index, columns=teamMatcher.denseColumns)], axis=1)
+        errorLogs['PredictedOwningTeam'] = np.array([result[1] if result else '' for result in results], dtype=object)[keptPositions]
+        return errorLogs
+
+    def reduceNrpLogs(self, nrpDf: pd.DataFrame) -> pd.DataFrame:
+        # The first row of each PredictedOwningTeam and the row with the most mentions of it are the only ones combineNrpLogs can return
+        if nrpDf.empty:
+            return nrpDf
+        mentions = Helper.predictedTeamMentions(nrpDf)
+        firstRows = ~nrpDf['PredictedOwningTeam'].duplicated()
+        mostMentionsRows = nrpDf.index.isin(mentions.groupby(nrpDf['PredictedOwningTeam'], sort=False, observed=True).idxmax())
+        return nrpDf[firstRows.to_numpy() | mostMentionsRows]
+
+    @timedStage('parseErrorDetails')
     def parseErrorDetails(self, errorLogs: pd.DataFrame) -> pd.DataFrame:
-        def cleanLines(lines: List[str]) -> List[str]:
-            cleanedLines = []
-            for line in lines:
-                match = re.search(r"bt\\[0-9]+\\repo\\src\\sources\\([a-zA-Z\\]+)", line)
-                if match:
-                    path = match.group(1)
-                    cleanedPath = re.sub(r'[0-9]+', '', path).replace('\\', ' ')
-                    cleanedLines.append(cleanedPath)
-            return cleanedLines
-        
+        # Explode every ErrorDetails into one row per line so the frame regex runs vectorized over all lines at once,
+        # str.extract keeps only the first frame on each line like the old per-line re.search did
+        lines = errorLogs['ErrorDetails'].reset_index(drop=True).str.split('\n').explode()
+        paths = lines.str.extract(stackFramePattern, expand=False).dropna()
+        cleanedLines = paths.str.replace('\\', ' ', regex=False)
+
+        # Stitch the surviving lines back onto their rows, explode keeps each row's lines contiguous and in order
+        positions = cleanedLines.index.to_numpy()
+        rowStarts = np.flatnonzero(np.diff(positions, prepend=-1))
+        stacks = [chunk.tolist() for chunk in np.split(cleanedLines.to_numpy(), rowStarts[1:])] if len(positions) else []
+        callStacks = pd.Series(stacks, index=positions[rowStarts], dtype=object).reindex(range(len(errorLogs)))
+
         # Remove any rows where there are no values in ExceptionCallStack
-        errorLogs['ExceptionCallStack'] = errorLogs['ErrorDetails'].str.split('\n').apply(cleanLines)
-        errorLogs = errorLogs[errorLogs['ExceptionCallStack'].map(len) > 0]
+        errorLogs['ExceptionCallStack'] = callStacks.to_numpy()
+        errorLogs = errorLogs[callStacks.notna().to_numpy()]
         return errorLogs
 
-    def mapToTeams(self, errorLogs: pd.DataFrame) -> pd.DataFrame:        
-        def mapLineToTeam(cleanedLines: List[str]) -> List[Dict[str, Any]]:
-            teamCounts = {}
-            for lineIndex, line in enumerate(cleanedLines):
-                for key, team in teamMap.items():
-                    matches = list(re.finditer(key.lower(), line.lower()))
-                    num_matches = len(matches)
-                    if matches:
-                        last_match = matches[-1]
-                        before_key = line[:last_match.start()]
-                        words_before_key = len(before_key.split())
-
-                        if key in teamCounts:
-                            teamCounts[key]['match_count'] += num_matches
-                            if lineIndex <= teamCounts[key]['exception_method_idx'][0]:
-                                teamCounts[key]['exception_method_idx'] = [lineIndex, words_before_key]
-                        else:
-                            teamCounts[key] = teamCounts[key] = {
-                                'team_key': key,
-                                'team_value': team,
-                                'match_count': num_matches,
-                                'exception_method_idx' : [lineIndex, words_before_key]
-                            }
-            return list(teamCounts.values())
-        
+    @timedStage('mapToTeams')
+    def mapToTeams(self, errorLogs: pd.DataFrame) -> pd.DataFrame:
         # Remove any rows where its not able to map the log to a team
-        errorLogs['MappedTeams'] = errorLogs['ExceptionCallStack'].apply(mapLineToTeam)
-        errorLogs = errorLogs[errorLogs['MappedTeams'].map(len) > 0]
+        dense = teamMatcher.matchStacks(errorLogs['ExceptionCallStack'])
+        matched = dense[:, :len(teamMatcher.keys)].any(axis=1)
+        errorLogs = errorLogs[matched]
+        errorLogs = pd.concat([errorLogs, pd.DataFrame(dense[matched], index=errorLogs.index, columns=teamMatcher.denseColumns)], axis=1)
         return errorLogs
 
-    def get_predicted_owning_team(self, errorLogs: pd.DataFrame) -> pd.DataFrame:
-        def sorting_criteria(team: Dict[str, Any]) -> tuple:
-            return (-team['match_count'], team['exception_method_idx'][0], -team['exception_method_idx'][1])
-
-        def get_team(MappedTeams: List[Dict[str, Any]]) -> str:
-            sorted_teams = sorted(MappedTeams, key=sorting_criteria)
-            if sorted_teams:
-                return sorted_teams[0]['team_value']
-            return ""
+    @timedStage('predictOwningTeamsWithModel')
+    def predictOwningTeamsWithModel(self, errorLogs: pd.DataFrame, model: OwningTeamModel) -> pd.DataFrame:
+        # Replaces mapToTeams -> get_predicted_owning_team: every row with frames is kept, whether or not a teamMap key matches it,
+        # and PredictedTeamScore (the model's probability for its team) stands in for the keyword mentions when picking rows
+        # parseErrorDetails hands back a filtered view, the model's columns go on a frame of its own
+        errorLogs = self.parseErrorDetails(errorLogs).copy()
+        predictedTeams, scores = model.predictWithScores(errorLogs['ExceptionCallStack'])
+        errorLogs['PredictedOwningTeam'] = predictedTeams
+        errorLogs['PredictedTeamScore'] = scores
+        return errorLogs
 
-        errorLogs['PredictedOwningTeam'] = errorLogs['MappedTeams'].apply(get_team)
+    @timedStage('get_predicted_owning_team')
+    def get_predicted_owning_team(self, errorLogs: pd.DataFrame) -> pd.DataFrame:
+        predictedKeys = teamMatcher.predictKeys(errorLogs[teamMatcher.denseColumns].to_numpy())
+        errorLogs['PredictedOwningTeam'] = teamMatcher.teamsForKeys(predictedKeys)
         return errorLogs 
 
     ####### Shared Processing #######
@@ -272,7 +1668,7 @@ class Exceptions(Resource):
         # Check if all PredictedOwningTeam values are the same
         if nrpDf['PredictedOwningTeam'].nunique() == 1:
             # Get the log with the most mentions of that team
-            most_mentions_log = nrpDf.loc[nrpDf['MappedTeams'].apply(lambda teams: sum(team['team_value'] == nrpDf['PredictedOwningTeam'].iloc[0] for team in teams)).idxmax()]
+            most_mentions_log = nrpDf.loc[Helper.predictedTeamMentions(nrpDf).idxmax()]
             newDf = pd.DataFrame([most_mentions_log])
         else:
             # Get the first occurrence of each log that has a different PredictedOwningTeam
@@ -282,6 +1678,7 @@ class Exceptions(Resource):
             return pd.DataFrame({'status': ['no_data'], 'message': ['combineNrpLogs: Table empty after combining all errorDetail logs']})
         return newDf
     
+    @timedStage('combineNrpIcm')
     def combineNrpIcm(self, nrpDf: pd.DataFrame, icmDf: pd.DataFrame) -> pd.DataFrame:
         nrpCombinedDf = self.combineNrpLogs(nrpDf)
         if 'status' in nrpCombinedDf.columns:
@@ -292,22 +1689,57 @@ class Exceptions(Resource):
         if mergedDf.empty:
             return pd.DataFrame({'status': ['no_data'], 'message': ['combineNrpIcm: Table empty after combining nrpDf and icmDf']})
         
-        mergedDf = mergedDf.drop(columns=['ErrorDetails','StackTrace', 'CorrelationRequestId', 'ErrorCode', 'OperationId', 'OperationName', 'MappedTeams', 'SupportTicketId'])
+        mergedDf = mergedDf.drop(columns=logTLDRDroppedColumns)
+        mergedDf = mergedDf.drop(columns=nrpScoringColumns, errors='ignore')
         return mergedDf
 
-    def runBody(self, incidentId: str) -> pd.DataFrame:
+    @timedStage('combineNrpIcmBatch')
+    def combineNrpIcmBatch(self, icmResults: Dict[str, pd.DataFrame], nrpResults: Dict[str, pd.DataFrame]) -> Dict[str, pd.DataFrame]:
+        # combineNrpIcm for every incident at once: the NRP logs go into one frame tagged with IncidentId, the combineNrpLogs
+        # pick is made per incident by groupby, and a single merge against all the ICM rows finishes them off
+        logTLDRs = {incidentId: nrpResult for incidentId, nrpResult in nrpResults.items() if 'status' in nrpResult.columns}
+        readyIds = [incidentId for incidentId in nrpResults if incidentId not in logTLDRs]
+        if not readyIds:
+            return logTLDRs
+        incidentIdsByKey = {int(incidentId): incidentId for incidentId in readyIds}
+
+        nrpBatchDf = pd.concat([nrpResults[incidentId] for incidentId in readyIds], keys=list(incidentIdsByKey), names=['IncidentId', None])
+        nrpBatchDf = nrpBatchDf.reset_index(level='IncidentId').reset_index(drop=True)
+        incidentKeys = nrpBatchDf['IncidentId']
+        # Incidents with one PredictedOwningTeam keep their row with the most mentions of it, the others the first row per team
+        singleTeam = (nrpBatchDf.groupby('IncidentId', sort=False)['PredictedOwningTeam'].transform('nunique') == 1).to_numpy()
+        mostMentionsRows = Helper.predictedTeamMentions(nrpBatchDf)[singleTeam].groupby(incidentKeys[singleTeam], sort=False).idxmax()
+        firstTeamRows = ~singleTeam & ~nrpBatchDf.duplicated(subset=['IncidentId', 'PredictedOwningTeam']).to_numpy()
+        nrpCombinedDf = nrpBatchDf[firstTeamRows | nrpBatchDf.index.isin(mostMentionsRows)]
+
+        icmBatchDf = pd.concat([icmResults[incidentId] for incidentId in readyIds], ignore_index=True)
+        mergedDf = pd.merge(nrpCombinedDf, icmBatchDf, on=['IncidentId', 'SubscriptionId'], how='inner')
+        # Same column order as combineNrpIcm, where IncidentId comes in with the ICM columns
+        columns = [column for column in nrpCombinedDf.columns if column != 'IncidentId'] + [column for column in icmBatchDf.columns if column != 'SubscriptionId']
+        mergedDf = mergedDf[columns].drop(columns=logTLDRDroppedColumns)
+        mergedDf = mergedDf.drop(columns=nrpScoringColumns, errors='ignore')
+
+        for incidentKey, logTLDR in mergedDf.groupby('IncidentId', sort=False):
+            logTLDRs[incidentIdsByKey[incidentKey]] = logTLDR.reset_index(drop=True)
+        combinedKeys = set(nrpCombinedDf['IncidentId'].tolist())
+        for incidentKey, incidentId in incidentIdsByKey.items():
+            if incidentId in logTLDRs:
+                continue
+            if incidentKey not in combinedKeys:
+                logTLDRs[incidentId] = pd.DataFrame({'status': ['no_data'], 'message': ['combineNrpLogs: Table empty after combining all errorDetail logs']})
+            else:
+                logTLDRs[incidentId] = pd.DataFrame({'status': ['no_data'], 'message': ['combineNrpIcm: Table empty after combining nrpDf and icmDf']})
+        return logTLDRs
+
+    @timedStage('runBody')
+    def runBody(self, incidentId: str, icmResult: pd.DataFrame = None) -> pd.DataFrame:
         if not incidentId:
             return pd.DataFrame({'status': ['error'], 'message': ['incident_id is required']})
     
-        icmResult = self.executeIcmQuery(incidentId)
-        if 'error' in icmResult.columns:
-            return icmResult
-        #print({"icmResult": icmResult.to_dict(orient='records')})
-    
-        subscriptionId = icmResult.iloc[0]['SubscriptionId']
-        incidentTime = icmResult.iloc[0]['IncidentStartTime']
-    
-        nrpResult = self.executeNrpQuery(subscriptionId, incidentTime, incidentId)
+        # icmResult is passed in when the ICM info was already fetched by executeIcmBatchQuery
+        if icmResult is None:
+            icmResult = self.executeIcmQuery(incidentId)
+        nrpResult = self.nrpResultFor(incidentId, icmResult)
         if 'status' in nrpResult.columns:
             return nrpResult
         #print({"nrpResult": nrpResult.to_dict(orient='records')})
@@ -318,6 +1750,109 @@ class Exceptions(Resource):
     
         return logTLDR
 
+    def nrpResultFor(self, incidentId: str, icmResult: pd.DataFrame) -> pd.DataFrame:
+        if 'error' in icmResult.columns:
+            return pd.DataFrame({'status': ['error'], 'message': [icmResult['error'].iloc[0]]})
+        if 'status' in icmResult.columns:
+            return icmResult
+        #print({"icmResult": icmResult.to_dict(orient='records')})
+    
+        subscriptionId = icmResult.iloc[0]['SubscriptionId']
+        incidentTime = icmResult.iloc[0]['IncidentStartTime']
+        return self.executeNrpQuery(subscriptionId, incidentTime, incidentId)
+
+    def safeNrpResultFor(self, incidentId: str, icmResult: pd.DataFrame) -> pd.DataFrame:
+        try:
+            return self.nrpResultFor(incidentId, icmResult)
+        except Exception as e:
+            return pd.DataFrame({'status': ['error'], 'message': [f'nrpResultFor: {e} on incident: {incidentId}']})
+
+    def safeRunBody(self, incidentId: str, icmResult: pd.DataFrame = None) -> pd.DataFrame:
+        # Failures are reported per incident as status/message frames so one bad incident can't sink the whole batch
+        metrics.increment('logtldr_incidents_in_flight')
+        try:
+            logTLDR = self.runBody(incidentId, icmResult)
+        except Exception as e:
+            logTLDR = pd.DataFrame({'status': ['error'], 'message': [f'runBody: {e} on incident: {incidentId}']})
+        finally:
+            metrics.increment('logtldr_incidents_in_flight', -1)
+        self.recordOutcome(logTLDR)
+        return logTLDR
+
+    def recordOutcome(self, logTLDR: pd.DataFrame) -> None:
+        outcome = 'ok' if 'status' not in logTLDR.columns else str(logTLDR['status'].iloc[0])
+        metrics.increment('logtldr_incidents_total', outcome=outcome)
+
+    def storeResult(self, incidentId: str, logTLDR: pd.DataFrame) -> pd.DataFrame:
+        if not Helper.isErrorFrame(logTLDR):
+            incidentStore.put(incidentId, logTLDR)
+        return logTLDR
+
+    def storedResults(self, icmIdList: List[str], refresh: bool = False) -> Tuple[Dict[str, pd.DataFrame], List[str]]:
+        # Incidents already in incidentStore are served from it unless refreshing, the rest still have to be computed
+        storedLogTLDRs = {}
+        missingIds = []
+        for incidentId in icmIdList:
+            logTLDR = None if refresh else incidentStore.get(incidentId)
+            if logTLDR is None:
+                missingIds.append(incidentId)
+            else:
+                storedLogTLDRs[incidentId] = logTLDR
+        return storedLogTLDRs, missingIds
+
+    def iterRunBodies(self, icmIdList: List[str], maxWorkers: int = maxIncidentWorkers, refresh: bool = False) -> Iterator[Tuple[str, pd.DataFrame]]:
+        # Yields (incidentId, logTLDR) as soon as each incident is ready, in completion order, stored incidents first
+        storedLogTLDRs, missingIds = self.storedResults(icmIdList, refresh)
+        yield from storedLogTLDRs.items()
+        if not missingIds:
+            return
+
+        # One batched ICM round trip for every missing incident, then the per-incident NRP work fans out
+        icmBatchDf = self.executeIcmBatchQuery(missingIds)
+        icmResults = [self.icmResultFor(icmBatchDf, incidentId) for incidentId in missingIds]
+        if maxWorkers <= 1 or len(missingIds) <= 1:
+            for incidentId, icmResult in zip(missingIds, icmResults):
+                yield incidentId, self.storeResult(incidentId, self.safeRunBody(incidentId, icmResult))
+            return
+
+        with ThreadPoolExecutor(max_workers=min(maxWorkers, len(missingIds))) as executor:
+            futures = {executor.submit(self.safeRunBody, incidentId, icmResult): incidentId for incidentId, icmResult in zip(missingIds, icmResults)}
+            for future in as_completed(futures):
+                yield futures[future], self.storeResult(futures[future], future.result())
+
+    def fetchNrpResults(self, icmResults: Dict[str, pd.DataFrame], maxWorkers: int = maxIncidentWorkers) -> Dict[str, pd.DataFrame]:
+        if maxWorkers <= 1 or len(icmResults) <= 1:
+            return {incidentId: self.safeNrpResultFor(incidentId, icmResult) for incidentId, icmResult in icmResults.items()}
+        with ThreadPoolExecutor(max_workers=min(maxWorkers, len(icmResults))) as executor:
+            futures = {incidentId: executor.submit(self.safeNrpResultFor, incidentId, icmResult) for incidentId, icmResult in icmResults.items()}
+            return {incidentId: future.result() for incidentId, future in futures.items()}
+
+    def runBodies(self, icmIdList: List[str], maxWorkers: int = maxIncidentWorkers, refresh: bool = False) -> List[pd.DataFrame]:
+        # Unlike iterRunBodies nothing is handed out early, so the NRP logs of every incident are fetched first and
+        # combined with their ICM info in one combineNrpIcmBatch pass. Results come back in the same order as icmIdList
+        results, missingIds = self.storedResults(icmIdList, refresh)
+        if missingIds:
+            metrics.increment('logtldr_incidents_in_flight', len(missingIds))
+            try:
+                icmBatchDf = self.executeIcmBatchQuery(missingIds)
+                icmResults = {incidentId: self.icmResultFor(icmBatchDf, incidentId) for incidentId in missingIds}
+                nrpResults = self.fetchNrpResults(icmResults, maxWorkers)
+                try:
+                    logTLDRs = self.combineNrpIcmBatch(icmResults, nrpResults)
+                except Exception as e:
+                    logTLDRs = {incidentId: pd.DataFrame({'status': ['error'], 'message': [f'combineNrpIcmBatch: {e} on incident: {incidentId}']}) for incidentId in missingIds}
+            finally:
+                metrics.increment('logtldr_incidents_in_flight', -len(missingIds))
+            for incidentId in missingIds:
+                self.recordOutcome(logTLDRs[incidentId])
+                results[incidentId] = self.storeResult(incidentId, logTLDRs[incidentId])
+        return [results[incidentId] for incidentId in icmIdList]
+
+    def tableLink(self, allIcmDf: pd.DataFrame) -> str:
+        # The table stays server-side, the link only carries its id
+        resultId = resultTableStore.put(allIcmDf)
+        return url_for('show_table', result_id=resultId, _external=True)
+
     # Use when you want to grab info for one icm
     # def get(self):
     #     incidentId = request.args.get('incident_id')
@@ -331,41 +1866,250 @@ class Exceptions(Resource):
         
     #     return jsonify({"TableLink" : tableLink, "logTLDR": logTLDR.to_dict(orient='records')}) 
 
-    # Use when you want to find the ICMs
-    def get(self):
-        icmIdList = self.executeFindIcmsQuery()
+    def collectIncidents(self, maxWorkers: int = maxIncidentWorkers, refresh: bool = False, incremental: bool = False) -> pd.DataFrame:
+        # Callers arriving while the same run is in flight get its result, workers only changes how fast it's made
+        return collectFlights.do((refresh, incremental), self.runCollectIncidents, maxWorkers, refresh, incremental).copy()
+
+    @timedStage('collectIncidents')
+    def runCollectIncidents(self, maxWorkers: int = maxIncidentWorkers, refresh: bool = False, incremental: bool = False) -> pd.DataFrame:
+        icmIdList, watermarks = self.findIncidentIds(incremental)
+        if isinstance(icmIdList, pd.DataFrame):
+            return icmIdList
+        # Only once discovery worked, a refresh that can't find incidents leaves the caches for the next try
+        if refresh:
+            Helper.invalidateCaches()
         print(icmIdList)
-        allIcmDf = pd.DataFrame()
+        logTLDRs = []
+        firstFailed = len(icmIdList)
         # icmIdList = pd.DataFrame([511101094, 519639582, 526186661, 525907329])
         # allIcm_df = pd.DataFrame()
         
-        for incidentId in icmIdList:
-            logTLDR = self.runBody(incidentId)
-    
+        for position, (incidentId, logTLDR) in enumerate(zip(icmIdList, self.runBodies(icmIdList, maxWorkers, refresh))):
             if 'status' in logTLDR.columns:
                 print(f'Incident {incidentId} failed in', logTLDR['message'].iloc[0])
+                if Helper.isErrorFrame(logTLDR):
+                    firstFailed = min(firstFailed, position)
                 continue
             print(f'Processing incident {incidentId}')
-            allIcmDf = pd.concat([allIcmDf, logTLDR], ignore_index=True)
+            logTLDRs.append(logTLDR)
+
+        if incremental:
+            # Only moved once the new incidents are processed and stored, a crash before this re-fetches them next run. Error frames
+            # aren't stored, so it stops just before the first incident that errored and the next run retries it and what came after
+            if watermarks is not None:
+                incidentStore.saveWatermark(findIcmsWatermarkName, watermarks[firstFailed])
+            # Earlier runs' incidents live in incidentStore, the result covers the ones stored within the lookback window
+            storedSince = (datetime.utcnow() - timedelta(days=findIcmsInitialLookbackDays)).strftime("%Y-%m-%dT%H:%M:%S")
+            logTLDRs = [logTLDR for logTLDR in incidentStore.allFrames(storedSince) if 'status' not in logTLDR.columns]
+        # Concatenated once at the end, growing the frame inside the loop copied every earlier row again per incident
+        return pd.concat(logTLDRs, ignore_index=True) if logTLDRs else pd.DataFrame()
+
+    # Use when you want to find the ICMs
+    def get(self):
+        workers = Helper.requestedWorkers()
+        incremental = request.args.get('incremental', default=0, type=int) == 1
+        allIcmDf = self.collectIncidents(workers, incremental=incremental)
 
         # Add html table to output
-        allIcmDfjson = quote(allIcmDf.to_json(orient='records'))
-        tableLink = f"http://127.0.0.1:5000/show_table?logTLDR={allIcmDfjson}"            
+        tableLink = self.tableLink(allIcmDf)
 
-        return jsonify({"TableLink" : tableLink, "allIcm_df": allIcmDf.to_dict(orient='records')})
+        return jsonify({"TableLink" : tableLink, "allIcm_df": Helper.jsonRecords(allIcmDf)})
 
-@app.route('/show_table')
-def show_table():
-    logTLDR_json = request.args.get('logTLDR')
-    
-    if not logTLDR_json:
-        return {"error": "logTLDR data is required"}, 400
-    
-    # Convert JSON string back to DataFrame
-    logTLDR_df = pd.read_json(StringIO(logTLDR_df))
+class ExceptionsStream(Exceptions):
+    # Same work as /exceptions but each incident is written out as soon as it's ready, one JSON object per line (NDJSON)
+    # or as server-sent events with ?format=sse, followed by a final "done" object carrying the TableLink
+    def get(self):
+        icmIdList, _ = self.findIncidentIds()
+        if isinstance(icmIdList, pd.DataFrame):
+            return {"status": "error", "message": icmIdList['message'].iloc[0]}, 502
+        workers = Helper.requestedWorkers()
+        useSse = request.args.get('format') == 'sse'
+
+        def formatEvent(eventName: str, event: Dict[str, Any]) -> str:
+            payload = app.json.dumps(event)
+            return f"event: {eventName}\ndata: {payload}\n\n" if useSse else f"{payload}\n"
+
+        def generate() -> Iterator[str]:
+            logTLDRs = []
+            for incidentId, logTLDR in self.iterRunBodies(icmIdList, workers):
+                if 'status' in logTLDR.columns:
+                    print(f'Incident {incidentId} failed in', logTLDR['message'].iloc[0])
+                    yield formatEvent('incident', {"IncidentId": incidentId, "status": logTLDR['status'].iloc[0], "message": logTLDR['message'].iloc[0]})
+                    continue
+                print(f'Processing incident {incidentId}')
+                logTLDRs.append(logTLDR)
+                yield formatEvent('incident', {"IncidentId": incidentId, "status": "ok", "logTLDR": Helper.jsonRecords(logTLDR)})
+
+            allIcmDf = pd.concat(logTLDRs, ignore_index=True) if logTLDRs else pd.DataFrame()
+            yield formatEvent('done', {"status": "done", "TableLink": self.tableLink(allIcmDf), "incidentCount": len(logTLDRs)})
+
+        if useSse:
+            return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Background recompute of /exceptions every refreshIntervalSeconds, 0 leaves only the on demand /exceptions/refresh
+refreshIntervalSeconds = 30 * 60
+refreshJobHistory = 20
+
+class RefreshScheduler:
+    # Runs the /exceptions recompute on a background thread, at most one job at a time, and keeps the newest finished snapshot
+    def __init__(self, intervalSeconds: float):
+        self.intervalSeconds = intervalSeconds
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        self.currentJob = None
+        self.queuedJob = None
+        self.snapshot = None
+        self.stopped = threading.Event()
+
+    def start(self) -> None:
+        if self.intervalSeconds > 0:
+            threading.Thread(target=self.runSchedule, name='refresh-scheduler', daemon=True).start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+    def runSchedule(self) -> None:
+        while not self.stopped.is_set():
+            self.trigger('schedule')
+            self.stopped.wait(self.intervalSeconds)
+
+    def trigger(self, reason: str, refresh: bool = False) -> Dict[str, Any]:
+        # A job that's already running is returned instead of starting another, so refreshes can't stack up. The exception is a
+        # refresh asked for while a job that keeps the caches and store is running: one refresh is queued to run after it
+        with self.lock:
+            if self.currentJob is not None:
+                if not refresh or self.currentJob['refresh']:
+                    return dict(self.currentJob)
+                if self.queuedJob is None:
+                    self.queuedJob = self.newJob(reason, refresh, 'queued')
+                return dict(self.queuedJob)
+            job = self.newJob(reason, refresh, 'running')
+            self.currentJob = job
+        self.startJob(job)
+        return dict(job)
+
+    def newJob(self, reason: str, refresh: bool, state: str) -> Dict[str, Any]:
+        job = {
+            'jobId': uuid.uuid4().hex[:12],
+            'state': state,
+            'reason': reason,
+            'refresh': refresh,
+            'startedAt': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S") if state == 'running' else None,
+            'finishedAt': None,
+            'incidentRows': None,
+            'message': None
+        }
+        self.jobs[job['jobId']] = job
+        while len(self.jobs) > refreshJobHistory:
+            self.jobs.popitem(last=False)
+        return job
+
+    def startJob(self, job: Dict[str, Any]) -> None:
+        threading.Thread(target=self.runJob, args=(job,), name=f"refresh-{job['jobId']}", daemon=True).start()
+
+    def runJob(self, job: Dict[str, Any]) -> None:
+        try:
+            # On demand refreshes rebuild from a full discovery, scheduled ones only pick up what's new since the watermark
+            incremental = incrementalDiscovery and not job['refresh']
+            allIcmDf = Exceptions().collectIncidents(maxIncidentWorkers, job['refresh'], incremental)
+            # A failed discovery keeps the previous snapshot rather than replacing it with nothing
+            if Helper.isErrorFrame(allIcmDf):
+                raise RuntimeError(allIcmDf['message'].iloc[0])
+            snapshot = {'jobId': job['jobId'], 'finishedAt': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"), 'frame': allIcmDf, 'resultId': resultTableStore.put(allIcmDf)}
+            with self.lock:
+                self.snapshot = snapshot
+                job.update(state='succeeded', incidentRows=len(allIcmDf), cacheStats=Helper.cacheStats())
+        except Exception as e:
+            with self.lock:
+                job.update(state='failed', message=str(e))
+        finally:
+            with self.lock:
+                job['finishedAt'] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+                nextJob, self.queuedJob = self.queuedJob, None
+                if nextJob is not None:
+                    nextJob.update(state='running', startedAt=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"))
+                self.currentJob = nextJob
+            if nextJob is not None:
+                self.startJob(nextJob)
+
+    def job(self, jobId: str) -> Dict[str, Any]:
+        with self.lock:
+            job = self.jobs.get(jobId)
+            return dict(job) if job is not None else None
+
+    def latestSnapshot(self) -> Dict[str, Any]:
+        with self.lock:
+            return self.snapshot
+
+refreshScheduler = RefreshScheduler(refreshIntervalSeconds)
+
+class ExceptionsFetch(Exceptions):
+    # Serves the newest snapshot from refreshScheduler right away, readers never wait on Kusto
+    def get(self):
+        snapshot = refreshScheduler.latestSnapshot()
+        if snapshot is None:
+            job = refreshScheduler.trigger('fetch_without_snapshot')
+            return {"status": "pending", "message": "No snapshot finished yet, a refresh job is running", "job": job}, 202
+
+        allIcmDf = snapshot['frame']
+        if resultTableStore.get(snapshot['resultId']) is None:
+            snapshot['resultId'] = resultTableStore.put(allIcmDf)
+        tableLink = url_for('show_table', result_id=snapshot['resultId'], _external=True)
+        return jsonify({"TableLink" : tableLink, "SnapshotJobId": snapshot['jobId'], "SnapshotFinishedAt": snapshot['finishedAt'], "allIcm_df": Helper.jsonRecords(allIcmDf)})
+
+class ExceptionsRefresh(Resource):
+    # Starts a background recompute that skips the caches and incident store, or returns the refresh already running or queued
+    def get(self):
+        job = refreshScheduler.trigger('on_demand', refresh=True)
+        return {"job": job, "JobLink": url_for('refreshjob', job_id=job['jobId'], _external=True)}, 202
+
+class RefreshJob(Resource):
+    def get(self, job_id):
+        job = refreshScheduler.job(job_id)
+        if job is None:
+            return {"error": f"No refresh job with id {job_id}"}, 404
+        return {"job": job}
+
+@app.route('/metrics')
+def metricsEndpoint():
+    # Cache counts live on the caches themselves, they're copied in at scrape time
+    for cacheName, stats in Helper.cacheStats().items():
+        metrics.set('logtldr_cache_hits_total', stats['hits'], cache=cacheName)
+        metrics.set('logtldr_cache_misses_total', stats['misses'], cache=cacheName)
+        metrics.set('logtldr_cache_hit_ratio', stats['hit_ratio'], cache=cacheName)
+        metrics.set('logtldr_cache_entries', stats['size'], cache=cacheName)
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/show_table/<result_id>')
+def show_table(result_id):
+    # ?page=<n>&page_size=<n>&columns=<a,b>&sort=<column>&order=asc|desc, only the requested page is rendered
+    page = max(request.args.get('page', default=1, type=int), 1)
+    pageSize = min(max(request.args.get('page_size', default=showTablePageSize, type=int), 1), showTableMaxPageSize)
+    columns = [column for column in request.args.get('columns', default='').split(',') if column]
+    sortBy = request.args.get('sort')
+    ascending = request.args.get('order', default='asc') != 'desc'
+
+    resultDf = resultTableStore.get(result_id)
+    if resultDf is None:
+        return {"error": f"No result table with id {result_id}, it may have been evicted"}, 404
+    unknownColumns = [column for column in columns + ([sortBy] if sortBy else []) if column not in resultDf.columns]
+    if unknownColumns:
+        return {"error": f"Unknown columns: {', '.join(unknownColumns)}"}, 400
+
+    pageDf = resultTableStore.page(result_id, (page - 1) * pageSize, pageSize, sortBy, ascending)
+    if columns:
+        pageDf = pageDf[columns]
     
     # Convert DataFrame to HTML table
-    html_table = logTLDR_df.to_html()
+    html_table = pageDf.to_html()
+
+    rowCount = len(resultDf)
+    pageCount = max((rowCount + pageSize - 1) // pageSize, 1)
+    # Only the paging options carry over to the previous/next links, anything else in the query string is dropped
+    pageArgs = {key: request.args[key] for key in showTablePageArgs if key in request.args}
+    previousLink = url_for('show_table', result_id=result_id, page=page - 1, **pageArgs) if page > 1 else None
+    nextLink = url_for('show_table', result_id=result_id, page=page + 1, **pageArgs) if page < pageCount else None
 
     return render_template_string('''
     <!DOCTYPE html>
@@ -376,18 +2120,42 @@ def show_table():
     </head>
     <body>
         <h1>Data Table</h1>
+        <p>Page {{ page }} of {{ pageCount }} ({{ rowCount }} rows)
+        {% if previousLink %}<a href="{{ previousLink }}">previous</a>{% endif %}
+        {% if nextLink %}<a href="{{ nextLink }}">next</a>{% endif %}</p>
         {{ table|safe }}
     </body>
     </html>
-    ''', table=html_table)
+    ''', table=html_table, page=page, pageCount=pageCount, rowCount=rowCount, previousLink=previousLink, nextLink=nextLink)
+
+def warmStart():
+    # Runs on a background thread in the serving process so the worker accepts connections while the deferred modules load,
+    # a request that needs one meanwhile just waits on that module's lock
+    for module in heavyModules:
+        module.load()
+    try:
+        print(f'Warm loaded {incidentStore.warmLoad()} incidents from {incidentStore.path}')
+    except Exception as e:
+        print(f'Unable to warm load incident store {incidentStore.path}, starting cold:', e)
 
 def signalHandler(signal, frame):
     print('Shutting down gracefully...')
-    icmClient.close()
-    nrpClient.close()
+    refreshScheduler.stop()
+    kustoClients.close()
     sys.exit(0)
  
 if __name__ == '__main__':
-    api.add_resource(Exceptions, '/exceptions', '/exceptions/fetch', '/exceptions/refresh')
+    api.add_resource(Exceptions, '/exceptions')
+    api.add_resource(ExceptionsFetch, '/exceptions/fetch')
+    api.add_resource(ExceptionsRefresh, '/exceptions/refresh')
+    api.add_resource(RefreshJob, '/exceptions/refresh/<job_id>')
+    api.add_resource(ExceptionsStream, '/exceptions/stream')
     signal.signal(signal.SIGINT, signalHandler)
-    app.run(debug=True)
\ No newline at end of file
+    # With debug on, the reloader re-runs this file in a child process and only that one serves requests
+    debugMode = True
+    if not debugMode or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Authentication happens on this background thread, startup and the first request don't wait on the az cli
+        threading.Thread(target=warmStart, name='warm-start', daemon=True).start()
+        kustoClients.startTokenRefresh()
+        refreshScheduler.start()
+    app.run(debug=debugMode)
\ No newline at end of file
@@ -0,0 +1,91 @@
+import argparse
+import sys
+import time
+from typing import Any, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+import controller
+
+"""Offline training and evaluation of the owning team classifier controller.py uses when useOwningTeamModel is on.
+Examples come from the incident store, each stored row's ExceptionCallStack labelled with the last OwningTeamName
+in its teamHistory. Run from this directory:
+	python owning-team-model.py train
+
+	OR to compare an existing artifact against the keyword scoring,
+	python owning-team-model.py evaluate
+"""
+
+def finalOwningTeam(teamHistory: Any) -> str:
+    if not isinstance(teamHistory, list) or not teamHistory:
+        return None
+    return max(teamHistory, key=lambda hop: str(hop.get('ModifiedDate')))['OwningTeamName']
+
+def loadExamples(storePath: str) -> pd.DataFrame:
+    store = controller.IncidentStore(storePath, controller.logTLDRSchemaVersion)
+    store.warmLoad()
+    frames = [logTLDR for logTLDR in store.allFrames() if {'ExceptionCallStack', 'teamHistory', 'IncidentId'}.issubset(logTLDR.columns)]
+    if not frames:
+        return pd.DataFrame(columns=['IncidentId', 'ExceptionCallStack', 'OwningTeamName'])
+    examples = pd.concat(frames, ignore_index=True)
+    examples['OwningTeamName'] = examples['teamHistory'].map(finalOwningTeam)
+    examples = examples[examples['OwningTeamName'].notna() & examples['ExceptionCallStack'].map(lambda callStack: isinstance(callStack, list) and len(callStack) > 0)]
+    return examples[['IncidentId', 'ExceptionCallStack', 'OwningTeamName']].reset_index(drop=True)
+
+def splitByIncident(examples: pd.DataFrame, testFraction: float) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    # Every row of an incident lands on the same side, so the test split only has incidents the model never saw
+    testIncidents = pd.util.hash_pandas_object(examples['IncidentId'].astype('int64'), index=False) % 1000 < testFraction * 1000
+    return examples[~testIncidents.to_numpy()], examples[testIncidents.to_numpy()]
+
+def heuristicPredictions(callStacks: pd.Series) -> Tuple[np.ndarray, float]:
+    exceptions = controller.Exceptions()
+    start = time.perf_counter()
+    errorLogs = exceptions.get_predicted_owning_team(exceptions.mapToTeams(pd.DataFrame({'ExceptionCallStack': callStacks.to_numpy()})))
+    elapsed = time.perf_counter() - start
+    # Stacks the keyword scoring can't map are dropped by mapToTeams, count them as wrong
+    return errorLogs['PredictedOwningTeam'].reindex(range(len(callStacks))).fillna('').to_numpy(), elapsed
+
+def modelPredictions(model: controller.OwningTeamModel, callStacks: pd.Series) -> Tuple[np.ndarray, float]:
+    start = time.perf_counter()
+    predictions = model.predict(callStacks)
+    return predictions, time.perf_counter() - start
+
+def evaluate(model: controller.OwningTeamModel, examples: pd.DataFrame) -> Dict[str, Dict[str, float]]:
+    callStacks = examples['ExceptionCallStack'].reset_index(drop=True)
+    actual = examples['OwningTeamName'].to_numpy()
+    results = {}
+    for name, (predictions, elapsed) in [('keyword scoring', heuristicPredictions(callStacks)), ('model', modelPredictions(model, callStacks))]:
+        results[name] = {'accuracy': float(np.mean(predictions == actual)) if len(actual) else 0.0, 'us_per_row': elapsed / max(len(actual), 1) * 1e6}
+    return results
+
+def printEvaluation(results: Dict[str, Dict[str, float]], rowCount: int) -> None:
+    print(f"Evaluated on {rowCount} rows")
+    for name, result in results.items():
+        print(f"  {name:16} accuracy {result['accuracy']:.3f}   {result['us_per_row']:8.1f} us/row")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train or evaluate the owning team classifier from the incident store.')
+    parser.add_argument('command', choices=['train', 'evaluate'])
+    parser.add_argument('--store', default=controller.incidentStorePath, help='incident store sqlite file to read examples from')
+    parser.add_argument('--model', default=controller.owningTeamModelPath, help='model artifact to write (train) or read (evaluate)')
+    parser.add_argument('--test-fraction', type=float, default=0.2, help='share of incidents held out for evaluation')
+    args = parser.parse_args()
+
+    examples = loadExamples(args.store)
+    if examples.empty:
+        print(f"No labelled examples in {args.store}, run the service to populate the incident store first")
+        sys.exit(1)
+    trainExamples, testExamples = splitByIncident(examples, args.test_fraction)
+
+    if args.command == 'train':
+        if trainExamples['OwningTeamName'].nunique() < 2:
+            print(f"Need examples of at least two owning teams to train, {args.store} has {trainExamples['OwningTeamName'].nunique()}")
+            sys.exit(1)
+        model = controller.OwningTeamModel().fit(trainExamples['ExceptionCallStack'].tolist(), trainExamples['OwningTeamName'].tolist())
+        model.save(args.model)
+        print(f"Trained on {len(trainExamples)} rows from {trainExamples['IncidentId'].nunique()} incidents, saved {args.model}")
+    else:
+        model = controller.OwningTeamModel.load(args.model)
+
+    printEvaluation(evaluate(model, testExamples if not testExamples.empty else examples), len(testExamples) or len(examples))
@@ -0,0 +1,75 @@
+import argparse
+import cProfile
+import os
+import pstats
+import sys
+import tempfile
+import time
+
+import controller
+
+"""Record the Kusto results behind an endpoint once, then replay them to profile controller.py offline and repeatably.
+Run from this directory:
+	python replay-profile.py record --directory recordings
+
+	OR to time and profile the same request against the recording, with or without simulated network latency,
+	python replay-profile.py replay --directory recordings
+	python replay-profile.py replay --directory recordings --latency-ms 200 --profile
+"""
+
+def requestOnce(path: str, workers: int = None) -> float:
+    # A throwaway incident store and emptied caches keep earlier results from answering instead of the recording
+    with tempfile.TemporaryDirectory() as directory:
+        controller.incidentStore = controller.IncidentStore(os.path.join(directory, 'replay.sqlite3'), controller.logTLDRSchemaVersion)
+        controller.Helper.invalidateCaches()
+        controller.stackCache.invalidate()
+        # Import time isn't part of serving the request
+        for module in controller.heavyModules:
+            module.load()
+        start = time.perf_counter()
+        queryString = {} if workers is None else {'workers': workers}
+        response = controller.app.test_client().get(path, query_string=queryString)
+        elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        print(f'{path} answered {response.status_code}: {response.get_data(as_text=True)[:500]}')
+    return elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record Kusto results for an endpoint, or replay them to profile it without the clusters.')
+    parser.add_argument('mode', choices=['record', 'replay'])
+    parser.add_argument('--directory', default='recordings', help='where recordings are written and read')
+    parser.add_argument('--path', default='/exceptions', help='endpoint to request')
+    parser.add_argument('--latency-ms', type=float, default=0, help='latency injected per replayed query')
+    parser.add_argument('--recorded-latency', action='store_true', help='replay each query with the latency it had when recorded')
+    parser.add_argument('--profile', action='store_true', help='print the slowest functions by cumulative time')
+    parser.add_argument('--top', type=int, default=25, help='how many functions the profile lists')
+    args = parser.parse_args()
+
+    controller.api.add_resource(controller.Exceptions, '/exceptions')
+    controller.api.add_resource(controller.ExceptionsStream, '/exceptions/stream')
+
+    if args.mode == 'record':
+        controller.kustoRecordDirectory = args.directory
+        elapsed = requestOnce(args.path)
+        print(f'Recorded {len(os.listdir(args.directory)) if os.path.isdir(args.directory) else 0} query results in {args.directory} ({elapsed:.2f} s)')
+        controller.kustoClients.close()
+        sys.exit(0)
+
+    replayClient = controller.ReplayKustoClient(args.directory, args.latency_ms / 1000, args.recorded_latency)
+    controller.kustoClients.register('icm', lambda: replayClient)
+    controller.kustoClients.register('nrp', lambda: replayClient)
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler:
+        profiler.enable()
+    # cProfile only sees the thread that enabled it, so profiled runs process the incidents one at a time on this thread
+    elapsed = requestOnce(args.path, workers=1 if profiler else None)
+    if profiler:
+        profiler.disable()
+
+    # Queries overlap across the incident workers, so the injected sleep total can exceed the wall time it cost
+    print(f'{args.path}: {elapsed:.3f} s wall, {replayClient.queryCount} queries replayed with {replayClient.injectedLatencySeconds:.3f} s of injected latency in total')
+    if not replayClient.injectedLatencySeconds:
+        print(f'No latency injected, all {elapsed:.3f} s were spent in controller.py and its libraries')
+    if profiler:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.top)
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+"""Startup timing for controller.py, built on python -X importtime. Run from this directory:
+	python startup-profile.py
+
+	OR to record a baseline and later fail when startup regresses past it,
+	python startup-profile.py --save-baseline startup-baseline.json
+	python startup-profile.py --baseline startup-baseline.json
+"""
+
+controllerDir = os.path.dirname(os.path.abspath(__file__))
+
+# Imports the controller and serves one /exceptions request for a single incident against FakeKustoClient, what a fresh
+# worker does before it's useful. The request is what loads pandas and azure-kusto-data, the import leaves them deferred
+firstRequestScript = r"""
+import os, tempfile, time
+start = time.perf_counter()
+import controller
+imported = time.perf_counter()
+
+stack = r"   at Foo() in d:\bt\1234\repo\src\sources\slb\manager\Slb.cs:line 20"
+def respond(database, query):
+    pd = controller.pd
+    tail = query.split('};')[-1]
+    if 'grabICMBatch' in tail:
+        return pd.DataFrame({
+            'Summary': ['Problem start time: 1/2/2024 3:04:05 PM UTC<br>'], 'SubscriptionId': ['sub-1'], 'SupportTicketId': ['st'],
+            'IncidentStartTime': [pd.Timestamp('2024-01-02')], 'IncidentId': [101],
+            'teamHistory': [[{'OwningTeamName': 'CLOUDNET\\NRP', 'ModifiedDate': '2024-01-02T00:00:00Z'}]],
+        })
+    if 'logs_of_interest' in tail:
+        return pd.DataFrame({
+            'TIMESTAMP': pd.to_datetime(['2024-01-02T15:00:00']), 'ErrorDetails': [stack], 'CorrelationRequestId': ['c1'], 'SubscriptionId': ['sub-1'],
+            'ResourceGroup': ['rg'], 'StackTrace': ['st'], 'ErrorCode': ['E'], 'OperationId': ['op'], 'OperationName': ['Put'],
+        })
+    return pd.DataFrame({'SubscriptionId': ['sub-1'], 'OwningTeamName': ['CLOUDNET\\NRP'], 'IncidentId': [101], 'IncidentStartTime': ['2024-01-02']})
+
+with tempfile.TemporaryDirectory() as directory:
+    client = controller.FakeKustoClient(respond)
+    controller.kustoClients.register('icm', lambda: client)
+    controller.kustoClients.register('nrp', lambda: client)
+    controller.incidentStore = controller.IncidentStore(os.path.join(directory, 'store.sqlite3'), controller.logTLDRSchemaVersion)
+    controller.api.add_resource(controller.Exceptions, '/exceptions')
+    response = controller.app.test_client().get('/exceptions?workers=1')
+    served = time.perf_counter()
+    assert response.status_code == 200 and response.get_json()['allIcm_df'], response.get_data(as_text=True)
+print(imported - start, served - start)
+"""
+
+# Imports the controller and times what warmStart does to the deferred modules, how long after startup a worker is warm
+warmStartScript = r"""
+import time
+import controller
+start = time.perf_counter()
+for module in controller.heavyModules:
+    module.load()
+print(time.perf_counter() - start)
+"""
+
+def importTimes() -> List[Tuple[str, int, int, int]]:
+    # (module, self microseconds, cumulative microseconds, nesting depth) for every module the controller import pulls in
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import controller'], cwd=controllerDir, capture_output=True, text=True, check=True)
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        selfTime, cumulativeTime, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        modules.append((name.strip(), int(selfTime), int(cumulativeTime), depth))
+    return modules
+
+def firstRequestTimes() -> Tuple[float, float]:
+    completed = subprocess.run([sys.executable, '-c', firstRequestScript], cwd=controllerDir, capture_output=True, text=True, check=True)
+    importSeconds, firstRequestSeconds = completed.stdout.split()[-2:]
+    return float(importSeconds), float(firstRequestSeconds)
+
+def warmStartTime() -> float:
+    completed = subprocess.run([sys.executable, '-c', warmStartScript], cwd=controllerDir, capture_output=True, text=True, check=True)
+    return float(completed.stdout.split()[-1])
+
+def profile(repeat: int) -> Dict[str, float]:
+    runs = [firstRequestTimes() for _ in range(repeat)]
+    return {
+        'import_ms': statistics.median(importSeconds for importSeconds, _ in runs) * 1000,
+        'first_request_ms': statistics.median(firstRequestSeconds for _, firstRequestSeconds in runs) * 1000,
+        'warm_start_ms': statistics.median(warmStartTime() for _ in range(repeat)) * 1000,
+    }
+
+def printReport(modules: List[Tuple[str, int, int, int]], timings: Dict[str, float], top: int) -> None:
+    controllerModule = next(module for module in modules if module[0] == 'controller')
+    print(f"controller import (-X importtime):  {controllerModule[2] / 1000:.1f} ms cumulative, {controllerModule[1] / 1000:.1f} ms self")
+    print(f"controller import (median):         {timings['import_ms']:.1f} ms")
+    print(f"first /exceptions request (median): {timings['first_request_ms']:.1f} ms")
+    print(f"warmStart module loads (median):    {timings['warm_start_ms']:.1f} ms")
+    print("\nSlowest imports pulled in directly by controller:")
+    direct = sorted((module for module in modules if module[3] == 1), key=lambda module: module[2], reverse=True)
+    for name, _, cumulativeTime, _ in direct[:top]:
+        print(f"  {cumulativeTime / 1000:8.1f} ms  {name}")
+
+def compareToBaseline(timings: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    regressions = []
+    for name, value in timings.items():
+        if name in baseline and value > baseline[name] * tolerance:
+            regressions.append(f"{name}: {value:.1f} ms, baseline {baseline[name]:.1f} ms (allowed up to {baseline[name] * tolerance:.1f} ms)")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure how long controller.py takes to import and serve its first request.')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per measurement, the median is reported')
+    parser.add_argument('--top', type=int, default=10, help='how many of the slowest imports to list')
+    parser.add_argument('--baseline', help='JSON written by --save-baseline to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='fail when a timing exceeds the baseline by more than this factor')
+    parser.add_argument('--save-baseline', help='write the measured timings to this JSON file')
+    args = parser.parse_args()
+
+    timings = profile(args.repeat)
+    printReport(importTimes(), timings, args.top)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baselineFile:
+            json.dump(timings, baselineFile, indent=2)
+        print(f"\nSaved baseline to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = compareToBaseline(timings, json.load(baselineFile), args.tolerance)
+        if regressions:
+            print('\nStartup regressed:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+        print(f"\nWithin {args.tolerance}x of baseline {args.baseline}")